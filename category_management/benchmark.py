@@ -0,0 +1,396 @@
+"""
+Reproducible benchmarks of the services and the rabbit hole script, in-process and through the API.
+
+Every scale loads a seeded random catalog into a fresh repository and times each operation on its own,
+so results only change when the code does. They are written as JSON to be compared between releases:
+
+    python benchmark.py --pairs 2000 20000 200000 1000000 --output benchmark.json
+    python benchmark.py --compare old.json new.json
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from fastapi.testclient import TestClient
+from category_service import CategoryService
+from similarity_service import SimilarityService
+from rabbit_hole_script import RabbitHoleScript
+from schemas import Category, DeleteMode, Similarity
+from models import InMemoryDatabase
+from sqlite_repository import SqliteRepository
+
+try:
+    import sparse_graph
+except ImportError:
+    # numpy and scipy are optional, and without them the sparse engine is not benchmarked
+    sparse_graph = None
+
+LOAD_BATCH_SIZE = 5000
+
+
+class Operation(NamedTuple):
+    name: str
+    # Called with the index of the sample
+    run: Callable[[int], object]
+    # Heavy operations, such as a full rabbit hole analysis, take fewer samples
+    heavy: bool = False
+    # Operations that grow faster than the graph are skipped on larger scales
+    max_pairs: Optional[int] = None
+
+
+class Workload:
+    """
+    Seeded random catalog: a forest of categories, each under a random earlier one, and distinct similarity pairs.
+    """
+
+    ROOT_SHARE = 0.01
+
+    def __init__(self, category_count: int, pair_count: int, seed: int):
+        self.random = random.Random(f"{seed}:{category_count}:{pair_count}")
+        self.names = [f"category{index}" for index in range(category_count)]
+        self.parents = [None if index == 0 or self.random.random() < self.ROOT_SHARE
+                        else self.names[self.random.randrange(index)] for index in range(category_count)]
+
+        # A pair is encoded as first * category_count + second with first < second, so a million stay compact
+        pair_count = min(pair_count, category_count * (category_count - 1) // 2)
+        codes = set()
+        while len(codes) < pair_count:
+            first, second = self.random.sample(range(category_count), 2)
+            codes.add(min(first, second) * category_count + max(first, second))
+        self.pair_codes = sorted(codes)
+        self.random.shuffle(self.pair_codes)
+
+    def categories(self) -> List[Category]:
+        return [Category(name=name, description=f"Description of {name}", parent_name=parent_name)
+                for name, parent_name in zip(self.names, self.parents)]
+
+    def similarities(self, start: int, end: int) -> List[Similarity]:
+        category_count = len(self.names)
+        return [Similarity(category_name_1=self.names[code // category_count],
+                           category_name_2=self.names[code % category_count]) for code in self.pair_codes[start:end]]
+
+    def new_pairs(self, rng: random.Random, count: int) -> List[tuple]:
+        """Random pairs that are not in the catalog, so deleting them again restores it"""
+        category_count, existing, pairs = len(self.names), set(self.pair_codes), []
+        while len(pairs) < count:
+            first, second = rng.sample(range(category_count), 2)
+            if min(first, second) * category_count + max(first, second) not in existing:
+                pairs.append((self.names[first], self.names[second]))
+        return pairs
+
+    def name(self, index: int) -> str:
+        return self.names[index % len(self.names)]
+
+    def random_name(self, rng: random.Random) -> str:
+        return rng.choice(self.names)
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def measure(operation: Operation, samples: int) -> Dict:
+    durations = []
+    started = time.perf_counter()
+    for index in range(samples):
+        start = time.perf_counter()
+        operation.run(index)
+        durations.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+
+    # One more sample under tracemalloc, which would distort the timings - its peak is what the operation allocates
+    tracemalloc.start()
+    operation.run(samples)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations.sort()
+    return {
+        "operation": operation.name,
+        "samples": samples,
+        "mean_ms": sum(durations) / samples * 1000,
+        "p50_ms": percentile(durations, 0.50) * 1000,
+        "p95_ms": percentile(durations, 0.95) * 1000,
+        "p99_ms": percentile(durations, 0.99) * 1000,
+        "throughput_per_s": samples / elapsed if elapsed else float("inf"),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def load(workload: Workload, category_service: CategoryService, similarity_service: SimilarityService) -> Dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    category_service.create_categories(workload.categories())
+    categories_loaded = time.perf_counter()
+    for batch_start in range(0, len(workload.pair_codes), LOAD_BATCH_SIZE):
+        similarity_service.create_similarities(workload.similarities(batch_start, batch_start + LOAD_BATCH_SIZE))
+    similarities_loaded = time.perf_counter()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "categories": len(workload.names),
+        "pairs": len(workload.pair_codes),
+        "categories_s": categories_loaded - start,
+        "similarities_s": similarities_loaded - categories_loaded,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+'''
+Writes are paired so the catalog is the same after them: every created category and similarity is deleted again.
+'''
+def in_process_operations(workload: Workload, category_service: CategoryService,
+                          similarity_service: SimilarityService, rabbit_hole_script: RabbitHoleScript,
+                          seed: int) -> List[Operation]:
+    rng = random.Random(f"{seed}:in-process")
+    bench_parents = [workload.random_name(rng) for _ in range(10_000)]
+    pairs = workload.new_pairs(rng, 50_000)
+
+    def bench_name(index: int) -> str:
+        return f"bench{index}"
+
+    def similarity(index: int) -> Similarity:
+        name_1, name_2 = pairs[index % len(pairs)]
+        return Similarity(category_name_1=name_1, category_name_2=name_2)
+
+    def batch(index: int) -> List[Similarity]:
+        return [similarity(index * 100 + offset) for offset in range(100)]
+
+    def graph():
+        return rabbit_hole_script.repository.similarity_graph()
+
+    return [
+        Operation("CategoryService.get_category", lambda i: category_service.get_category(workload.name(i))),
+        Operation("CategoryService.get_categories", lambda i: category_service.get_categories(workload.name(i))),
+        Operation("CategoryService.get_categories_by_depth",
+                  lambda i: category_service.get_categories(depth=i % 4)),
+        Operation("CategoryService.get_subtree", lambda i: list(category_service.get_subtree(workload.name(i)))),
+        Operation("CategoryService.get_subtree_of_roots",
+                  lambda i: [list(category_service.get_subtree(root.name)) for root in category_service.get_categories()],
+                  heavy=True),
+        Operation("CategoryService.update_category", lambda i: category_service.update_category(
+            workload.name(i), Category(name=workload.name(i), description=f"Updated {i}"))),
+        Operation("CategoryService.create_category", lambda i: category_service.create_category(
+            Category(name=bench_name(i), parent_name=bench_parents[i % len(bench_parents)]))),
+        Operation("CategoryService.move_category",
+                  lambda i: category_service.move_category(bench_name(i), bench_parents[-1 - i % len(bench_parents)])),
+        Operation("CategoryService.delete_category", lambda i: category_service.delete_category(bench_name(i))),
+        Operation("CategoryService.create_categories", lambda i: category_service.create_categories(
+            [Category(name=f"bench{i}_{offset}", parent_name=bench_parents[i % len(bench_parents)])
+             for offset in range(100)])),
+        Operation("CategoryService.delete_category_cascade", lambda i: [
+            category_service.delete_category(f"bench{i}_{offset}", DeleteMode.CASCADE) for offset in range(100)]),
+        Operation("SimilarityService.get_similarities",
+                  lambda i: similarity_service.get_similarities(workload.name(i))),
+        Operation("SimilarityService.get_rabbit_island",
+                  lambda i: similarity_service.get_rabbit_island(workload.name(i))),
+        Operation("SimilarityService.create_similarity", lambda i: similarity_service.create_similarity(similarity(i))),
+        Operation("SimilarityService.delete_similarity", lambda i: similarity_service.delete_similarity(similarity(i))),
+        Operation("SimilarityService.create_similarities", lambda i: similarity_service.create_similarities(batch(i))),
+        Operation("SimilarityService.delete_similarities",
+                  lambda i: [similarity_service.delete_similarity(pair) for pair in batch(i)]),
+        Operation("SimilarityService.get_rabbit_islands", lambda i: similarity_service.get_rabbit_islands(),
+                  heavy=True),
+        Operation("RabbitHoleScript.analyse_rabbit_holes",
+                  lambda i: rabbit_hole_script.analyse_rabbit_holes(i), heavy=True),
+        Operation("RabbitHoleScript.find_longest_rabbit_hole_and_islands",
+                  lambda i: rabbit_hole_script.find_longest_rabbit_hole_and_islands()),
+        Operation("RabbitHoleScript.create_adjacency_list_optimized",
+                  lambda i: rabbit_hole_script.create_adjacency_list_optimized()),
+        Operation("RabbitHoleScript.find_longest_rabbit_hole",
+                  lambda i: rabbit_hole_script.find_longest_rabbit_hole(graph()), heavy=True),
+        # Every longest rabbit hole needs a BFS from every vertex that ends one, which dense graphs are full of
+        Operation("RabbitHoleScript.find_longest_rabbit_hole_optimized",
+                  lambda i: rabbit_hole_script.find_longest_rabbit_hole_optimized(graph()), heavy=True,
+                  max_pairs=20000),
+        Operation("RabbitHoleScript.find_rabbit_islands_optimized",
+                  lambda i: rabbit_hole_script.find_rabbit_islands_optimized(graph()), heavy=True),
+    ] + ([
+        Operation("RabbitHoleScript.find_longest_rabbit_hole[sparse]",
+                  lambda i: rabbit_hole_script.find_longest_rabbit_hole(graph(), "sparse"), heavy=True),
+        Operation("RabbitHoleScript.find_longest_rabbit_hole_optimized[sparse]",
+                  lambda i: rabbit_hole_script.find_longest_rabbit_hole_optimized(graph(), "sparse"), heavy=True),
+        Operation("RabbitHoleScript.find_rabbit_islands_optimized[sparse]",
+                  lambda i: rabbit_hole_script.find_rabbit_islands_optimized(graph(), "sparse"), heavy=True),
+    ] if sparse_graph else [])
+
+
+def api_client(category_service: CategoryService, similarity_service: SimilarityService,
+               rabbit_hole_script: RabbitHoleScript) -> TestClient:
+    import main
+
+    # The routes look the services up as module globals, so they are pointed at the benchmark's repository
+    main.category_service = category_service
+    main.similarity_service = similarity_service
+    main.rabbit_hole_script = rabbit_hole_script
+    return TestClient(main.app)
+
+
+def api_operations(workload: Workload, client: TestClient, seed: int) -> List[Operation]:
+    rng = random.Random(f"{seed}:api")
+    bench_parents = [workload.random_name(rng) for _ in range(10_000)]
+    pairs = workload.new_pairs(rng, 50_000)
+
+    def request(method: str, url: str, **kwargs):
+        response = client.request(method, url, **kwargs)
+        assert response.status_code == 200, response.text
+        return response.content
+
+    def bench_name(index: int) -> str:
+        return f"api-bench{index}"
+
+    def similarity(index: int) -> Dict:
+        name_1, name_2 = pairs[index % len(pairs)]
+        return {"category_name_1": name_1, "category_name_2": name_2}
+
+    def ndjson_batch(index: int) -> bytes:
+        return "\n".join(json.dumps(similarity(index * 100 + offset)) for offset in range(100)).encode()
+
+    return [
+        Operation("GET /categories/{name}", lambda i: request("GET", f"/categories/{workload.name(i)}")),
+        Operation("GET /categories/?parent_name", lambda i: request("GET", "/categories/",
+                                                                    params={"parent_name": workload.name(i)})),
+        Operation("GET /categories/?depth", lambda i: request("GET", "/categories/", params={"depth": i % 4})),
+        Operation("GET /categories/{name}/subtree", lambda i: request("GET", f"/categories/{workload.name(i)}/subtree")),
+        Operation("PUT /categories/{name}", lambda i: request(
+            "PUT", f"/categories/{workload.name(i)}", json={"name": workload.name(i), "description": f"Updated {i}"})),
+        Operation("POST /categories/", lambda i: request(
+            "POST", "/categories/", json={"name": bench_name(i), "parent_name": bench_parents[i % len(bench_parents)]})),
+        Operation("PATCH /categories/{name}/move", lambda i: request(
+            "PATCH", f"/categories/{bench_name(i)}/move",
+            params={"new_parent_name": bench_parents[-1 - i % len(bench_parents)]})),
+        Operation("DELETE /categories/{name}", lambda i: request("DELETE", f"/categories/{bench_name(i)}")),
+        Operation("GET /similarities/{name}", lambda i: request("GET", f"/similarities/{workload.name(i)}")),
+        Operation("POST /similarities/", lambda i: request("POST", "/similarities/", json=similarity(i))),
+        Operation("DELETE /similarities/", lambda i: request("DELETE", "/similarities/", json=similarity(i))),
+        Operation("POST /similarities/batch", lambda i: request(
+            "POST", "/similarities/batch", content=ndjson_batch(i), headers={"Content-Type": "application/x-ndjson"})),
+        Operation("GET /rabbit_islands/{name}", lambda i: request("GET", f"/rabbit_islands/{workload.name(i)}")),
+        Operation("GET /rabbit_islands/", lambda i: request("GET", "/rabbit_islands/"), heavy=True),
+        Operation("GET /rabbit_hole_and_islands/", lambda i: request("GET", "/rabbit_hole_and_islands/")),
+    ]
+
+
+def build_repository(kind: str, directory: str, pair_count: int):
+    if kind == "sqlite":
+        return SqliteRepository(f"{directory}/benchmark-{pair_count}.db")
+    return InMemoryDatabase()
+
+
+def run(pair_counts: List[int], category_count: int = 2000, seed: int = 42, samples: int = 200,
+        heavy_samples: int = 5, modes: tuple = ("in-process", "api"), repository: str = "memory",
+        operation_filter: Optional[str] = None, report: Callable[[str], None] = print) -> Dict:
+    results = {
+        "meta": {
+            "seed": seed,
+            "categories": category_count,
+            "samples": samples,
+            "heavy_samples": heavy_samples,
+            "repository": repository,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "scales": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for pair_count in pair_counts:
+            workload = Workload(category_count, pair_count, seed)
+            store = build_repository(repository, directory, pair_count)
+            category_service, similarity_service = CategoryService(store), SimilarityService(store)
+            rabbit_hole_script = RabbitHoleScript(store)
+            scale = {"pairs": pair_count, "load": load(workload, category_service, similarity_service), "results": []}
+            report(f"\n{pair_count} pairs - loaded in "
+                   f"{scale['load']['categories_s'] + scale['load']['similarities_s']:.2f}s")
+
+            operations = []
+            if "in-process" in modes:
+                operations += [("in-process", operation) for operation in in_process_operations(
+                    workload, category_service, similarity_service, rabbit_hole_script, seed)]
+            if "api" in modes:
+                client = api_client(category_service, similarity_service, rabbit_hole_script)
+                operations += [("api", operation) for operation in api_operations(workload, client, seed)]
+
+            for mode, operation in operations:
+                if operation_filter and operation_filter not in operation.name:
+                    continue
+                if operation.max_pairs is not None and pair_count > operation.max_pairs:
+                    report(f"{mode:<10} {operation.name:<55} skipped above {operation.max_pairs} pairs")
+                    continue
+                result = measure(operation, heavy_samples if operation.heavy else samples)
+                result["mode"] = mode
+                scale["results"].append(result)
+                report(format_result(result))
+
+            results["scales"].append(scale)
+            if hasattr(store, "close"):
+                store.close()
+
+    return results
+
+
+def format_result(result: Dict) -> str:
+    return (f"{result['mode']:<10} {result['operation']:<55} p50 {result['p50_ms']:9.3f}ms "
+            f"p95 {result['p95_ms']:9.3f}ms p99 {result['p99_ms']:9.3f}ms "
+            f"{result['throughput_per_s']:10.1f}/s peak {result['peak_memory_bytes'] / 1024:9.1f}KiB")
+
+
+'''
+Prints how p50 and p95 changed for every operation the two result files have in common
+'''
+def compare(old: Dict, new: Dict, report: Callable[[str], None] = print):
+    def keyed(results):
+        return {(scale["pairs"], result["mode"], result["operation"]): result
+                for scale in results["scales"] for result in scale["results"]}
+
+    old_results, new_results = keyed(old), keyed(new)
+    for key in sorted(old_results.keys() & new_results.keys(), key=str):
+        pairs, mode, operation = key
+        changes = []
+        for field in ("p50_ms", "p95_ms"):
+            before, after = old_results[key][field], new_results[key][field]
+            change = (after / before - 1) * 100 if before else 0.0
+            changes.append(f"{field} {before:9.3f} -> {after:9.3f}ms ({change:+6.1f}%)")
+        report(f"{pairs:>8} {mode:<10} {operation:<55} {' '.join(changes)}")
+
+
+def main(arguments: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, nargs="+", default=[2000, 20000, 200000],
+                        help="similarity pair counts to benchmark, one fresh catalog each")
+    parser.add_argument("--categories", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--heavy-samples", type=int, default=5)
+    parser.add_argument("--modes", nargs="+", choices=["in-process", "api"], default=["in-process", "api"])
+    parser.add_argument("--repository", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--operation", help="only run operations whose name contains this")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON result files")
+    args = parser.parse_args(arguments)
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    results = run(args.pairs, args.categories, args.seed, args.samples, args.heavy_samples, tuple(args.modes),
+                  args.repository, args.operation)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"\nResults written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
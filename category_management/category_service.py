@@ -1,83 +1,198 @@
 from fastapi import HTTPException
-from typing import Optional
-from schemas import Category
+from typing import Iterable, List, Optional
+from schemas import Category, DeleteMode
+from journaled import Journaled
 from models import db
+from versions import CATEGORY, CHILDREN, SIMILAR, TREE
 
 
-class CategoryService:
-    def __init__(self, in_memory_db):
-        self.categories = in_memory_db.categories
-        self.category_tree = in_memory_db.category_tree
+class CategoryService(Journaled):
+    def __init__(self, repository):
+        # A repository.Repository - the in-memory database or the SQLite one
+        self.repository = repository
+        self.write_lock = repository.write_lock
+        self.versions = repository.versions
 
     def create_category(self, category: Category):
-        if category.parent_name:
-            if category.parent_name not in self.categories:
+        with self.write_lock:
+            if category.parent_name and not self.repository.has_category(category.parent_name):
                 raise HTTPException(status_code=404, detail="Parent category not found")
 
-            self.category_tree.setdefault(category.parent_name, []).append(category.name)
-        else:
-            self.category_tree[None].append(category.name)
-
-        self.categories[category.name] = category
-        return self.categories[category.name]
+            # Creating a category that exists replaces it, which must not put it under itself
+            existing = self.repository.get_category(category.name)
+            if existing is not None and self.repository.is_in_subtree(category.parent_name, category.name):
+                raise HTTPException(status_code=400, detail="Category can not be moved into its own subtree")
+
+            self._create_categories([category])
+            if existing is not None:
+                self._bump_changed([category.name], self._similar_names([category.name]), [existing.parent_name])
+        self.sync()
+        return self.repository.get_category(category.name)
+
+    '''
+    All or nothing - the whole batch is validated first and nothing is created if any category fails.
+    A parent may be created earlier in the same batch.
+    '''
+    def create_categories(self, categories: List[Category]):
+        with self.write_lock:
+            errors = []
+            batch_names = set()
+            for index, category in enumerate(categories):
+                if self.repository.has_category(category.name) or category.name in batch_names:
+                    errors.append({"index": index, "detail": "Category already exists"})
+                elif category.parent_name and not self.repository.has_category(category.parent_name) \
+                        and category.parent_name not in batch_names:
+                    errors.append({"index": index, "detail": "Parent category not found"})
+                batch_names.add(category.name)
+
+            if errors:
+                raise HTTPException(status_code=422, detail=errors)
+
+            self._create_categories(categories)
+
+        self.sync()
+        return {"created": len(categories)}
 
     def update_category(self, name: str, category_data: Category):
-        if name not in self.categories:
-            raise HTTPException(status_code=404, detail="Category not found")
-
-        current_category = self.categories[name]
-        updated_fields = category_data.dict(exclude_unset=True)
-
-        for field, value in updated_fields.items():
-            setattr(current_category, field, value)
+        with self.write_lock:
+            current_category = self.repository.get_category(name)
+            if current_category is None:
+                raise HTTPException(status_code=404, detail="Category not found")
+
+            updated_fields = category_data.dict(exclude_unset=True)
+            logged_fields = dict(updated_fields)
+
+            # The tree has to follow a parent change, so it goes through move_category
+            new_parent_name = updated_fields.pop("parent_name", current_category.parent_name)
+            if new_parent_name != current_category.parent_name:
+                self._move_category(name, new_parent_name)
+
+            self.repository.update_category(name, updated_fields)
+            self.log("update_category", name, logged_fields)
+            self._bump_changed([name], self._similar_names([name]), [current_category.parent_name])
+
+        self.sync()
+        return self.repository.get_category(name)
+
+    '''
+    Deletes the category together with its similarities. Its children are either moved up to its parent
+    (reparent) or deleted with their whole subtree (cascade).
+    '''
+    def delete_category(self, name: str, mode: DeleteMode = DeleteMode.REPARENT):
+        with self.write_lock:
+            category = self.repository.get_category(name)
+            if category is None:
+                raise HTTPException(status_code=404, detail="Category not found")
+
+            # Listings that show a deleted or reparented category change too, so they are found before the delete
+            if mode == DeleteMode.CASCADE:
+                deleted_names = changed_names = self._subtree_names(name)
+            else:
+                deleted_names = [name]
+                changed_names = deleted_names + [child.name for child in self.repository.get_children(name)]
+            similar_names = self._similar_names(changed_names)
+
+            deleted_categories = self.repository.delete_category(name, mode)
+            self.log("delete_category", name, DeleteMode(mode).value)
+            # The listings of deleted names are bumped as well, so a category created again under one of the names
+            # starts past every version they had
+            self._bump_changed(changed_names, similar_names.union(deleted_names),
+                               [category.parent_name, *deleted_names])
+
+        self.sync()
+        return {"message": f"Category '{name}' deleted successfully", "deleted_categories": deleted_categories}
 
-        self.categories[name] = current_category
-        return self.categories[name]
-
-    def delete_category(self, name: str):
-        if name not in self.categories:
-            raise HTTPException(status_code=404, detail="Category not found")
+    def move_category(self, name: str, new_parent_name: Optional[str]):
+        with self.write_lock:
+            self._move_category(name, new_parent_name)
+        self.sync()
+        return self.repository.get_category(name)
 
-        parent_name = self.categories[name].parent_name
-        if parent_name in self.category_tree:
-            self.category_tree[parent_name].remove(name)
+    def is_in_subtree(self, name: Optional[str], root_name: str) -> bool:
+        return self.repository.is_in_subtree(name, root_name)
 
-        del self.categories[name]
+    '''
+    ETags of what the routes serve, taken before the data is read
+    '''
+    def category_etag(self, name: str) -> str:
+        return self.versions.etag(CATEGORY, name)
 
-        return {"message": f"Category '{name}' deleted successfully"}
+    def categories_etag(self, parent_name: Optional[str] = None, depth: Optional[int] = None) -> str:
+        if depth is None:
+            return self.versions.etag(CHILDREN, parent_name)
+        return self.versions.etag(TREE)
 
-    def move_category(self, name: str, new_parent_name: Optional[str]):
-        if name not in self.categories:
+    def get_category(self, name: str):
+        category = self.repository.get_category(name)
+        if category is None:
             raise HTTPException(status_code=404, detail="Category not found")
+        return category
 
-        if new_parent_name is not None and new_parent_name not in self.categories:
-            raise HTTPException(status_code=404, detail="New parent category not found")
-
-        current_category = self.categories[name]
-        current_parent_name = current_category.parent_name
+    '''
+    With a depth, returns the categories that many levels below the parent (or below the roots, which are at depth 0)
+    '''
+    def get_categories(self, parent_name: Optional[str] = None, depth: Optional[int] = None):
+        if parent_name is not None and not self.repository.has_category(parent_name):
+            raise HTTPException(status_code=404, detail="Parent category not found")
 
-        if current_parent_name in self.category_tree:
-            self.category_tree[current_parent_name].remove(name)
+        if depth is None:
+            return self.repository.get_children(parent_name)
+        return self.repository.get_categories_at_depth(depth, parent_name)
 
-        current_category.parent_name = new_parent_name
+    '''
+    Returns a lazy iterator of (category, depth below name) in preorder, so large subtrees can be streamed
+    '''
+    def get_subtree(self, name: str, max_depth: Optional[int] = None):
+        if not self.repository.has_category(name):
+            raise HTTPException(status_code=404, detail="Category not found")
 
-        if new_parent_name is None:
-            self.category_tree[None].append(name)
-        else:
-            self.category_tree.setdefault(new_parent_name, []).append(name)
+        return self.repository.get_subtree(name, max_depth)
 
-        return self.categories[name]
+    def _create_categories(self, categories: List[Category]):
+        self.repository.add_categories(categories)
+        if self.journal is not None:
+            for category in categories:
+                self.log("create_category", category.dict(exclude={"children"}))
+        self._bump_changed((), (), {category.parent_name for category in categories})
 
-    def get_category(self, name: str):
-        if name not in self.categories:
+    def _move_category(self, name: str, new_parent_name: Optional[str]):
+        if not self.repository.has_category(name):
             raise HTTPException(status_code=404, detail="Category not found")
-        return self.categories[name]
 
-    def get_categories(self, parent_name: Optional[str] = None):
-        if parent_name is not None and parent_name not in self.categories:
-            raise HTTPException(status_code=404, detail="Parent category not found")
+        if new_parent_name is not None and not self.repository.has_category(new_parent_name):
+            raise HTTPException(status_code=404, detail="New parent category not found")
 
-        return [self.categories[cid] for cid in self.category_tree.get(parent_name, [])]
+        if self.repository.is_in_subtree(new_parent_name, name):
+            raise HTTPException(status_code=400, detail="Category can not be moved into its own subtree")
+
+        old_parent_name = self.repository.get_category(name).parent_name
+
+        self.repository.set_parent(name, new_parent_name)
+        self.log("move_category", name, new_parent_name)
+        self._bump_changed([name], self._similar_names([name]), [old_parent_name, new_parent_name])
+
+    '''
+    Walks the children instead of get_subtree, which would rebuild the in-memory tree index after every write
+    '''
+    def _subtree_names(self, name: str) -> List[str]:
+        names, index = [name], 0
+        while index < len(names):
+            names.extend(child.name for child in self.repository.get_children(names[index]))
+            index += 1
+        return names
+
+    def _similar_names(self, names: Iterable[str]) -> set:
+        return {similar.name for name in names for similar in self.repository.get_similar(name)}
+
+    '''
+    Called after a write with the categories it changed. Their own versions, the similarity listings
+    they appear in, the children listings of parent_names and the tree are bumped.
+    '''
+    def _bump_changed(self, names: Iterable[str], similar_names: Iterable[str], parent_names: Iterable[Optional[str]]):
+        self.versions.bump(CATEGORY, names)
+        self.versions.bump(SIMILAR, similar_names)
+        self.versions.bump(CHILDREN, parent_names)
+        self.versions.bump(TREE, [None])
 
 
 category_service = CategoryService(db)
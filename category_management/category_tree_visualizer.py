@@ -1,17 +1,13 @@
-from models import Category
+from typing import Iterable, Tuple
+from schemas import CategoryRecord
 
 
 class CategoryTreeVisualizer:
     @staticmethod
-    def build_category_tree(category: Category) -> Category:
-        category.children = [CategoryTreeVisualizer.build_category_tree(child) for child in category.children]
-        return category
-
-    @staticmethod
-    def print_category_tree(category: Category, indent: int = 0):
-        print(' ' * indent + f'Name: {category.name}, Description: {category.description}, Image: {category.image}')
-        for child in category.children:
-            CategoryTreeVisualizer.print_category_tree(child, indent + 4)
+    def print_category_tree(subtree: Iterable[Tuple[CategoryRecord, int]], indent: int = 4):
+        for category, depth in subtree:
+            print(' ' * indent * depth +
+                  f'Name: {category.name}, Description: {category.description}, Image: {category.image}')
 
 
-category_tree_visualizer = CategoryTreeVisualizer()
\ No newline at end of file
+category_tree_visualizer = CategoryTreeVisualizer()
@@ -0,0 +1,18 @@
+class Journaled:
+    """
+    A service whose writes are appended to an optional persistence.WriteAheadLog, set by Persistence on open.
+
+    Writes are journaled under the write lock, so the log keeps their order. Waiting for the fsync happens
+    after the lock is released, so concurrent writers share one fsync.
+    """
+
+    # The persistence.WriteAheadLog of the service, None while nothing is persisted
+    journal = None
+
+    def log(self, operation: str, *arguments):
+        if self.journal is not None:
+            self.journal.append(operation, *arguments)
+
+    def sync(self):
+        if self.journal is not None:
+            self.journal.sync()
@@ -0,0 +1,188 @@
+import heapq
+import time
+from array import array
+from typing import List, Optional, Tuple
+from metrics import metrics
+from models import SimilarityGraph
+
+
+class LandmarkIndex:
+    """
+    Rabbit hole distances from a few landmark categories to every category of a similarity graph snapshot.
+
+    For a landmark l that reaches u and v, |d(l, u) - d(l, v)| <= d(u, v) <= d(l, u) + d(l, v), so bounds of any
+    distance take one lookup per landmark, and tight bounds guide an exact search straight to its target.
+    The largest islands get a landmark first, at the far end of a sweep, and any left over go farthest first -
+    each to the category farthest from every landmark so far. Islands of one pair never get one, so the island
+    of every category is kept as well, and settles the pairs that no landmark reaches.
+    """
+
+    def __init__(self, graph: SimilarityGraph, count: int):
+        self.graph = graph
+        self.version = graph.version
+        self.landmarks: List[int] = []
+        # Hops from each landmark to every category id, -1 where it does not reach
+        self.distances: List[array] = []
+        # Island number of every category id, -1 for ids without similarities
+        self.island = array('i', [-1]) * graph.vertex_count
+
+        islands = sorted(self._islands(), key=lambda island: -island[0])
+        for size, far_end in islands[:count]:
+            if size < 3:
+                break
+            self._add(far_end)
+
+        # Hops to the nearest landmark, -1 where none reaches - those categories never get one now
+        nearest = array('i', [-1]) * graph.vertex_count
+        for distances in self.distances:
+            nearest = array('i', map(self._nearer, nearest, distances))
+        while self.distances and len(self.landmarks) < count:
+            farthest = max(range(graph.vertex_count), key=nearest.__getitem__)
+            if nearest[farthest] <= 1:
+                break
+            nearest = array('i', map(self._nearer, nearest, self._add(farthest)))
+
+    def bounds(self, source: int, target: int) -> Optional[Tuple[int, Optional[int]]]:
+        """
+        (lower, upper) bounds of the distance, with no upper bound when no landmark reaches the categories.
+        None when they are on different islands.
+        """
+        if source == target:
+            return 0, 0
+        if self.island[source] < 0 or self.island[source] != self.island[target]:
+            return None
+
+        lower, upper = 1, None
+        for distances in self.distances:
+            distance_1, distance_2 = distances[source], distances[target]
+            if distance_1 < 0:
+                continue
+            lower = max(lower, abs(distance_1 - distance_2))
+            upper = distance_1 + distance_2 if upper is None else min(upper, distance_1 + distance_2)
+        return lower, upper
+
+    '''
+    Exact distance, None when the categories are not connected. When the bounds are tight the lower bounds guide
+    an A* search straight to the target; when they are loose, as on small-world graphs, they would not steer it
+    and a bidirectional BFS is cheaper. Both stop once no hole shorter than the upper bound is left.
+    '''
+    def distance(self, source: int, target: int) -> Optional[int]:
+        bounds = self.bounds(source, target)
+        if bounds is None:
+            return None
+        lower, upper = bounds
+        if lower == upper:
+            return lower
+
+        started = time.perf_counter()
+        if upper is not None and 2 * lower >= upper:
+            distance, vertices, edges = self._guided_search(source, target, lower, upper)
+        else:
+            distance, vertices, edges = self._bidirectional_search(source, target, upper)
+        metrics.bfs("landmark_search", started, vertices, edges)
+        return distance
+
+    def _guided_search(self, source: int, target: int, lower: int, upper: int) -> Tuple[Optional[int], int, int]:
+        # The landmark lower bound never overestimates, so the target is first reached along a shortest hole
+        reaching = [(distances, distances[target]) for distances in self.distances if distances[target] >= 0]
+        hops = {source: 0}
+        # (estimated length, -hops, vertex) - among equal estimates the vertex closest to the target comes first
+        queue = [(lower, 0, source)]
+        vertices = edges = 0
+        while queue:
+            estimate, negative_hops, vertex = heapq.heappop(queue)
+            if vertex == target:
+                return -negative_hops, vertices, edges
+            if estimate >= upper:
+                return upper, vertices, edges
+            if -negative_hops > hops[vertex]:
+                continue
+
+            neighbors = self.graph[vertex]
+            vertices += 1
+            edges += len(neighbors)
+            next_hops = 1 - negative_hops
+            for neighbor in neighbors:
+                if next_hops >= hops.get(neighbor, next_hops + 1):
+                    continue
+                estimate = next_hops + max(abs(distances[neighbor] - to_target) for distances, to_target in reaching)
+                if estimate <= upper:
+                    hops[neighbor] = next_hops
+                    heapq.heappush(queue, (estimate, -next_hops, neighbor))
+        return None, vertices, edges
+
+    def _bidirectional_search(self, source: int, target: int,
+                              upper: Optional[int]) -> Tuple[Optional[int], int, int]:
+        hops, frontiers, levels = ({source: 0}, {target: 0}), [[source], [target]], [0, 0]
+        vertices = edges = 0
+        while frontiers[0] and frontiers[1]:
+            # No meeting yet means no hole of levels[0] + levels[1] hops, so the next level can not beat upper
+            if upper is not None and levels[0] + levels[1] + 1 >= upper:
+                return upper, vertices, edges
+
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            own_hops, other_hops = hops[side], hops[1 - side]
+            levels[side] += 1
+            shortest, next_frontier = None, []
+            for vertex in frontiers[side]:
+                neighbors = self.graph[vertex]
+                vertices += 1
+                edges += len(neighbors)
+                for neighbor in neighbors:
+                    if neighbor in own_hops:
+                        continue
+                    if neighbor in other_hops:
+                        # Meetings of one level may be at different hops from the other end, so all are compared
+                        length = levels[side] + other_hops[neighbor]
+                        shortest = length if shortest is None else min(shortest, length)
+                        continue
+                    own_hops[neighbor] = levels[side]
+                    next_frontier.append(neighbor)
+            if shortest is not None:
+                return shortest, vertices, edges
+            frontiers[side] = next_frontier
+        return None, vertices, edges
+
+    def _add(self, landmark: int) -> array:
+        started = time.perf_counter()
+        distances = array('i', [-1]) * self.graph.vertex_count
+        distances[landmark] = 0
+        frontier, level, vertices, edges = [landmark], 0, 0, 0
+        while frontier:
+            level += 1
+            next_frontier = []
+            for vertex in frontier:
+                neighbors = self.graph[vertex]
+                edges += len(neighbors)
+                for neighbor in neighbors:
+                    if distances[neighbor] < 0:
+                        distances[neighbor] = level
+                        next_frontier.append(neighbor)
+            vertices += len(frontier)
+            frontier = next_frontier
+
+        metrics.bfs("landmark", started, vertices, edges)
+        self.landmarks.append(landmark)
+        self.distances.append(distances)
+        return distances
+
+    def _islands(self) -> List[Tuple[int, int]]:
+        """(size, last vertex of a BFS from its first vertex) of every island, numbering the islands in self.island"""
+        island, islands = self.island, []
+        for start in self.graph:
+            if island[start] >= 0:
+                continue
+            island[start] = len(islands)
+            # The queue grows while it is walked, so it ends up in BFS order
+            queue = [start]
+            for vertex in queue:
+                for neighbor in self.graph[vertex]:
+                    if island[neighbor] < 0:
+                        island[neighbor] = len(islands)
+                        queue.append(neighbor)
+            islands.append((len(queue), queue[-1]))
+        return islands
+
+    @staticmethod
+    def _nearer(nearest: int, distance: int) -> int:
+        return distance if 0 <= distance and (nearest < 0 or distance < nearest) else nearest
@@ -0,0 +1,386 @@
+"""
+Concurrent load generator for a running API, to find where it saturates.
+
+Requests are a seeded mix of reads and writes on the benchmark catalog, sent over a pool of keep-alive connections.
+Closed loop keeps --concurrency requests in flight; open loop (--rate) sends them at a target rate whatever the
+server does, and times each from when it was due, so a saturated server shows up as growing latency:
+
+    uvicorn main:app --port 8080
+    python load_generator.py --url http://localhost:8080 --load-catalog --concurrency 64 --duration 30
+    python load_generator.py --url http://localhost:8080 --rate 500 1000 2000 --write-ratio 0.2
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from benchmark import LOAD_BATCH_SIZE, Workload
+
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram: every doubling from MIN_MS up is split into SUB_BUCKETS buckets,
+    so percentiles are within about 4% of the recorded value whatever its scale, in constant memory.
+    """
+
+    MIN_MS = 0.01
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms: float):
+        self.counts[self.bucket(latency_ms)] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def bucket(self, latency_ms: float) -> int:
+        if latency_ms <= self.MIN_MS:
+            return 0
+        return int(math.log2(latency_ms / self.MIN_MS) * self.SUB_BUCKETS) + 1
+
+    def upper_bound(self, bucket: int) -> float:
+        return self.MIN_MS * 2 ** (bucket / self.SUB_BUCKETS)
+
+    '''
+    Nearest-rank percentile, reported as the upper bound of its bucket but never above the largest latency
+    '''
+    def percentile(self, fraction: float) -> float:
+        if not self.count:
+            return 0.0
+        rank, seen = max(1, math.ceil(fraction * self.count)), 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.upper_bound(bucket), self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p90_ms": self.percentile(0.90),
+            "p99_ms": self.percentile(0.99),
+            "p999_ms": self.percentile(0.999),
+            "max_ms": self.max_ms,
+        }
+
+    def render(self, width: int = 50) -> List[str]:
+        """One bar per doubling of latency"""
+        doublings = Counter()
+        for bucket, count in self.counts.items():
+            doublings[(bucket + self.SUB_BUCKETS - 1) // self.SUB_BUCKETS] += count
+        largest = max(doublings.values(), default=0)
+        return [f"{'<=':>4} {self.upper_bound(doubling * self.SUB_BUCKETS):10.2f}ms {count:9} "
+                f"{'#' * max(1, round(count / largest * width))}" for doubling, count in sorted(doublings.items())]
+
+
+class Request(NamedTuple):
+    operation: str
+    method: str
+    url: str
+    params: Optional[Dict] = None
+    json: Optional[Dict] = None
+
+
+class RequestMix:
+    """
+    Seeded stream of requests on the catalog. Writes update descriptions, create similarities between categories
+    that are not similar yet and delete similarities it created earlier, so the graph keeps its size.
+    """
+
+    READS = {
+        "GET /categories/{name}": 30,
+        "GET /categories/?parent_name": 15,
+        "GET /categories/{name}/subtree": 5,
+        "GET /similarities/{name}": 30,
+        "GET /rabbit_islands/{name}": 15,
+        "GET /rabbit_hole_and_islands/": 5,
+    }
+    WRITES = {
+        "PUT /categories/{name}": 40,
+        "POST /similarities/": 30,
+        "DELETE /similarities/": 30,
+    }
+
+    def __init__(self, workload: Workload, write_ratio: float, seed: int):
+        self.workload = workload
+        self.write_ratio = write_ratio
+        self.random = random.Random(f"{seed}:load")
+        self.new_pairs = deque(workload.new_pairs(self.random, 100_000))
+        # Similarities created by this run whose create has completed, so deleting them does not race it
+        self.created_pairs = deque()
+        # Pairs created or being created and not deleted yet, in sorted order, which are not created again
+        self.live_pairs = set()
+
+    def next(self) -> Request:
+        operations = self.WRITES if self.random.random() < self.write_ratio else self.READS
+        operation = self.random.choices(list(operations), weights=list(operations.values()))[0]
+        if operation == "DELETE /similarities/" and not self.created_pairs:
+            operation = "POST /similarities/"
+        pair = self.new_pair() if operation == "POST /similarities/" else None
+        if operation == "POST /similarities/" and pair is None:
+            # Only a small catalog runs out of pairs that are not live
+            operation = "GET /similarities/{name}"
+        name = self.workload.random_name(self.random)
+
+        if operation == "GET /categories/{name}":
+            return Request(operation, "GET", f"/categories/{name}")
+        if operation == "GET /categories/?parent_name":
+            return Request(operation, "GET", "/categories/", params={"parent_name": name})
+        if operation == "GET /categories/{name}/subtree":
+            return Request(operation, "GET", f"/categories/{name}/subtree", params={"max_depth": 2})
+        if operation == "GET /similarities/{name}":
+            return Request(operation, "GET", f"/similarities/{name}")
+        if operation == "GET /rabbit_islands/{name}":
+            return Request(operation, "GET", f"/rabbit_islands/{name}")
+        if operation == "GET /rabbit_hole_and_islands/":
+            return Request(operation, "GET", "/rabbit_hole_and_islands/")
+        if operation == "PUT /categories/{name}":
+            return Request(operation, "PUT", f"/categories/{name}",
+                           json={"name": name, "description": f"Load {self.random.random()}"})
+
+        if operation == "DELETE /similarities/":
+            pair = self.created_pairs.popleft()
+            self.live_pairs.discard(tuple(sorted(pair)))
+        return Request(operation, operation.split()[0], "/similarities/",
+                       json={"category_name_1": pair[0], "category_name_2": pair[1]})
+
+    '''
+    Pairs are recycled once they run out, skipping those that are still live - creating one again would succeed
+    and queue it for a second delete. None when every pair is live.
+    '''
+    def new_pair(self) -> Optional[Tuple[str, str]]:
+        for _ in range(len(self.new_pairs)):
+            pair = self.new_pairs[0]
+            self.new_pairs.rotate(-1)
+            key = tuple(sorted(pair))
+            if key not in self.live_pairs:
+                self.live_pairs.add(key)
+                return pair
+        return None
+
+    def completed(self, request: Request, status_code: int):
+        if request.operation == "POST /similarities/":
+            pair = request.json["category_name_1"], request.json["category_name_2"]
+            if status_code == 200:
+                self.created_pairs.append(pair)
+            else:
+                self.live_pairs.discard(tuple(sorted(pair)))
+
+
+class Statistics:
+    def __init__(self):
+        self.latency = {}
+        self.statuses = {}
+        self.errors = Counter()
+
+    def record(self, operation: str, latency_ms: float, status: str):
+        self.latency.setdefault(operation, LatencyHistogram()).record(latency_ms)
+        self.statuses.setdefault(operation, Counter())[status] += 1
+        if not status.startswith("2"):
+            self.errors[operation] += 1
+
+    def summary(self, elapsed: float) -> Dict:
+        overall = LatencyHistogram()
+        operations = []
+        for operation in sorted(self.latency):
+            histogram = self.latency[operation]
+            overall.merge(histogram)
+            operations.append({
+                "operation": operation,
+                **histogram.summary(),
+                "throughput_per_s": histogram.count / elapsed if elapsed else 0.0,
+                "error_rate": self.errors[operation] / histogram.count,
+                "statuses": dict(self.statuses[operation]),
+            })
+        return {
+            **overall.summary(),
+            "throughput_per_s": overall.count / elapsed if elapsed else 0.0,
+            "error_rate": sum(self.errors.values()) / overall.count if overall.count else 0.0,
+            "elapsed_s": elapsed,
+            "histogram": overall.render(),
+            "operations": operations,
+        }
+
+
+async def send(client: httpx.AsyncClient, mix: RequestMix, statistics: Optional[Statistics], due: float):
+    request = mix.next()
+    try:
+        response = await client.request(request.method, request.url, params=request.params, json=request.json)
+        # Streamed responses such as the subtree are only complete once their body has been read
+        await response.aread()
+        status = str(response.status_code)
+        mix.completed(request, response.status_code)
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    if statistics is not None:
+        statistics.record(request.operation, (time.perf_counter() - due) * 1000, status)
+
+
+'''
+Closed loop: every worker sends its next request as soon as the previous one is answered
+'''
+async def closed_loop(client: httpx.AsyncClient, mix: RequestMix, concurrency: int, warmup: float,
+                      duration: float) -> Dict:
+    statistics = Statistics()
+    start = time.perf_counter()
+    measured_from, end = start + warmup, start + warmup + duration
+
+    async def worker():
+        while (now := time.perf_counter()) < end:
+            await send(client, mix, statistics if now >= measured_from else None, now)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return statistics.summary(time.perf_counter() - measured_from)
+
+
+'''
+Open loop: requests are started on schedule, at most max_in_flight at a time. Latency counts from when a request
+was due rather than when it was sent, so time spent queued behind a slow server is not hidden (coordinated omission).
+'''
+async def open_loop(client: httpx.AsyncClient, mix: RequestMix, rate: float, poisson: bool, max_in_flight: int,
+                    warmup: float, duration: float, seed: int) -> Dict:
+    statistics = Statistics()
+    arrivals = random.Random(f"{seed}:arrivals:{rate}")
+    slots = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+    start = time.perf_counter()
+    measured_from, end = start + warmup, start + warmup + duration
+
+    async def scheduled(due: float):
+        async with slots:
+            await send(client, mix, statistics if due >= measured_from else None, due)
+
+    due = start
+    while due < end:
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(scheduled(due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        due += arrivals.expovariate(rate) if poisson else 1 / rate
+
+    await asyncio.gather(*tasks)
+    # Measured until the last response, so a server that falls behind shows a throughput below the target
+    result = statistics.summary(time.perf_counter() - measured_from)
+    result["target_rate_per_s"] = rate
+    return result
+
+
+async def load_catalog(client: httpx.AsyncClient, workload: Workload, report: Callable[[str], None]):
+    response = await client.post("/categories/batch", json=[
+        category.model_dump(exclude={"children"}) for category in workload.categories()])
+    if response.status_code != 200:
+        report(f"Categories not loaded ({response.status_code}) - the catalog is probably there already")
+        return
+
+    for batch_start in range(0, len(workload.pair_codes), LOAD_BATCH_SIZE):
+        lines = (similarity.model_dump_json() for similarity in workload.similarities(
+            batch_start, batch_start + LOAD_BATCH_SIZE))
+        response = await client.post("/similarities/batch", content="\n".join(lines).encode(),
+                                     headers={"Content-Type": "application/x-ndjson"})
+        response.raise_for_status()
+    report(f"Loaded {len(workload.names)} categories and {len(workload.pair_codes)} similarities")
+
+
+async def generate(url: str, concurrency: int = 32, rates: Optional[List[float]] = None, poisson: bool = False,
+                   write_ratio: float = 0.1, duration: float = 10.0, warmup: float = 1.0, category_count: int = 2000,
+                   pair_count: int = 20000, seed: int = 42, catalog: bool = False, timeout: float = 30.0,
+                   transport: Optional[httpx.AsyncBaseTransport] = None,
+                   report: Callable[[str], None] = print) -> Dict:
+    workload = Workload(category_count, pair_count, seed)
+    mix = RequestMix(workload, write_ratio, seed)
+    # One keep-alive connection per concurrent request; requests beyond that wait for a free one
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = {
+        "meta": {
+            "url": url,
+            "concurrency": concurrency,
+            "write_ratio": write_ratio,
+            "duration_s": duration,
+            "warmup_s": warmup,
+            "seed": seed,
+            "arrivals": "poisson" if poisson else "constant",
+        },
+        "runs": [],
+    }
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, transport=transport,
+                                 timeout=httpx.Timeout(timeout, pool=None)) as client:
+        if catalog:
+            await load_catalog(client, workload, report)
+
+        for rate in rates or [None]:
+            if rate is None:
+                run = await closed_loop(client, mix, concurrency, warmup, duration)
+                run["mode"] = f"closed loop, {concurrency} in flight"
+            else:
+                run = await open_loop(client, mix, rate, poisson, concurrency, warmup, duration, seed)
+                run["mode"] = f"open loop, {rate:g}/s target"
+            results["runs"].append(run)
+            for line in format_run(run):
+                report(line)
+
+    return results
+
+
+def format_run(run: Dict) -> List[str]:
+    lines = [f"\n{run['mode']}: {run['count']} requests, {run['throughput_per_s']:.1f}/s, "
+             f"errors {run['error_rate']:.2%}, p50 {run['p50_ms']:.2f}ms p99 {run['p99_ms']:.2f}ms "
+             f"max {run['max_ms']:.2f}ms"]
+    for operation in run["operations"]:
+        lines.append(f"  {operation['operation']:<32} {operation['count']:7} {operation['throughput_per_s']:9.1f}/s "
+                     f"p50 {operation['p50_ms']:8.2f}ms p90 {operation['p90_ms']:8.2f}ms "
+                     f"p99 {operation['p99_ms']:8.2f}ms errors {operation['error_rate']:6.2%}")
+    return lines + ["  " + line for line in run["histogram"]]
+
+
+def main(arguments: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="requests in flight (closed loop) or the most allowed in flight (open loop)")
+    parser.add_argument("--rate", type=float, nargs="+",
+                        help="open loop target rates in requests per second, one run each")
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals instead of evenly spaced ones")
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=1.0, help="unmeasured seconds before each run")
+    parser.add_argument("--categories", type=int, default=2000)
+    parser.add_argument("--pairs", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--load-catalog", action="store_true", help="load the seeded catalog into the server first")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args(arguments)
+
+    results = asyncio.run(generate(args.url, args.concurrency, args.rate, args.poisson, args.write_ratio,
+                                   args.duration, args.warmup, args.categories, args.pairs, args.seed,
+                                   args.load_catalog, args.timeout))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"\nResults written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
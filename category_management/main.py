@@ -1,49 +1,185 @@
-from typing import Optional
+import os
+from contextlib import asynccontextmanager
+from typing import Callable, Iterable, List, Optional, Type
 
-from fastapi import FastAPI
-from schemas import Similarity, Category
-from similarity_service import similarity_service
-from category_service import category_service
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from schemas import Similarity, Category, CategoryRecord, DeleteMode, ProfilerSettings
+from similarity_service import SimilarityService, similarity_service
+from category_service import CategoryService, category_service
 from category_tree_visualizer import category_tree_visualizer
+from rabbit_hole_script import RabbitHoleScript, rabbit_hole_script
+from persistence import Persistence
+from sqlite_repository import SqliteRepository
+from models import db
+from metrics import PROMETHEUS_MEDIA_TYPE, MetricsMiddleware, metrics
+from profiling import ProfiledRoute, profiler
+from versions import etag_matches
 
-app = FastAPI()
+# The in-memory database is the default repository - with a SQLite path the services run on that file instead
+SQLITE_PATH = os.environ.get("CATEGORY_TREE_SQLITE_PATH")
+if SQLITE_PATH:
+    repository = SqliteRepository(SQLITE_PATH)
+    category_service = CategoryService(repository)
+    similarity_service = SimilarityService(repository)
+    rabbit_hole_script = RabbitHoleScript(repository)
+
+# The rabbit hole analysis runs on the python engine unless another one is picked - see rabbit_hole_script.ENGINES.
+# An unknown engine, or one whose optional dependencies are not installed, fails at startup.
+RABBIT_HOLE_ENGINE = os.environ.get("CATEGORY_TREE_RABBIT_HOLE_ENGINE")
+if RABBIT_HOLE_ENGINE:
+    rabbit_hole_script.use_engine(RABBIT_HOLE_ENGINE)
+# Processes of the "parallel" engine, one per core by default
+RABBIT_HOLE_WORKERS = os.environ.get("CATEGORY_TREE_RABBIT_HOLE_WORKERS")
+if RABBIT_HOLE_WORKERS:
+    if int(RABBIT_HOLE_WORKERS) < 1:
+        raise ValueError(f"CATEGORY_TREE_RABBIT_HOLE_WORKERS must be at least 1, got {RABBIT_HOLE_WORKERS}")
+    rabbit_hole_script.workers = int(RABBIT_HOLE_WORKERS)
+
+# Persistence of the in-memory database is optional - without a data directory everything stays in memory only
+# It needs a single uvicorn worker: a second process opening the same data directory fails at startup
+DATA_DIR = os.environ.get("CATEGORY_TREE_DATA_DIR")
+persistence = Persistence(db, category_service, similarity_service, DATA_DIR) if DATA_DIR and not SQLITE_PATH else None
+
+# Requests can be profiled from startup; PUT /profiler changes the settings while the app runs
+PROFILE_MODE = os.environ.get("CATEGORY_TREE_PROFILE")
+if PROFILE_MODE:
+    profiler.configure(mode=PROFILE_MODE,
+                       sample_rate=float(os.environ.get("CATEGORY_TREE_PROFILE_SAMPLE_RATE", profiler.sample_rate)),
+                       threshold_ms=float(os.environ.get("CATEGORY_TREE_PROFILE_THRESHOLD_MS", profiler.threshold_ms)))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if persistence:
+        persistence.open()
+    yield
+    if persistence:
+        persistence.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+# Every route added from here on is behind the profiler
+app.router.route_class = ProfiledRoute
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JSON_MEDIA_TYPE = "application/json"
+
+
+'''
+Categories are sent as the JSON their records keep encoded, so responses skip FastAPI's validation and encoding
+'''
+def category_response(category: CategoryRecord) -> Response:
+    return Response(category.json, media_type=JSON_MEDIA_TYPE)
+
+
+def categories_response(categories: Iterable[CategoryRecord]) -> Response:
+    return Response(b"[" + b",".join([category.json for category in categories]) + b"]", media_type=JSON_MEDIA_TYPE)
+
+
+'''
+Polled resources carry an ETag of their version, and a client that already has it gets a 304 without a body.
+The ETag is passed in before the body is built, so it is never newer than the body.
+'''
+def conditional_response(if_none_match: Optional[str], etag: str, build: Callable[[], Response]) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    response = build()
+    response.headers.update(headers)
+    return response
+
+
+async def read_batch(request: Request, model: Type[BaseModel]) -> List[BaseModel]:
+    """
+    Parses a batch body - a JSON array, or NDJSON that is parsed line by line while it streams in.
+    Every invalid item is reported with its index; a single one rejects the whole batch.
+    """
+    items, errors = [], []
+
+    def parse(index, validate, raw_item):
+        try:
+            items.append(validate(raw_item))
+        except ValidationError as e:
+            errors.append({"index": index, "detail": e.errors(include_url=False, include_context=False, include_input=False)})
+
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        index, pending = 0, b""
+        async for chunk in request.stream():
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in filter(bytes.strip, lines):
+                parse(index, model.model_validate_json, line)
+                index += 1
+        if pending.strip():
+            parse(index, model.model_validate_json, pending)
+    else:
+        try:
+            raw_items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Expected a JSON array")
+        if not isinstance(raw_items, list):
+            raise HTTPException(status_code=422, detail="Expected a JSON array")
+        for index, raw_item in enumerate(raw_items):
+            parse(index, model.model_validate, raw_item)
+
+    if errors:
+        raise HTTPException(status_code=422, detail=errors)
+    return items
 
 
 @app.post("/categories/")
 def create_category(category: Category):
-    return category_service.create_category(category)
+    return category_response(category_service.create_category(category))
+
+
+@app.post("/categories/batch")
+async def create_categories(request: Request):
+    categories = await read_batch(request, Category)
+    return await run_in_threadpool(category_service.create_categories, categories)
 
 
 @app.put("/categories/{name}")
 def update_category(name: str, category: Category):
-    return category_service.update_category(name, category)
+    return category_response(category_service.update_category(name, category))
 
 
 @app.delete("/categories/{name}")
-def delete_category(name: str):
-    return category_service.delete_category(name)
+def delete_category(name: str, mode: DeleteMode = DeleteMode.REPARENT):
+    return category_service.delete_category(name, mode)
 
 
 @app.patch("/categories/{name}/move")
 def move_category(name: str, new_parent_name: Optional[str] = None):
-    return category_service.move_category(name, new_parent_name)
+    return category_response(category_service.move_category(name, new_parent_name))
 
 
 @app.get("/categories/{name}")
-def get_category(name: str):
-    return category_service.get_category(name)
+def get_category(name: str, if_none_match: Optional[str] = Header(None)):
+    return conditional_response(if_none_match, category_service.category_etag(name),
+                                lambda: category_response(category_service.get_category(name)))
+
+
+@app.get("/categories/{name}/subtree")
+def get_subtree(name: str, max_depth: Optional[int] = Query(None, ge=0)):
+    subtree = category_service.get_subtree(name, max_depth)
+    lines = (b'{"depth": %d, "category": %s}\n' % (depth, category.fields_json) for category, depth in subtree)
+    return StreamingResponse(lines, media_type=NDJSON_MEDIA_TYPE)
 
 
 @app.get("/categories/")
-def get_categories(parent_name: Optional[str] = None):
-    return category_service.get_categories(parent_name)
+def get_categories(parent_name: Optional[str] = None, depth: Optional[int] = Query(None, ge=0),
+                   if_none_match: Optional[str] = Header(None)):
+    return conditional_response(if_none_match, category_service.categories_etag(parent_name, depth),
+                                lambda: categories_response(category_service.get_categories(parent_name, depth)))
 
 
 @app.get("/print_category_tree/{name}")
 def visualize_category_tree(name: str):
-    category = category_service.get_category(name)
-    category_tree = category_tree_visualizer.build_category_tree(category)
-    category_tree_visualizer.print_category_tree(category_tree)
+    category_tree_visualizer.print_category_tree(category_service.get_subtree(name))
 
     return {"detail": "Category tree printed to console"}
 
@@ -53,20 +189,77 @@ def create_similarity(similarity: Similarity):
     return similarity_service.create_similarity(similarity)
 
 
+@app.post("/similarities/batch")
+async def create_similarities(request: Request):
+    similarities = await read_batch(request, Similarity)
+    return await run_in_threadpool(similarity_service.create_similarities, similarities)
+
+
 @app.delete("/similarities/")
 def delete_similarity(similarity: Similarity):
     return similarity_service.delete_similarity(similarity)
 
 
+'''
+Without hops, limit or stream only the directly similar categories are sent, with their ETag. Otherwise each
+category within hops similarities comes with its hop distance - as one JSON array, or as NDJSON lines sent
+while the search goes on.
+'''
 @app.get("/similarities/{name}")
-def get_similarities(name: str):
-    return similarity_service.get_similarities(name)
+def get_similarities(name: str, hops: Optional[int] = Query(None, ge=1), limit: Optional[int] = Query(None, ge=1),
+                     stream: bool = False, if_none_match: Optional[str] = Header(None)):
+    if hops is None and limit is None and not stream:
+        return conditional_response(if_none_match, similarity_service.similarities_etag(name),
+                                    lambda: categories_response(similarity_service.get_similarities(name)))
+
+    neighborhood = similarity_service.get_similarity_neighborhood(name, hops or 1, limit)
+    items = (b'{"hops": %d, "category": %s}' % (distance, category.fields_json) for category, distance in neighborhood)
+    if stream:
+        return StreamingResponse((item + b"\n" for item in items), media_type=NDJSON_MEDIA_TYPE)
+    return Response(b"[" + b",".join(items) + b"]", media_type=JSON_MEDIA_TYPE)
+
+
+@app.get("/rabbit_islands/")
+def get_rabbit_islands():
+    return similarity_service.get_rabbit_islands()
+
+
+@app.get("/rabbit_islands/{name}")
+def get_rabbit_island(name: str):
+    return categories_response(similarity_service.get_rabbit_island(name))
 
 
 # Rabbit Hole and Rabbit Island logic
 @app.get("/rabbit_hole_and_islands/")
 def rabbit_hole_and_islands():
-    return category_service.find_longest_rabbit_hole_and_islands()
+    return rabbit_hole_script.find_longest_rabbit_hole_and_islands()
+
+
+@app.get("/rabbit_holes/{from_name}/{to_name}")
+def get_rabbit_hole(from_name: str, to_name: str):
+    return rabbit_hole_script.find_rabbit_hole(from_name, to_name)
+
+
+@app.post("/rabbit_holes/distances")
+async def get_rabbit_hole_distances(request: Request, exact: bool = False):
+    similarities = await read_batch(request, Similarity)
+    pairs = [(similarity.category_name_1, similarity.category_name_2) for similarity in similarities]
+    return await run_in_threadpool(rabbit_hole_script.rabbit_hole_distances, pairs, exact)
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type=PROMETHEUS_MEDIA_TYPE)
+
+
+@app.get("/profiler")
+def get_profiler():
+    return profiler.settings()
+
+
+@app.put("/profiler")
+def configure_profiler(settings: ProfilerSettings):
+    return profiler.configure(**settings.dict(exclude_unset=True))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """Monotonic counter with one value per combination of label values"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        with self.lock:
+            return [(self.name, self.label_names, label_values, value)
+                    for label_values, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket upper bounds. Observations are counted in their own bucket only
+    and made cumulative when rendered, so an observation costs one bisect.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                                             2.5, 5, 10)):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket, the last one for +Inf], sum]
+        self.values: Dict[Tuple[str, ...], list] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, *label_values: str):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            counts_and_sum = self.values.get(label_values)
+            if counts_and_sum is None:
+                counts_and_sum = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts_and_sum[0][bucket] += 1
+            counts_and_sum[1] += value
+
+    def count(self, *label_values: str) -> int:
+        counts_and_sum = self.values.get(label_values)
+        return sum(counts_and_sum[0]) if counts_and_sum else 0
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        samples = []
+        with self.lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in sorted(values):
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.label_names + ("le",),
+                                label_values + (format_value(upper_bound),), cumulative))
+            samples.append((f"{self.name}_sum", self.label_names, label_values, total))
+            samples.append((f"{self.name}_count", self.label_names, label_values, cumulative))
+        return samples
+
+
+class Metrics:
+    """
+    Request latencies and hot path counters of the services, rendered in the Prometheus text format for GET /metrics.
+
+    Hot loops count into locals and add them once per call, so instrumentation costs a few lock acquisitions
+    per request rather than one per visited vertex.
+    """
+
+    def __init__(self):
+        self.requests = Counter(
+            "category_tree_http_requests_total", "HTTP requests by route and status code.",
+            ("method", "route", "status"))
+        self.request_duration = Histogram(
+            "category_tree_http_request_duration_seconds", "HTTP request latency by route, until the response is sent.",
+            ("method", "route"))
+        self.similarity_lookups = Counter(
+            "category_tree_similarity_lookups_total", "Similarity lookups by kind.", ("lookup",))
+        self.bfs_duration = Histogram(
+            "category_tree_bfs_duration_seconds", "Duration of breadth-first searches by traversal.", ("traversal",),
+            buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10))
+        self.bfs_vertices = Counter(
+            "category_tree_bfs_vertices_visited_total", "Vertices expanded by breadth-first searches.", ("traversal",))
+        self.bfs_edges = Counter(
+            "category_tree_bfs_edges_visited_total", "Similarities followed by breadth-first searches.", ("traversal",))
+        self.cache_requests = Counter(
+            "category_tree_cache_requests_total", "Lookups of derived results cached against a version.",
+            ("cache", "result"))
+
+    def cache(self, cache: str, hit: bool):
+        self.cache_requests.inc(cache, "hit" if hit else "miss")
+
+    def bfs(self, traversal: str, started: float, vertices: int, edges: int):
+        """Records a search that started at time.perf_counter() started"""
+        self.bfs_duration.observe(time.perf_counter() - started, traversal)
+        self.bfs_vertices.inc(traversal, amount=vertices)
+        self.bfs_edges.inc(traversal, amount=edges)
+
+    def render(self) -> str:
+        lines = []
+        for metric in vars(self).values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, label_names, label_values, value in metric.samples():
+                labels = ",".join(f'{label_name}="{escape(label_value)}"'
+                                  for label_name, label_value in zip(label_names, label_values))
+                lines.append(f"{name}{{{labels}}} {format_value(value)}" if labels else f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request. Requests are labelled with the path template of their route,
+    e.g. /categories/{name}, so the number of series does not grow with the number of categories.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            # The router stores the matched route in the scope; anything else is reported as one unmatched route
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            self.metrics.request_duration.observe(time.perf_counter() - started, scope["method"], route)
+            self.metrics.requests.inc(scope["method"], route, str(status))
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def escape(label_value: str) -> str:
+    return label_value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+metrics = Metrics()
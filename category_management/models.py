@@ -1,12 +1,576 @@
-from typing import Dict, List, Optional, Set, Tuple
-from schemas import Category
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from threading import RLock
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+from schemas import Category, CategoryRecord, DeleteMode
+from repository import Repository
+from metrics import metrics
+from versions import ResourceVersions
 
 
-class InMemoryDatabase:
+class RabbitIslands:
+    """
+    Disjoint-set forest over the categories that have similarities.
+
+    Creating a similarity merges two islands in O(α(n)). A union-find can not split an island when a
+    similarity is deleted, so deletes only mark the forest stale and it is rebuilt on the next query.
+    """
+
     def __init__(self):
-        self.categories: Dict[str, Category] = {}
-        self.category_tree: Dict[Optional[str], List[str]] = {None: []}
-        self.similarities: Set[Tuple[str, str]] = set()
+        self.parents: Dict[str, str] = {}
+        self.members: Dict[str, List[str]] = {}
+        self.stale = False
+
+    def find(self, name: str) -> str:
+        if name not in self.parents:
+            self.parents[name] = name
+            self.members[name] = [name]
+            return name
+
+        # Path halving keeps the trees flat without recursion
+        while self.parents[name] != name:
+            self.parents[name] = self.parents[self.parents[name]]
+            name = self.parents[name]
+        return name
+
+    def union(self, name_1: str, name_2: str):
+        root_1, root_2 = self.find(name_1), self.find(name_2)
+        if root_1 == root_2:
+            return
+
+        if len(self.members[root_1]) < len(self.members[root_2]):
+            root_1, root_2 = root_2, root_1
+        self.parents[root_2] = root_1
+        self.members[root_1].extend(self.members.pop(root_2))
+
+    def rebuild(self, pairs: Iterable[Tuple[str, str]]):
+        self.parents, self.members, self.stale = {}, {}, False
+        for name, neighbor in pairs:
+            self.union(name, neighbor)
+
+
+class SimilarityGraph(Mapping):
+    """
+    Read-only CSR snapshot of the similarity graph over interned category ids.
+
+    The similar ids of category id v are targets[offsets[v]:offsets[v + 1]], in ascending order.
+    As a mapping it holds the ids of the categories that have similarities, so the RabbitHoleScript
+    algorithms run on it as on any other adjacency list.
+    """
+
+    def __init__(self, names: List[str], ids: Dict[str, int], offsets: Sequence[int], targets: Sequence[int],
+                 version: int):
+        self.names = names
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = targets
+        self.version = version
+        self.vertex_count = len(offsets) - 1
+        self._targets_view = memoryview(targets)
+        self._size = sum(1 for vertex in range(self.vertex_count) if offsets[vertex] != offsets[vertex + 1])
+
+    def vertex(self, name: str) -> Optional[int]:
+        vertex = self.ids.get(name)
+        if vertex is None or vertex >= self.vertex_count:
+            return None
+        return vertex
+
+    def __getitem__(self, vertex: int) -> Sequence[int]:
+        if not 0 <= vertex < self.vertex_count or self.offsets[vertex] == self.offsets[vertex + 1]:
+            raise KeyError(vertex)
+        return self._targets_view[self.offsets[vertex]:self.offsets[vertex + 1]]
+
+    def __iter__(self) -> Iterator[int]:
+        offsets = self.offsets
+        return (vertex for vertex in range(self.vertex_count) if offsets[vertex] != offsets[vertex + 1])
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class CsrLayers(NamedTuple):
+    """
+    The CSR arrays of a SimilarityIndex and the overlay of writes on top of them, swapped as one unit.
+    The arrays are never changed in place, so they may be read-only views of a mapped snapshot.
+    """
+    offsets: Sequence[int]
+    targets: Sequence[int]
+    added: Dict[int, Set[int]]
+    removed: Dict[int, Set[int]]
+
+
+class SimilarityIndex:
+    """
+    Bidirectional similarity pairs, stored as a CSR graph over interned category ids.
+
+    It behaves like the set of (name, similar_name) tuples it replaces - every pair is visible in both
+    directions - but looking up the similarities of one category costs O(degree). Category names are
+    interned to dense ids and the similar ids of every category live in two flat arrays (offsets and
+    sorted targets). Writes go to a per-id overlay of added and removed ids, which is merged into new
+    arrays once it outgrows a quarter of the graph or when a snapshot is taken.
+
+    Writes must hold the lock. Reads don't take it: compaction publishes new layers with a single
+    assignment, so a read sees either the old arrays with their overlay or the new ones.
+    """
+
+    COMPACTION_MIN_OVERLAY = 1024
+
+    def __init__(self, lock: Optional[RLock] = None):
+        self.lock = lock or RLock()
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.degrees: List[int] = []
+        self.layers = CsrLayers(array('i', [0]), array('i'), {}, {})
+        self.overlay_size = 0
+        self.size = 0
+        self.islands = RabbitIslands()
+        # Bumped on every change to the similarity graph, so derived results can be cached against it
+        self.version = 0
+        self._snapshot: Optional[SimilarityGraph] = None
+
+    @property
+    def adjacency(self) -> 'NeighborNames':
+        return NeighborNames(self.snapshot())
+
+    def intern(self, name: str) -> int:
+        vertex = self.ids.get(name)
+        if vertex is None:
+            vertex = len(self.names)
+            self.names.append(name)
+            self.degrees.append(0)
+            # Published last, so readers never see an id without its name
+            self.ids[name] = vertex
+        return vertex
+
+    def add(self, pair: Tuple[str, str]):
+        if pair in self:
+            return
+
+        category_name_1, category_name_2 = pair
+        vertex_1, vertex_2 = self.intern(category_name_1), self.intern(category_name_2)
+        self._link(vertex_1, vertex_2)
+        if vertex_1 != vertex_2:
+            self._link(vertex_2, vertex_1)
+        if not self.islands.stale:
+            self.islands.union(category_name_1, category_name_2)
+        self._written()
+
+    def discard(self, pair: Tuple[str, str]):
+        if pair not in self:
+            return
+
+        vertex_1, vertex_2 = self.ids[pair[0]], self.ids[pair[1]]
+        self._unlink(vertex_1, vertex_2)
+        if vertex_1 != vertex_2:
+            self._unlink(vertex_2, vertex_1)
+        self.islands.stale = True
+        self._written()
+
+    def remove_category(self, name: str):
+        vertex = self.ids.get(name)
+        if vertex is None:
+            return
+        for neighbor in self.neighbor_ids(vertex):
+            self.discard((name, self.names[neighbor]))
+
+    def degree(self, name: str) -> int:
+        vertex = self.ids.get(name)
+        return 0 if vertex is None else self.degrees[vertex]
+
+    def neighbors(self, name: str) -> Set[str]:
+        vertex = self.ids.get(name)
+        if vertex is None:
+            return set()
+        return {self.names[neighbor] for neighbor in self.neighbor_ids(vertex)}
+
+    def neighbor_ids(self, vertex: int) -> List[int]:
+        offsets, targets, added, removed = self.layers
+        neighbors = [] if vertex + 1 >= len(offsets) else list(targets[offsets[vertex]:offsets[vertex + 1]])
+
+        removed_neighbors = removed.get(vertex)
+        if removed_neighbors:
+            neighbors = [neighbor for neighbor in neighbors if neighbor not in removed_neighbors]
+        # tuple() copies the set in one step, even while a writer changes it
+        neighbors.extend(tuple(added.get(vertex, ())))
+        return neighbors
+
+    def snapshot(self) -> SimilarityGraph:
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            metrics.cache("similarity_graph", True)
+            return snapshot
+
+        with self.lock:
+            hit = self._snapshot is not None and self._snapshot.version == self.version
+            metrics.cache("similarity_graph", hit)
+            if not hit:
+                if self.overlay_size:
+                    self.compact()
+                offsets, targets, _, _ = self.layers
+                self._snapshot = SimilarityGraph(self.names, self.ids, offsets, targets, self.version)
+            return self._snapshot
+
+    def load(self, names: List[str], offsets: Sequence[int], targets: Sequence[int]):
+        """Replaces the whole graph with CSR arrays over names, e.g. the mapped arrays of a persisted snapshot"""
+        with self.lock:
+            self.names = list(names)
+            self.ids = {name: vertex for vertex, name in enumerate(self.names)}
+            self.degrees = [offsets[vertex + 1] - offsets[vertex] for vertex in range(len(self.names))]
+            self.layers = CsrLayers(offsets, targets, {}, {})
+            self.overlay_size = 0
+            self.size = len(targets)
+            self.islands.stale = True
+            self.version += 1
+
+    def compact(self):
+        # New arrays are built instead of updating the old ones in place, so snapshots and readers stay valid
+        offsets, targets = array('i', [0]), array('i')
+        for vertex in range(len(self.names)):
+            if self.degrees[vertex]:
+                targets.extend(sorted(self.neighbor_ids(vertex)))
+            offsets.append(len(targets))
+
+        self.layers = CsrLayers(offsets, targets, {}, {})
+        self.overlay_size = 0
+
+    '''
+    Island reads hold the lock while they copy, as a union moves members from one island to another
+    '''
+    def rabbit_island(self, name: str) -> List[str]:
+        with self.lock:
+            if not self.degree(name):
+                return [name]
+            return list(self._fresh_islands().members[self.islands.find(name)])
+
+    def rabbit_islands(self) -> List[List[str]]:
+        with self.lock:
+            return [list(members) for members in self._fresh_islands().members.values()]
+
+    def same_island(self, name_1: str, name_2: str) -> bool:
+        with self.lock:
+            if name_1 == name_2:
+                return True
+            if not self.degree(name_1) or not self.degree(name_2):
+                return False
+            islands = self._fresh_islands()
+            return islands.find(name_1) == islands.find(name_2)
+
+    def _fresh_islands(self) -> RabbitIslands:
+        metrics.cache("rabbit_islands", not self.islands.stale)
+        if self.islands.stale:
+            self.islands.rebuild(self)
+        return self.islands
+
+    def _written(self):
+        self.version += 1
+        if self.overlay_size > max(self.COMPACTION_MIN_OVERLAY, len(self.layers.targets) // 4):
+            self.compact()
+
+    def _link(self, vertex: int, neighbor: int):
+        removed = self.layers.removed.get(vertex)
+        if removed and neighbor in removed:
+            removed.discard(neighbor)
+            self.overlay_size -= 1
+        else:
+            self.layers.added.setdefault(vertex, set()).add(neighbor)
+            self.overlay_size += 1
+        self.degrees[vertex] += 1
+        self.size += 1
+
+    def _unlink(self, vertex: int, neighbor: int):
+        added = self.layers.added.get(vertex)
+        if added and neighbor in added:
+            added.discard(neighbor)
+            self.overlay_size -= 1
+        else:
+            self.layers.removed.setdefault(vertex, set()).add(neighbor)
+            self.overlay_size += 1
+        self.degrees[vertex] -= 1
+        self.size -= 1
+
+    def _contains_ids(self, vertex: int, neighbor: int) -> bool:
+        offsets, targets, added, removed = self.layers
+        if neighbor in added.get(vertex, ()):
+            return True
+        if neighbor in removed.get(vertex, ()) or vertex + 1 >= len(offsets):
+            return False
+
+        end = offsets[vertex + 1]
+        position = bisect_left(targets, neighbor, offsets[vertex], end)
+        return position < end and targets[position] == neighbor
+
+    def __contains__(self, pair: Tuple[str, str]) -> bool:
+        vertex_1, vertex_2 = self.ids.get(pair[0]), self.ids.get(pair[1])
+        return vertex_1 is not None and vertex_2 is not None and self._contains_ids(vertex_1, vertex_2)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        for vertex, degree in enumerate(self.degrees):
+            if degree:
+                name = self.names[vertex]
+                for neighbor in self.neighbor_ids(vertex):
+                    yield name, self.names[neighbor]
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class NeighborNames(Mapping):
+    """
+    Read-only {name: similar names} view of a SimilarityGraph snapshot, holding the categories with similarities.
+    Writes after the snapshot was taken never show, so an analysis iterating it sees one consistent graph.
+    """
+
+    def __init__(self, graph: SimilarityGraph):
+        self.graph = graph
+
+    def __getitem__(self, name: str) -> Set[str]:
+        vertex = self.graph.vertex(name)
+        if vertex is None:
+            raise KeyError(name)
+        return {self.graph.names[neighbor] for neighbor in self.graph[vertex]}
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.graph.names[vertex] for vertex in self.graph)
+
+    def __len__(self) -> int:
+        return len(self.graph)
+
+
+class ChildSet(dict):
+    """Insertion-ordered set of child category names - appending and removing a child are O(1)"""
+
+    def append(self, name: str):
+        self[name] = None
+
+    def remove(self, name: str):
+        del self[name]
+
+
+class TreeTour(NamedTuple):
+    tour: List[str]
+    depths: List[int]
+    exits: List[int]
+    entries: Dict[str, int]
+    levels: List[List[int]]
+
+
+class CategoryTreeIndex:
+    """
+    Preorder (Euler tour) index of the category tree, rebuilt lazily after the tree changes.
+
+    The subtree of a category is the contiguous range tour[entry:exit], and the categories at every depth
+    are kept in preorder, so subtree and depth queries are range scans instead of recursive walks.
+    Roots have depth 0. A rebuild walks the live tree, so it holds the writers' lock; queries run on
+    an immutable TreeTour without it.
+    """
+
+    def __init__(self, category_tree: Dict[Optional[str], ChildSet], lock: Optional[RLock] = None):
+        self.category_tree = category_tree
+        self.lock = lock or RLock()
+        self.stale = True
+        self.tree_tour = TreeTour([], [], [], {}, [])
+
+    def invalidate(self):
+        self.stale = True
+
+    def preorder(self) -> List[str]:
+        return list(self._fresh_tour().tour)
+
+    def subtree(self, name: str, max_depth: Optional[int] = None) -> Iterator[Tuple[str, int]]:
+        """Yields (name, depth below name) for the subtree of name in preorder, down to max_depth"""
+        tour, depths, exits, entries, _ = self._fresh_tour()
+        position = entries[name]
+        end, base_depth = exits[position], depths[position]
+        while position < end:
+            depth = depths[position] - base_depth
+            if max_depth is not None and depth > max_depth:
+                # Everything below a category that is too deep is too deep as well
+                position = exits[position]
+                continue
+            yield tour[position], depth
+            position += 1
+
+    def at_depth(self, depth: int, name: Optional[str] = None) -> List[str]:
+        """Categories at depth below name, or at absolute depth when name is None"""
+        tour, depths, exits, entries, levels = self._fresh_tour()
+        if name is None:
+            start, end = 0, len(tour)
+        else:
+            start = entries[name]
+            end, depth = exits[start], depth + depths[start]
+
+        if depth >= len(levels):
+            return []
+        level = levels[depth]
+        return [tour[position] for position in level[bisect_left(level, start):bisect_left(level, end)]]
+
+    def _fresh_tour(self) -> TreeTour:
+        if not self.stale:
+            metrics.cache("tree_tour", True)
+            return self.tree_tour
+
+        with self.lock:
+            metrics.cache("tree_tour", not self.stale)
+            if self.stale:
+                self.tree_tour = self._build_tour()
+                self.stale = False
+            return self.tree_tour
+
+    def _build_tour(self) -> TreeTour:
+        tour, depths, exits, entries, levels = TreeTour([], [], [], {}, [])
+        # (name, depth) entries the tour visits; a None name closes the subtree opened at that position
+        stack = [(name, 0) for name in reversed(self.category_tree[None])]
+        while stack:
+            name, depth = stack.pop()
+            if name is None:
+                exits[depth] = len(tour)
+                continue
+
+            position = len(tour)
+            entries[name] = position
+            tour.append(name)
+            depths.append(depth)
+            exits.append(position + 1)
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(position)
+
+            stack.append((None, position))
+            stack.extend((child, depth + 1) for child in reversed(self.category_tree.get(name, ())))
+
+        return TreeTour(tour, depths, exits, entries, levels)
+
+
+class InMemoryDatabase(Repository):
+    def __init__(self):
+        # Held by every service write, so writes are serialized and a batch is applied without interleaving
+        # writes. Reads don't take it - they only see atomic updates or immutable snapshots.
+        self.write_lock = RLock()
+        self.categories: Dict[str, CategoryRecord] = {}
+        self.category_tree: Dict[Optional[str], ChildSet] = {None: ChildSet()}
+        self.similarities: SimilarityIndex = SimilarityIndex(self.write_lock)
+        self.tree_index = CategoryTreeIndex(self.category_tree, self.write_lock)
+        self.versions = ResourceVersions()
+
+    def get_category(self, name: str) -> Optional[CategoryRecord]:
+        return self.categories.get(name)
+
+    def has_category(self, name: str) -> bool:
+        return name in self.categories
+
+    def get_children(self, parent_name: Optional[str]) -> List[CategoryRecord]:
+        # tuple() copies the children in one step, even while a writer changes them
+        return self.lookup(tuple(self.category_tree.get(parent_name, ())))
+
+    def get_categories_at_depth(self, depth: int, parent_name: Optional[str]) -> List[CategoryRecord]:
+        return self.lookup(self.tree_index.at_depth(depth, parent_name))
+
+    def get_subtree(self, name: str, max_depth: Optional[int]) -> Iterator[Tuple[CategoryRecord, int]]:
+        return ((category, depth) for cid, depth in self.tree_index.subtree(name, max_depth)
+                if (category := self.categories.get(cid)) is not None)
+
+    '''
+    Walks the parent pointers up from name, so it costs O(depth)
+    '''
+    def is_in_subtree(self, name: Optional[str], root_name: str) -> bool:
+        while name is not None:
+            if name == root_name:
+                return True
+            name = self.categories[name].parent_name
+        return False
+
+    def add_categories(self, categories: List[Category]):
+        for category in categories:
+            existing = self.categories.get(category.name)
+            if existing is not None and existing.parent_name in self.category_tree:
+                # Adding a category that exists replaces it and moves it, as the SQLite upsert does
+                self.category_tree[existing.parent_name].pop(category.name, None)
+            if category.parent_name:
+                self.category_tree.setdefault(category.parent_name, ChildSet()).append(category.name)
+            else:
+                self.category_tree[None].append(category.name)
+            self.categories[category.name] = CategoryRecord.from_category(category)
+        self.tree_index.invalidate()
+
+    def update_category(self, name: str, fields: dict):
+        self.categories[name] = self.categories[name].replace(**fields)
+
+    def set_parent(self, name: str, parent_name: Optional[str]):
+        category = self.categories[name]
+        if category.parent_name in self.category_tree:
+            self.category_tree[category.parent_name].remove(name)
+
+        self.categories[name] = category.replace(parent_name=parent_name)
+        self.category_tree.setdefault(parent_name, ChildSet()).append(name)
+        self.tree_index.invalidate()
+
+    '''
+    Children are either moved up to the parent (reparent) or deleted with their whole subtree (cascade) -
+    the cost is proportional to the affected categories and their similarities.
+    '''
+    def delete_category(self, name: str, mode: DeleteMode) -> int:
+        parent_name = self.categories[name].parent_name
+        if parent_name in self.category_tree:
+            self.category_tree[parent_name].remove(name)
+
+        deleted_names = [name]
+        children = self.category_tree.pop(name, ChildSet())
+        if mode == DeleteMode.CASCADE:
+            pending = list(children)
+            while pending:
+                child = pending.pop()
+                deleted_names.append(child)
+                pending.extend(self.category_tree.pop(child, ()))
+        else:
+            siblings = self.category_tree.setdefault(parent_name, ChildSet())
+            for child in children:
+                self.categories[child] = self.categories[child].replace(parent_name=parent_name)
+                siblings.append(child)
+
+        for deleted_name in deleted_names:
+            del self.categories[deleted_name]
+            self.similarities.remove_category(deleted_name)
+        self.tree_index.invalidate()
+        return len(deleted_names)
+
+    def add_similarities(self, pairs: Iterable[Tuple[str, str]]):
+        for pair in pairs:
+            self.similarities.add(pair)
+
+    def discard_similarity(self, pair: Tuple[str, str]):
+        self.similarities.discard(pair)
+
+    def get_similar(self, name: str) -> List[CategoryRecord]:
+        return self.lookup(self.similarities.neighbors(name))
+
+    def similar_names(self, name: str) -> Set[str]:
+        return self.similarities.neighbors(name)
+
+    def get_rabbit_island(self, name: str) -> List[CategoryRecord]:
+        return self.lookup(self.similarities.rabbit_island(name))
+
+    def get_rabbit_islands(self) -> List[List[str]]:
+        return self.similarities.rabbit_islands()
+
+    def same_rabbit_island(self, name_1: str, name_2: str) -> bool:
+        return self.similarities.same_island(name_1, name_2)
+
+    @property
+    def similarity_version(self) -> int:
+        return self.similarities.version
+
+    def similarity_graph(self) -> SimilarityGraph:
+        return self.similarities.snapshot()
+
+    def similarity_adjacency(self) -> 'NeighborNames':
+        return self.similarities.adjacency
+
+    '''
+    Reads don't lock, so categories deleted since the names were read are skipped
+    '''
+    def lookup(self, names: Iterable[str]) -> List[CategoryRecord]:
+        return [category for category in map(self.categories.get, names) if category is not None]
 
 
 db = InMemoryDatabase()
@@ -0,0 +1,302 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+from array import array
+from threading import Condition, Event, Thread
+from typing import List, Optional, Tuple
+from schemas import Category, CategoryRecord, DeleteMode, Similarity
+from models import ChildSet
+
+
+SNAPSHOT_MAGIC = b'CTSNAP01'
+# magic, last WAL sequence in the snapshot, category count, similarity target count, string pool size
+SNAPSHOT_HEADER = struct.Struct('<8sQIIQ')
+# name, description and image as (offset, length) into the string pool, then the parent's row (-1 for roots)
+SNAPSHOT_CATEGORY = struct.Struct('<IIIIIIi')
+# The CSR offsets and targets are int32 arrays in the native byte order, so they can be used in place
+CSR_TYPECODE = 'i'
+NO_STRING = 0xFFFFFFFF
+
+
+class WriteAheadLog:
+    """
+    Append-only JSON lines log of service writes, with group commit.
+
+    append() only queues a record, so it is cheap to call under the writers' lock. A background thread
+    writes everything queued with one write and one fsync, so writers that commit while an fsync is
+    running share the next one. sync() blocks until every record appended so far is on disk.
+    Every record is [sequence, operation, *arguments].
+    """
+
+    def __init__(self, path: str, sequence: int = 0):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.sequence = sequence
+        self.durable_sequence = sequence
+        self.size = os.path.getsize(path)
+        self.pending: List[bytes] = []
+        self.closed = False
+        self.condition = Condition()
+        self.flusher = Thread(target=self._flush_loop, name='wal-flusher', daemon=True)
+        self.flusher.start()
+
+    def append(self, operation: str, *arguments) -> int:
+        with self.condition:
+            self.sequence += 1
+            record = json.dumps([self.sequence, operation, *arguments], separators=(',', ':'))
+            self.pending.append(record.encode() + b'\n')
+            self.condition.notify_all()
+            return self.sequence
+
+    def sync(self):
+        with self.condition:
+            sequence = self.sequence
+            while self.durable_sequence < sequence:
+                self.condition.wait()
+
+    '''
+    Empties the log once its records are in a snapshot. The caller holds the writers' lock, so nothing is appended meanwhile.
+    '''
+    def truncate(self):
+        self.sync()
+        with self.condition:
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size = 0
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+        self.file.close()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                records, self.pending = self.pending, []
+                sequence = self.sequence
+
+            data = b''.join(records)
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            with self.condition:
+                self.durable_sequence = sequence
+                self.size += len(data)
+                self.condition.notify_all()
+
+    @staticmethod
+    def read(path: str):
+        """Yields the records of the log at path; a torn last line from a crash is skipped"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    return
+                yield json.loads(line)
+
+
+'''
+Writes every category in tree preorder, so siblings keep their order, and the similarities as a CSR graph
+over the category rows. The file is written aside and renamed over the old snapshot, so a crash never leaves a torn one.
+'''
+def write_snapshot(path: str, in_memory_db, sequence: int):
+    names = in_memory_db.tree_index.preorder()
+    rows = {name: row for row, name in enumerate(names)}
+    for name in in_memory_db.categories:
+        if name not in rows:
+            rows[name] = len(names)
+            names.append(name)
+
+    pool = bytearray()
+    pool_offsets = {}
+
+    def pooled(value: Optional[str]) -> Tuple[int, int]:
+        if value is None:
+            return 0, NO_STRING
+        if value not in pool_offsets:
+            encoded = value.encode()
+            pool_offsets[value] = len(pool), len(encoded)
+            pool.extend(encoded)
+        return pool_offsets[value]
+
+    table = bytearray()
+    offsets, targets = array(CSR_TYPECODE, [0]), array(CSR_TYPECODE)
+    for name in names:
+        category = in_memory_db.categories[name]
+        table += SNAPSHOT_CATEGORY.pack(*pooled(name), *pooled(category.description), *pooled(category.image),
+                                        rows.get(category.parent_name, -1))
+        targets.extend(sorted(rows[neighbor] for neighbor in in_memory_db.similarities.neighbors(name)
+                              if neighbor in rows))
+        offsets.append(len(targets))
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, sequence, len(names), len(targets), len(pool)))
+        file.write(table)
+        file.write(offsets.tobytes())
+        file.write(targets.tobytes())
+        file.write(pool)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+'''
+Loads a snapshot into an empty database and returns the WAL sequence it covers, or 0 without a snapshot.
+The file is mapped read-only and the similarity arrays are used in place, so loading copies no adjacency
+and every worker process that loads the same snapshot shares its pages through the page cache.
+'''
+def read_snapshot(path: str, in_memory_db) -> int:
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb') as file:
+        # The mapping outlives the file, and a compaction renaming a new snapshot over it
+        data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    magic, sequence, category_count, target_count, pool_size = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a category snapshot")
+
+    # Every section is a multiple of 4 bytes long, so the int32 arrays are aligned
+    table_end = SNAPSHOT_HEADER.size + category_count * SNAPSHOT_CATEGORY.size
+    item_size = array(CSR_TYPECODE).itemsize
+    targets_start = table_end + (category_count + 1) * item_size
+    pool_start = targets_start + target_count * item_size
+    offsets = data[table_end:targets_start].cast(CSR_TYPECODE)
+    targets = data[targets_start:pool_start].cast(CSR_TYPECODE)
+    pool = data[pool_start:pool_start + pool_size]
+
+    def pooled(offset: int, length: int) -> Optional[str]:
+        return None if length == NO_STRING else str(pool[offset:offset + length], 'utf-8')
+
+    rows = list(SNAPSHOT_CATEGORY.iter_unpack(data[SNAPSHOT_HEADER.size:table_end]))
+    names = [pooled(name_offset, name_length) for name_offset, name_length, *_ in rows]
+    for name, (_, _, description_offset, description_length, image_offset, image_length, parent) in zip(names, rows):
+        parent_name = names[parent] if parent >= 0 else None
+        in_memory_db.categories[name] = CategoryRecord(name, pooled(description_offset, description_length),
+                                                       pooled(image_offset, image_length), parent_name)
+        in_memory_db.category_tree.setdefault(parent_name, ChildSet()).append(name)
+
+    in_memory_db.similarities.load(names, offsets, targets)
+    in_memory_db.tree_index.invalidate()
+    return sequence
+
+
+class Persistence:
+    """
+    Optional on-disk backend of an InMemoryDatabase: a binary snapshot plus a write-ahead log of the writes after it.
+
+    open() loads the snapshot, replays the log through the services and then journals every service write.
+    Replaying the log is much slower than loading a snapshot, so once it outgrows compact_size bytes it is
+    compacted into a new snapshot in the background. That keeps startup at a snapshot load plus a short replay.
+
+    Only one process may use a directory: open() takes an exclusive lock on it and fails when another process,
+    such as a second uvicorn worker, holds it. Each worker would otherwise serve its own copy of the data, and
+    a compaction in one would truncate log records that the others appended.
+    """
+
+    SNAPSHOT_FILE = 'snapshot.bin'
+    WAL_FILE = 'wal.log'
+
+    def __init__(self, in_memory_db, category_service, similarity_service, directory: str,
+                 compact_size: int = 1 << 20, compaction_interval: float = 5.0):
+        self.in_memory_db = in_memory_db
+        self.category_service = category_service
+        self.similarity_service = similarity_service
+        # journaled.Journaled services whose writes go to the log
+        self.journaled = (category_service, similarity_service)
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_FILE)
+        self.wal_path = os.path.join(directory, self.WAL_FILE)
+        self.directory = directory
+        self.compact_size = compact_size
+        self.compaction_interval = compaction_interval
+        self.wal: Optional[WriteAheadLog] = None
+        self.stopped = Event()
+        self.compactor: Optional[Thread] = None
+        # Descriptor of the directory while open, which holds its lock
+        self.directory_fd: Optional[int] = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            fcntl.flock(directory_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(directory_fd)
+            raise RuntimeError(f"{self.directory} is used by another process - persistence needs a single worker")
+        self.directory_fd = directory_fd
+
+        with self.in_memory_db.write_lock:
+            sequence = read_snapshot(self.snapshot_path, self.in_memory_db)
+            # Records up to the snapshot sequence survive when a crash hit between the snapshot and the truncate
+            for record_sequence, operation, *arguments in WriteAheadLog.read(self.wal_path):
+                if record_sequence > sequence:
+                    self.replay(operation, arguments)
+                    sequence = record_sequence
+
+            self.wal = WriteAheadLog(self.wal_path, sequence)
+            self._journal_to(self.wal)
+
+        self.compactor = Thread(target=self._compaction_loop, name='wal-compactor', daemon=True)
+        self.compactor.start()
+
+    def replay(self, operation: str, arguments: list):
+        if operation == 'create_category':
+            self.category_service.create_category(Category(**arguments[0]))
+        elif operation == 'update_category':
+            self.category_service.update_category(arguments[0], Category(**arguments[1]))
+        elif operation == 'move_category':
+            self.category_service.move_category(*arguments)
+        elif operation == 'delete_category':
+            self.category_service.delete_category(arguments[0], DeleteMode(arguments[1]))
+        elif operation == 'create_similarity':
+            self.similarity_service.create_similarity(Similarity(category_name_1=arguments[0],
+                                                                 category_name_2=arguments[1]))
+        elif operation == 'create_similarities':
+            self.similarity_service.create_similarities([Similarity(category_name_1=name_1, category_name_2=name_2)
+                                                         for name_1, name_2 in arguments[0]])
+        elif operation == 'delete_similarity':
+            self.similarity_service.delete_similarity(Similarity(category_name_1=arguments[0],
+                                                                 category_name_2=arguments[1]))
+        else:
+            raise ValueError(f"Unknown WAL operation {operation}")
+
+    def compact(self):
+        with self.in_memory_db.write_lock:
+            self.wal.sync()
+            write_snapshot(self.snapshot_path, self.in_memory_db, self.wal.sequence)
+            self.wal.truncate()
+
+    def close(self):
+        self.stopped.set()
+        if self.compactor is not None:
+            self.compactor.join()
+        if self.wal is not None:
+            self._journal_to(None)
+            self.wal.close()
+            self.wal = None
+        if self.directory_fd is not None:
+            # Closing the descriptor releases the lock
+            os.close(self.directory_fd)
+            self.directory_fd = None
+
+    def _journal_to(self, wal: Optional[WriteAheadLog]):
+        for service in self.journaled:
+            service.journal = wal
+
+    def _compaction_loop(self):
+        while not self.stopped.wait(self.compaction_interval):
+            if self.wal.size >= self.compact_size:
+                self.compact()
@@ -0,0 +1,195 @@
+import cProfile
+import inspect
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+from typing import Callable, Dict, Optional
+
+from fastapi.routing import APIRoute
+from schemas import ProfilerMode
+
+# The profile of the request the current code runs for, if that request is profiled
+current_profile: ContextVar[Optional['RequestProfile']] = ContextVar('current_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self, name: str, mode: ProfilerMode):
+        self.name = name
+        self.mode = mode
+        self.started = time.perf_counter()
+        # Folded stacks and how many samples hit them, filled by the sampler thread
+        self.stacks = Counter()
+        # cProfile profiles, one per thread that worked on the request
+        self.profiles = []
+
+
+class Profiler:
+    """
+    Profiles a sampled fraction of requests and writes a profile of every one slower than threshold_ms.
+
+    Sampling mode records the stack of each thread serving a profiled request every interval_ms, from one
+    background thread, and writes folded stacks that flamegraph.pl, speedscope and inferno read as they are.
+    cProfile mode traces every call of a profiled request and writes pstats files (snakeviz, flameprof).
+    With the mode off a request costs one attribute check, and settings can be changed while the app runs.
+    """
+
+    def __init__(self, directory: str = "profiles", mode: ProfilerMode = ProfilerMode.OFF, sample_rate: float = 1.0,
+                 threshold_ms: float = 100.0, interval_ms: float = 5.0):
+        self.directory = directory
+        self.mode = ProfilerMode(mode)
+        self.sample_rate = sample_rate
+        self.threshold_ms = threshold_ms
+        self.interval_ms = interval_ms
+        self.lock = threading.Lock()
+        # Thread ident -> profile of the request the thread works on, for the sampler
+        self.sampled_threads: Dict[int, RequestProfile] = {}
+        self.sampler: Optional[threading.Thread] = None
+        self.written = 0
+        self.file_numbers = count()
+        self.random = random.Random()
+
+    def configure(self, **settings) -> Dict:
+        """Changes any of mode, sample_rate, threshold_ms, interval_ms and directory; None keeps a setting"""
+        with self.lock:
+            for setting, value in settings.items():
+                if value is not None:
+                    setattr(self, setting, ProfilerMode(value) if setting == "mode" else value)
+            if self.mode == ProfilerMode.SAMPLING and self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample_loop, name='request-profiler', daemon=True)
+                self.sampler.start()
+        return self.settings()
+
+    def settings(self) -> Dict:
+        return {
+            "mode": self.mode,
+            "sample_rate": self.sample_rate,
+            "threshold_ms": self.threshold_ms,
+            "interval_ms": self.interval_ms,
+            "directory": self.directory,
+            "written": self.written,
+        }
+
+    def wrap(self, name: str, endpoint: Callable) -> Callable:
+        """Profiles calls of a route endpoint that runs in the threadpool; coroutines are returned as they are"""
+        if inspect.iscoroutinefunction(endpoint):
+            return endpoint
+
+        @wraps(endpoint)
+        def profiled(*args, **kwargs):
+            if self.mode == ProfilerMode.OFF or self.random.random() >= self.sample_rate:
+                return endpoint(*args, **kwargs)
+            return self.run(name, endpoint, args, kwargs)
+
+        return profiled
+
+    def run(self, name: str, function: Callable, args: tuple, kwargs: dict):
+        request = RequestProfile(name, self.mode)
+        token = current_profile.set(request)
+        try:
+            with self.thread(request):
+                return function(*args, **kwargs)
+        finally:
+            current_profile.reset(token)
+            self.finish(request)
+
+    '''
+    Work a request hands to another thread, like the rabbit hole analysis, is profiled with the request
+    when the function is wrapped with follow() before it is submitted
+    '''
+    def follow(self, function: Callable) -> Callable:
+        request = current_profile.get()
+        if request is None:
+            return function
+
+        @wraps(function)
+        def followed(*args, **kwargs):
+            with self.thread(request):
+                return function(*args, **kwargs)
+
+        return followed
+
+    @contextmanager
+    def thread(self, request: RequestProfile):
+        if request.mode == ProfilerMode.CPROFILE:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                request.profiles.append(profile)
+            return
+
+        ident = threading.get_ident()
+        with self.lock:
+            self.sampled_threads[ident] = request
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.sampled_threads.pop(ident, None)
+
+    def finish(self, request: RequestProfile):
+        latency_ms = (time.perf_counter() - request.started) * 1000
+        # A request shorter than the sampling interval may have no samples at all
+        if latency_ms < self.threshold_ms or request.mode == ProfilerMode.SAMPLING and not request.stacks:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        route = re.sub(r'[^A-Za-z0-9]+', '_', request.name).strip('_') or 'root'
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{next(self.file_numbers)}-{route}"
+                                            f"-{latency_ms:.0f}ms")
+        if request.mode == ProfilerMode.CPROFILE:
+            stats = pstats.Stats(*request.profiles)
+            stats.dump_stats(f"{path}.prof")
+        else:
+            with self.lock:
+                stacks = list(request.stacks.items())
+            with open(f"{path}.folded", "w") as output:
+                output.writelines(f"{stack} {samples}\n" for stack, samples in stacks)
+        self.written += 1
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval_ms / 1000)
+            with self.lock:
+                if self.mode != ProfilerMode.SAMPLING:
+                    self.sampler = None
+                    return
+                if not self.sampled_threads:
+                    continue
+
+                frames = sys._current_frames()
+                for ident, request in self.sampled_threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        request.stacks[fold(frame)] += 1
+
+
+def fold(frame) -> str:
+    """The stack of frame in the folded format - outermost function first, separated by semicolons"""
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(functions))
+
+
+class ProfiledRoute(APIRoute):
+    """Route class that puts the endpoints of a router behind the profiler"""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, profiler.wrap(path, endpoint), **kwargs)
+
+
+profiler = Profiler(os.environ.get("CATEGORY_TREE_PROFILE_DIR", "profiles"))
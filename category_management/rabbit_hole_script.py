@@ -1,85 +1,537 @@
-from models import db
-from collections import defaultdict, deque
+import atexit
+import os
+import time
+from array import array
+from fastapi import HTTPException
+from models import SimilarityGraph, db
+from landmarks import LandmarkIndex
+from metrics import metrics
+from profiling import profiler
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context, shared_memory
+from threading import Lock
+
+# Engines the analysis can run on - "sparse" is sparse_graph.SparseGraph and needs numpy and scipy,
+# "parallel" runs the python engine on the islands in worker processes
+ENGINES = ("python", "sparse", "parallel")
 
 
 class RabbitHoleScript:
-    def __init__(self, in_memory_db):
-        self.categories = in_memory_db.categories
-        self.category_tree = in_memory_db.category_tree
-        self.similarities = in_memory_db.similarities
+    def __init__(self, repository, engine="python", workers=None, landmark_count=16):
+        # A repository.Repository - the in-memory database or the SQLite one
+        self.repository = repository
+        # The engine of the analysis when a call does not pick one
+        self.engine = engine
+        # (similarity_version, future) of the analysis running or last run on a single background worker
+        self.analysis = None
+        # Result of the latest analysis that completed, served while a newer one runs
+        self.completed_analysis = None
+        self.analysis_lock = Lock()
+        self.analysis_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rabbit-hole-analysis')
+        # Processes of the parallel engine, started on its first use
+        self.workers = workers or os.cpu_count()
+        self.process_executor = None
+        # landmarks.LandmarkIndex of the distance queries, rebuilt in the background after a similarity write
+        self.landmark_count = landmark_count
+        self.landmarks = None
+        # (similarity_version, future) of the index being built or last built
+        self.landmarks_build = None
+        self.landmarks_lock = Lock()
+        self.landmarks_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rabbit-hole-landmarks')
 
+    '''
+    The repository's adjacency is a read-only view of one snapshot, so writes made while it is analysed never show
+    '''
     def create_adjacency_list_optimized(self):
-        adjacency_list = defaultdict(set)
-        for cat1, cat2 in self.similarities:
-            adjacency_list[cat1].add(cat2)
-            adjacency_list[cat2].add(cat1)
-        return adjacency_list
+        return self.repository.similarity_adjacency()
+
+    '''
+    Results are memoized against the similarity version, and polls are O(1): after a similarity write they get
+    the last completed result, whose version tells it is stale, while the new one is computed in the background.
+    Only polls before any analysis completed wait for it. A failed analysis is not kept, so the next poll retries.
+    '''
+    def find_longest_rabbit_hole_and_islands(self):
+        version = self.repository.similarity_version
+        with self.analysis_lock:
+            completed = self.completed_analysis
+            hit = completed is not None and completed["version"] == version
+            if not hit and (self.analysis is None or self.analysis[0] != version):
+                # A profiled request that starts the analysis gets its profile as well
+                keep_analysis = profiler.follow(self.keep_analysis)
+                self.analysis = version, self.analysis_executor.submit(keep_analysis, version)
+            future = self.analysis[1] if completed is None else None
+        metrics.cache("rabbit_hole_analysis", hit)
+
+        return completed if future is None else future.result()
+
+    def keep_analysis(self, version):
+        try:
+            result = self.analyse_rabbit_holes(version)
+        except BaseException:
+            with self.analysis_lock:
+                if self.analysis is not None and self.analysis[0] == version:
+                    self.analysis = None
+            raise
+
+        with self.analysis_lock:
+            if self.completed_analysis is None or self.completed_analysis["version"] < version:
+                self.completed_analysis = result
+        return result
+
+    def analyse_rabbit_holes(self, version):
+        graph = self.repository.similarity_graph()
+        length, longest_path = self.find_longest_rabbit_hole(graph)
+
+        return {
+            "version": version,
+            "longest_rabbit_hole": {"length": length, "categories": [graph.names[vertex] for vertex in longest_path]},
+            "rabbit_islands": self.repository.get_rabbit_islands(),
+        }
+
+    '''
+    Shortest rabbit hole from one category to another. The search reads the similar names of the repository,
+    which follow writes without building a similarity graph, so a query after a write costs no more than before it.
+    '''
+    def find_rabbit_hole(self, name_1, name_2):
+        if not self.repository.has_category(name_1) or not self.repository.has_category(name_2):
+            raise HTTPException(status_code=404, detail="One or both categories not found")
+
+        path = self.shortest_rabbit_hole(name_1, name_2)
+        if path is None:
+            raise HTTPException(status_code=404, detail="The categories are on different rabbit islands")
+        return {"length": len(path) - 1, "categories": path}
+
+    def shortest_rabbit_hole(self, name_1, name_2):
+        return self.bidirectional_bfs(name_1, name_2, SimilarNames(self.repository))
+
+    '''
+    Grows a BFS from both ends, a whole level of the smaller frontier at a time, so a hole of length d costs two
+    searches of depth about d / 2 instead of one of depth d. Returns None when the ends are not connected.
+    '''
+    def bidirectional_bfs(self, source, target, adjacency_list):
+        if source == target:
+            return [source]
+
+        started = time.perf_counter()
+        distances, parents = ({source: 0}, {target: 0}), ({source: None}, {target: None})
+        frontiers = [[source], [target]]
+        meeting = None
+        vertices = edges = 0
+        while meeting is None and frontiers[0] and frontiers[1]:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            own_distances, own_parents, other_distances = distances[side], parents[side], distances[1 - side]
+            next_frontier = []
+            for vertex in frontiers[side]:
+                next_distance = own_distances[vertex] + 1
+                neighbors = adjacency_list[vertex]
+                vertices += 1
+                edges += len(neighbors)
+                for neighbor in neighbors:
+                    if neighbor in own_distances:
+                        continue
+                    own_distances[neighbor] = next_distance
+                    own_parents[neighbor] = vertex
+                    next_frontier.append(neighbor)
+                    # Meetings found in one level may be at different distances from the other end, so the level
+                    # is finished and the closest one is kept
+                    if neighbor in other_distances and (
+                            meeting is None or other_distances[neighbor] < other_distances[meeting]):
+                        meeting = neighbor
+            frontiers[side] = next_frontier
+
+        metrics.bfs("bidirectional", started, vertices, edges)
+        if meeting is None:
+            return None
+
+        path = self.build_path(parents[0], meeting)
+        end = parents[1][meeting]
+        while end is not None:
+            path.append(end)
+            end = parents[1][end]
+        return path
+
+    '''
+    Bounds of the rabbit hole distance of every pair of category names, and the exact distance as well when asked.
+    All of them are null for a pair on different islands; upper is null when no landmark is on the island of a pair.
+    While the index is rebuilt after a similarity write the bounds come from the previous one and are marked
+    approximate, and exact distances are searched for on the similar names of the repository instead.
+    '''
+    def rabbit_hole_distances(self, pairs, exact=False):
+        names = {name for pair in pairs for name in pair}
+        existing = {name for name in names if self.repository.has_category(name)}
+        errors = [{"index": index, "detail": "One or both categories not found"}
+                  for index, pair in enumerate(pairs) if pair[0] not in existing or pair[1] not in existing]
+        if errors:
+            raise HTTPException(status_code=422, detail=errors)
+
+        index = self.landmark_index()
+        graph = index.graph
+        approximate = index.version != self.repository.similarity_version
+        distances = []
+        for name_1, name_2 in pairs:
+            vertex_1, vertex_2 = graph.vertex(name_1), graph.vertex(name_2)
+            if name_1 == name_2:
+                bounds = 0, 0
+            elif not self.has_similarities(vertex_1, graph) or not self.has_similarities(vertex_2, graph):
+                bounds = None
+            else:
+                bounds = index.bounds(vertex_1, vertex_2)
+
+            lower, upper = bounds or (None, None)
+            distance = {"category_name_1": name_1, "category_name_2": name_2, "lower": lower, "upper": upper,
+                        "approximate": approximate}
+            if exact and approximate:
+                path = self.shortest_rabbit_hole(name_1, name_2)
+                distance["distance"] = None if path is None else len(path) - 1
+            elif exact:
+                distance["distance"] = lower if lower == upper or bounds is None else index.distance(vertex_1, vertex_2)
+            distances.append(distance)
+        return distances
+
+    @staticmethod
+    def has_similarities(vertex, graph):
+        # A category keeps its interned id after its last similarity is deleted, with no similar ids in the graph
+        return vertex is not None and vertex in graph
+
+    '''
+    The index of the latest similarity version, or the last one built while that one is built in the background.
+    Only queries before any index was built wait for it. A failed build is not kept, so the next query retries.
+    '''
+    def landmark_index(self):
+        version = self.repository.similarity_version
+        with self.landmarks_lock:
+            index = self.landmarks
+            hit = index is not None and index.version == version
+            if not hit and (self.landmarks_build is None or self.landmarks_build[0] != version):
+                self.landmarks_build = version, self.landmarks_executor.submit(self.keep_landmarks, version)
+            future = self.landmarks_build[1] if index is None else None
+        metrics.cache("landmarks", hit)
+
+        return index if future is None else future.result()
+
+    def keep_landmarks(self, version):
+        try:
+            index = LandmarkIndex(self.repository.similarity_graph(), self.landmark_count)
+        except BaseException:
+            with self.landmarks_lock:
+                if self.landmarks_build is not None and self.landmarks_build[0] == version:
+                    self.landmarks_build = None
+            raise
+
+        with self.landmarks_lock:
+            if self.landmarks is None or self.landmarks.version < index.version:
+                self.landmarks = index
+        return index
 
     def bfs_deepest_paths(self, start, adjacency_list):
-        queue = deque([(start, [start])])
-        visited = set()
-        deepest_paths = []
-        max_length = 0
+        distances, parents = self.bfs_tree(start, adjacency_list)
+        max_length = distances[self.farthest(distances)]
+
+        # Only the winning paths are rebuilt from the parent pointers
+        deepest_paths = [self.build_path(parents, vertex) for vertex, distance in distances.items()
+                         if distance == max_length]
+        return max_length, deepest_paths
+
+    '''
+    Vertices are marked when enqueued and only parent pointers are stored, so every vertex is queued once
+    and paths are rebuilt on demand with build_path
+    '''
+    def bfs_tree(self, start, adjacency_list):
+        started = time.perf_counter()
+        distances = {start: 0}
+        parents = {start: None}
+        queue = deque([start])
+        edges = 0
 
         while queue:
-            vertex, path = queue.popleft()
-            if vertex not in visited:
-                visited.add(vertex)
-                if len(path) > max_length:
-                    max_length = len(path)
-                    deepest_paths = [path]
-                elif len(path) == max_length:
-                    deepest_paths.append(path)
-
-                for neighbor in adjacency_list[vertex]:
-                    if neighbor not in visited:
-                        new_path = path + [neighbor]
-                        queue.append((neighbor, new_path))
-
-        return max_length - 1, deepest_paths
-
-    def calculate_node_degrees(self, adjacency_list):
-        node_degrees = defaultdict(int)
-        for node in adjacency_list:
-            node_degrees[node] = len(adjacency_list[node])
-        return node_degrees
-
-    def find_longest_rabbit_hole_optimized(self, adjacency_list):
-        node_degrees = self.calculate_node_degrees(adjacency_list)
-
-        min_degree = min(node_degrees.values())
-        lowest_degree_nodes = [node for node, degree in node_degrees.items() if degree == min_degree]
+            vertex = queue.popleft()
+            next_distance = distances[vertex] + 1
+            neighbors = adjacency_list[vertex]
+            edges += len(neighbors)
+            for neighbor in neighbors:
+                if neighbor not in distances:
+                    distances[neighbor] = next_distance
+                    parents[neighbor] = vertex
+                    queue.append(neighbor)
+
+        metrics.bfs("tree", started, len(distances), edges)
+
+        # distances keeps BFS order, so its last key is one of the farthest vertices
+        return distances, parents
+
+    @staticmethod
+    def build_path(parents, end):
+        path = []
+        while end is not None:
+            path.append(end)
+            end = parents[end]
+        path.reverse()
+        return path
+
+    @staticmethod
+    def farthest(distances):
+        return next(reversed(distances))
+
+    def island_diameter(self, island, adjacency_list):
+        """
+        Exact longest rabbit hole of one island, as (length, start, bitsets, root_levels).
+
+        Uses iFUB: a 4-sweep gives a lower bound and a central root, then only the vertices on the
+        outermost BFS levels around the root are expanded until the lower bound reaches 2 * level.
+        The eccentricities of a whole level are found by one bit-parallel search.
+        Vertices and levels are positions/bitsets of IslandBitsets; start is a position.
+        """
+        bitsets = IslandBitsets(island, adjacency_list)
+
+        # Each double sweep runs between two far apart vertices, and the next starts half way between them
+        start = max(range(len(island)), key=bitsets.degrees.__getitem__)
+        length = longest_start = -1
+        for _ in range(2):
+            sweep_start = bitsets.lowest(bitsets.levels(start)[-1])
+            start_levels = bitsets.levels(sweep_start)
+            sweep_end = bitsets.lowest(start_levels[-1])
+            end_levels = bitsets.levels(sweep_end)
+            if len(start_levels) - 1 > length:
+                length, longest_start = len(start_levels) - 1, sweep_start
+            half = (len(start_levels) - 1) // 2
+            middle = start_levels[half] & end_levels[len(start_levels) - 1 - half]
+            start = bitsets.lowest(middle) if middle else sweep_start
+        root_levels = bitsets.levels(start)
+
+        # Any two vertices within `level` of the root are at most 2 * level apart
+        level = len(root_levels) - 1
+        while length < 2 * level:
+            vertices = list(bitsets.positions(root_levels[level]))
+            for vertex, eccentricity in zip(vertices, bitsets.eccentricities(vertices)):
+                if eccentricity > length:
+                    length, longest_start = eccentricity, vertex
+            level -= 1
+
+        return length, longest_start, bitsets, root_levels
+
+    def checked_engine(self, engine):
+        engine = engine or self.engine
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {', '.join(ENGINES)}")
+        return engine
+
+    '''
+    Sets the engine of the analysis, failing at once for an unknown engine or one whose imports are missing
+    rather than on the first analysis
+    '''
+    def use_engine(self, engine):
+        if self.checked_engine(engine) == "sparse":
+            self.sparse_graph_class()
+        self.engine = engine
+
+    '''
+    Returns None for the other engines, which run on the adjacency list itself
+    '''
+    def sparse_graph(self, adjacency_list, engine):
+        if self.checked_engine(engine) != "sparse":
+            return None
+        return self.sparse_graph_class()(adjacency_list)
+
+    @staticmethod
+    def sparse_graph_class():
+        try:
+            from sparse_graph import SparseGraph
+        except ImportError as e:
+            raise ImportError("The sparse engine needs numpy and scipy: pip install numpy scipy") from e
+        return SparseGraph
+
+    def find_longest_rabbit_hole(self, adjacency_list, engine=None):
+        sparse_graph = self.sparse_graph(adjacency_list, engine)
+        if sparse_graph is not None:
+            return sparse_graph.longest_path()
+        if self.checked_engine(engine) == "parallel":
+            length, longest_paths = self.parallel_longest_paths(adjacency_list, every_path=False)
+            return max(length, 0), longest_paths[0] if longest_paths else []
+
+        max_length, longest_path = -1, []
+
+        for island in self.find_rabbit_islands_optimized(adjacency_list, "python"):
+            # An island of n categories can not hold a rabbit hole longer than n - 1
+            if len(island) - 1 <= max_length:
+                continue
+
+            length, paths = self.island_longest_paths(island, adjacency_list, False, max_length + 1)
+            if paths:
+                max_length, longest_path = length, paths[0]
+
+        return max(max_length, 0), longest_path
+
+    '''
+    Returns every longest rabbit hole as an ordered path - one per pair of end categories
+    '''
+    def find_longest_rabbit_hole_optimized(self, adjacency_list, engine=None):
+        sparse_graph = self.sparse_graph(adjacency_list, engine)
+        if sparse_graph is not None:
+            return sparse_graph.longest_paths()
+        if self.checked_engine(engine) == "parallel":
+            return self.parallel_longest_paths(adjacency_list, every_path=True)[1]
 
         max_length = 0
-        longest_paths = []
+        longest_paths = {}
+
+        for island in self.find_rabbit_islands_optimized(adjacency_list, "python"):
+            if len(island) - 1 < max_length:
+                continue
 
-        for category in lowest_degree_nodes:
-            length, paths = self.bfs_deepest_paths(category, adjacency_list)
+            length, paths = self.island_longest_paths(island, adjacency_list, True, max_length)
+            if length < max_length:
+                continue
             if length > max_length:
-                max_length = length
-                longest_paths = paths
-            elif length == max_length:
-                longest_paths.extend(paths)
+                max_length, longest_paths = length, {}
+            for path in paths:
+                longest_paths.setdefault(frozenset((path[0], path[-1])), path)
 
-        normalized_paths = {tuple(sorted(path)) for path in longest_paths}
-        return [list(path) for path in normalized_paths]
+        return list(longest_paths.values())
 
-    def bfs_connected_component(self, start, adjacency_list, visited):
-        queue = deque([start])
-        connected_component = []
+    def island_longest_paths(self, island, adjacency_list, every_path=True, min_length=0):
+        """
+        (length, paths) of the longest rabbit holes of one island - all of them, one per pair of end categories,
+        or just one. Paths are only built when the length is at least min_length.
+        """
+        length, start, bitsets, root_levels = self.island_diameter(island, adjacency_list)
+        if length < min_length:
+            return length, []
+        if not every_path:
+            distances, parents = self.bfs_tree(island[start], adjacency_list)
+            return length, [self.build_path(parents, self.farthest(distances))]
 
-        while queue:
-            node = queue.popleft()
-            if node not in visited:
-                visited.add(node)
-                connected_component.append(node)
-                for neighbor in adjacency_list[node]:
-                    if neighbor not in visited:
-                        queue.append(neighbor)
+        # ecc(v) <= d(root, v) + ecc(root), so only vertices this far from the root can end a longest hole
+        candidates = 0
+        for level in root_levels[max(length - len(root_levels) + 1, 0):]:
+            candidates |= level
+
+        longest_paths = {}
+        candidates = list(bitsets.positions(candidates))
+        for vertex, eccentricity in zip(candidates, bitsets.eccentricities(candidates)):
+            if eccentricity < length:
+                continue
+
+            start = island[vertex]
+            distances, parents = self.bfs_tree(start, adjacency_list)
+            for end in reversed(distances):
+                if distances[end] < length:
+                    break
+                longest_paths.setdefault(frozenset((start, end)), self.build_path(parents, end))
+
+        return length, list(longest_paths.values())
+
+    '''
+    The parallel engine: islands are analysed in worker processes, largest first, and the results are merged
+    in island order, so they are the same as those of the python engine on the same graph whatever the
+    scheduling. The CSR arrays and the vertices of every island are copied into one shared memory block per
+    call, and tasks only name slices of it. Searches in the workers do not show in the metrics of this process.
+    '''
+    def parallel_longest_paths(self, adjacency_list, every_path):
+        graph = self.csr_graph(adjacency_list)
+        islands = self.find_rabbit_islands_optimized(graph, "python")
+        by_size = sorted(range(len(islands)), key=lambda index: -len(islands[index]))
+
+        offsets, targets = memoryview(graph.offsets).cast("B").cast("i"), memoryview(graph.targets).cast("B").cast("i")
+        island_words = sum(len(island) for island in islands)
+        memory = shared_memory.SharedMemory(create=True, size=4 * max(len(offsets) + len(targets) + island_words, 1))
+        try:
+            with memory.buf.cast("i") as words:
+                words[:len(offsets)] = offsets
+                words[len(offsets):len(offsets) + len(targets)] = targets
+                position, slices = len(offsets) + len(targets), {}
+                for index in by_size:
+                    words[position:position + len(islands[index])] = array("i", islands[index])
+                    slices[index] = position, position + len(islands[index])
+                    position += len(islands[index])
+
+            # The length of every island first, then the paths of only the islands that hold the longest holes
+            shared = memory.name, len(offsets), len(targets)
+            lengths = self.run_island_chunks(shared, by_size, slices, islands, every_path, None)
+            max_length = max(lengths.values(), default=-1)
+            longest = [index for index in by_size if lengths.get(index) == max_length]
+            if not every_path and longest:
+                # Like the python engine, a single path comes from the first island, in island order, that has one
+                longest = [min(longest)]
+            paths = self.run_island_chunks(shared, longest, slices, islands, every_path, max_length)
+        finally:
+            memory.close()
+            memory.unlink()
+
+        longest_paths = [path for index in range(len(islands)) for path in paths.get(index, ())]
+        names = None if isinstance(adjacency_list, SimilarityGraph) else graph.names
+        return max_length, [[names[vertex] for vertex in path] for path in longest_paths] if names else longest_paths
 
-        return connected_component
+    '''
+    Runs _analyse_islands on the islands at indices in chunks, returning {index: result}. While lengths are
+    searched, chunks that can no longer reach the longest hole found so far are cancelled before they start.
+    '''
+    def run_island_chunks(self, shared, indices, slices, islands, every_path, min_length):
+        # Chunks of islands of similar size, a few per worker so the largest islands do not leave workers idle
+        target = max(sum(len(islands[index]) for index in indices) // (4 * self.workers), 1)
+        chunks, chunk, chunk_size = [], [], 0
+        for index in indices:
+            chunk.append(index)
+            chunk_size += len(islands[index])
+            if chunk_size >= target:
+                chunks.append(chunk)
+                chunk, chunk_size = [], 0
+        if chunk:
+            chunks.append(chunk)
 
-    def find_rabbit_islands_optimized(self, adjacency_list):
+        executor = self.process_pool()
+        pending = {executor.submit(_analyse_islands, shared, [slices[index] for index in chunk], every_path,
+                                   min_length): chunk for chunk in chunks}
+        results, max_length = {}, -1
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                if not future.cancelled():
+                    results.update(zip(chunk, future.result()))
+            if min_length is not None:
+                continue
+
+            # The first island of a chunk is its largest, and an island of n categories has no hole longer than n - 1
+            max_length = max(results.values(), default=-1)
+            for future, chunk in pending.items():
+                if len(islands[chunk[0]]) - 1 < max_length:
+                    future.cancel()
+
+        return results
+
+    def process_pool(self):
+        with self.analysis_lock:
+            if self.process_executor is None:
+                # Workers are spawned, as forking a process with running threads may copy held locks
+                self.process_executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"))
+            return self.process_executor
+
+    @staticmethod
+    def csr_graph(adjacency_list):
+        """The adjacency list as a SimilarityGraph, whose names are the keys of the list"""
+        if isinstance(adjacency_list, SimilarityGraph):
+            return adjacency_list
+
+        names = list(adjacency_list)
+        ids = {name: vertex for vertex, name in enumerate(names)}
+        offsets, targets = array("i", [0]), array("i")
+        for name in names:
+            targets.extend(sorted(ids[neighbor] for neighbor in adjacency_list[name]))
+            offsets.append(len(targets))
+        return SimilarityGraph(names, ids, offsets, targets, 0)
+
+    def bfs_connected_component(self, start, adjacency_list, visited):
+        distances, _ = self.bfs_tree(start, adjacency_list)
+        visited.update(distances)
+        return list(distances)
+
+    def find_rabbit_islands_optimized(self, adjacency_list, engine=None):
+        sparse_graph = self.sparse_graph(adjacency_list, engine)
+        if sparse_graph is not None:
+            return sparse_graph.islands()
+
+        # Islands are found in one pass on every other engine - the parallel one analyses them afterwards
         visited = set()
         rabbit_islands = []
 
@@ -91,4 +543,150 @@ class RabbitHoleScript:
         return rabbit_islands
 
 
+class SimilarNames:
+    """
+    Adjacency of category names that looks every name up in the repository, so a search on it needs no snapshot.
+    A search that runs while similarities are written may see some of the writes only.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def __getitem__(self, name):
+        return self.repository.similar_names(name)
+
+
+class IslandBitsets:
+    """
+    One rabbit island with the similarities of every category packed into an int bitset.
+
+    Categories are addressed by their position in the island. A BFS level is a single int, so expanding
+    a level costs one bitwise OR per vertex instead of one dict lookup per similarity pair.
+    Eccentricities of many sources are searched at once the other way round: every category holds an int
+    with one bit per source, and a level ORs those bits along the similarities of the frontier.
+    """
+
+    # Bytes the per-category source bitsets of one batch may take, which bounds how many sources run at once
+    BATCH_BYTES = 32 << 20
+
+    def __init__(self, island, adjacency_list):
+        positions = {vertex: position for position, vertex in enumerate(island)}
+        self.masks = []
+        self.neighbors = [[positions[neighbor] for neighbor in adjacency_list[vertex]] for vertex in island]
+        self.degrees = [len(neighbors) for neighbors in self.neighbors]
+        for neighbors in self.neighbors:
+            mask = bytearray((len(island) + 7) // 8)
+            for position in neighbors:
+                mask[position >> 3] |= 1 << (position & 7)
+            self.masks.append(int.from_bytes(mask, 'little'))
+        self.island_mask = (1 << len(island)) - 1
+
+    def levels(self, start):
+        started = time.perf_counter()
+        levels = [1 << start]
+        seen = levels[0]
+        vertices = edges = 0
+        while seen != self.island_mask:
+            reached = 0
+            for vertex in self.positions(levels[-1]):
+                reached |= self.masks[vertex]
+                vertices += 1
+                edges += self.degrees[vertex]
+            # Only an island that is not connected, e.g. one read while its similarities change, stops short
+            if not reached & ~seen:
+                break
+            levels.append(reached & ~seen)
+            seen |= reached
+
+        metrics.bfs("bitset", started, vertices, edges)
+        return levels
+
+    def eccentricities(self, sources):
+        """Eccentricity of each of the distinct sources, found in batches of sources searched at once"""
+        batch = max(1, 8 * self.BATCH_BYTES // len(self.masks))
+        eccentricities = []
+        for begin in range(0, len(sources), batch):
+            eccentricities.extend(self._batch_eccentricities(sources[begin:begin + batch]))
+        return eccentricities
+
+    def _batch_eccentricities(self, sources):
+        # Source i is bit i of every bitset here; a vertex is in the frontier with the sources that just reached it
+        started = time.perf_counter()
+        reached = [0] * len(self.masks)
+        for bit, source in enumerate(sources):
+            reached[source] = 1 << bit
+        frontier = {source: reached[source] for source in sources}
+        eccentricities = [0] * len(sources)
+        level = vertices = edges = 0
+        while frontier:
+            level += 1
+            arrived = {}
+            for vertex, bits in frontier.items():
+                neighbors = self.neighbors[vertex]
+                vertices += 1
+                edges += len(neighbors)
+                for neighbor in neighbors:
+                    arrived[neighbor] = arrived.get(neighbor, 0) | bits
+            frontier, found = {}, 0
+            for vertex, bits in arrived.items():
+                bits &= ~reached[vertex]
+                if bits:
+                    reached[vertex] |= bits
+                    frontier[vertex] = bits
+                    found |= bits
+            # Every source that reached a new vertex on this level is at least this eccentric
+            for bit in self.positions(found):
+                eccentricities[bit] = level
+
+        metrics.bfs("bitset", started, vertices, edges)
+        return eccentricities
+
+    @staticmethod
+    def lowest(mask):
+        return (mask & -mask).bit_length() - 1
+
+    @staticmethod
+    def positions(mask):
+        while mask:
+            lowest_bit = mask & -mask
+            yield lowest_bit.bit_length() - 1
+            mask ^= lowest_bit
+
+
+# (name, shared memory, graph, words of the block) of the graph a worker process of the parallel engine attached last
+_attached = None
+
+
+def _attach(name, offset_count, target_count):
+    global _attached
+    if _attached is None or _attached[0] != name:
+        _detach()
+        memory = shared_memory.SharedMemory(name)
+        words = memory.buf.cast("i")
+        graph = SimilarityGraph([], {}, words[:offset_count], words[offset_count:offset_count + target_count], 0)
+        _attached = name, memory, graph, words
+    return _attached[2], _attached[3]
+
+
+@atexit.register
+def _detach():
+    global _attached
+    if _attached is not None:
+        # Dropping the graph and the words releases the views of the block, which can only be closed then
+        memory, _attached = _attached[1], None
+        memory.close()
+
+
+def _analyse_islands(shared, slices, every_path, min_length):
+    """
+    A task of the parallel engine, on islands given as slices of the shared block: the length of the longest
+    hole of every island without a min_length, and the paths of every island with one.
+    """
+    graph, words = _attach(*shared)
+    islands = [words[begin:end].tolist() for begin, end in slices]
+    if min_length is None:
+        return [rabbit_hole_script.island_diameter(island, graph)[0] for island in islands]
+    return [rabbit_hole_script.island_longest_paths(island, graph, every_path, min_length)[1] for island in islands]
+
+
 rabbit_hole_script = RabbitHoleScript(db)
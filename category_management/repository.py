@@ -0,0 +1,101 @@
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from typing import Collection, Iterable, Iterator, List, Optional, Tuple
+from schemas import Category, CategoryRecord, DeleteMode
+
+
+class Repository(ABC):
+    """
+    Storage behind CategoryService, SimilarityService and RabbitHoleScript.
+
+    The services validate requests and raise the HTTP errors; a repository only stores and queries.
+    Writes are called with write_lock held, so they are serialized and may assume that the validation
+    done just before them still holds. Reads are called without the lock.
+    Implementations: models.InMemoryDatabase and sqlite_repository.SqliteRepository.
+    """
+
+    write_lock = None
+    # versions.ResourceVersions shared by the services on this repository, which bump them on every write
+    versions = None
+
+    @abstractmethod
+    def get_category(self, name: str) -> Optional[CategoryRecord]:
+        pass
+
+    @abstractmethod
+    def has_category(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def get_children(self, parent_name: Optional[str]) -> List[CategoryRecord]:
+        """Children of parent_name in insertion order, or the roots when it is None"""
+
+    @abstractmethod
+    def get_categories_at_depth(self, depth: int, parent_name: Optional[str]) -> List[CategoryRecord]:
+        """Categories depth levels below parent_name in preorder, or at absolute depth (roots are 0) when it is None"""
+
+    @abstractmethod
+    def get_subtree(self, name: str, max_depth: Optional[int]) -> Iterator[Tuple[CategoryRecord, int]]:
+        """(category, depth below name) for the subtree of name in preorder, down to max_depth"""
+
+    @abstractmethod
+    def is_in_subtree(self, name: Optional[str], root_name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def add_categories(self, categories: List[Category]):
+        """Adds the categories in order, so a parent may come earlier in the same list"""
+
+    @abstractmethod
+    def update_category(self, name: str, fields: dict):
+        """Sets fields other than parent_name - a parent change goes through set_parent"""
+
+    @abstractmethod
+    def set_parent(self, name: str, parent_name: Optional[str]):
+        """Moves the category to the end of the children of parent_name"""
+
+    @abstractmethod
+    def delete_category(self, name: str, mode: DeleteMode) -> int:
+        """Deletes the category and the similarities of every deleted category, returning how many were deleted"""
+
+    @abstractmethod
+    def add_similarities(self, pairs: Iterable[Tuple[str, str]]):
+        pass
+
+    @abstractmethod
+    def discard_similarity(self, pair: Tuple[str, str]):
+        pass
+
+    @abstractmethod
+    def get_similar(self, name: str) -> List[CategoryRecord]:
+        pass
+
+    @abstractmethod
+    def similar_names(self, name: str) -> Collection[str]:
+        """Names of the categories similar to one, read without building a similarity graph"""
+        pass
+
+    @abstractmethod
+    def get_rabbit_island(self, name: str) -> List[CategoryRecord]:
+        pass
+
+    @abstractmethod
+    def get_rabbit_islands(self) -> List[List[str]]:
+        pass
+
+    @abstractmethod
+    def same_rabbit_island(self, name_1: str, name_2: str) -> bool:
+        """Whether the categories are on one rabbit island - a category without similarities is on its own"""
+
+    @property
+    @abstractmethod
+    def similarity_version(self) -> int:
+        """Changes with every change to the similarities, so derived results can be cached against it"""
+
+    @abstractmethod
+    def similarity_graph(self):
+        """models.SimilarityGraph of the similarities at similarity_version"""
+
+    @abstractmethod
+    def similarity_adjacency(self) -> Mapping:
+        """{name: similar names} of the categories with similarities, frozen at one similarity_version"""
@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+import json
+from enum import Enum
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import Optional, List
 
 
@@ -9,10 +11,95 @@ class Category(BaseModel):
     parent_name: Optional[str] = None
     children: List['Category'] = []
 
+    # An empty parent name is no parent, as the category tree keeps roots under None
+    @field_validator("parent_name")
+    @classmethod
+    def no_empty_parent_name(cls, parent_name: Optional[str]) -> Optional[str]:
+        return parent_name or None
+
 
 Category.update_forward_refs()
 
 
+class CategoryRecord:
+    """
+    A stored category - the repositories keep these instead of Category models, which validate on every change.
+
+    Records are never changed: a write stores a new record, so a lock-free reader never sees a half updated
+    one and the JSON of a record is encoded once and reused by every response that contains it.
+    """
+
+    __slots__ = ("name", "description", "image", "parent_name", "_json")
+
+    FIELDS = ("name", "description", "image", "parent_name")
+    # Stored categories have no children, but responses keep the field of the Category model
+    CHILDREN_JSON = b',"children":[]}'
+
+    def __init__(self, name: str, description: Optional[str] = None, image: Optional[str] = None,
+                 parent_name: Optional[str] = None):
+        self.name = name
+        self.description = description
+        self.image = image
+        self.parent_name = parent_name
+        self._json = None
+
+    @classmethod
+    def from_category(cls, category: Category) -> "CategoryRecord":
+        return cls(category.name, category.description, category.image, category.parent_name)
+
+    def replace(self, **fields) -> "CategoryRecord":
+        """A copy with the given fields changed; fields the record does not have, like children, are ignored"""
+        values = {field: fields.get(field, getattr(self, field)) for field in self.FIELDS}
+        return CategoryRecord(**values)
+
+    @property
+    def json(self) -> bytes:
+        """The category as the Category model serializes it, encoded on first use"""
+        if self._json is None:
+            fields = json.dumps({field: getattr(self, field) for field in self.FIELDS}, ensure_ascii=False,
+                                separators=(",", ":"))
+            self._json = fields.encode()[:-1] + self.CHILDREN_JSON
+        return self._json
+
+    @property
+    def fields_json(self) -> bytes:
+        """The JSON without the children field"""
+        return self.json[:-len(self.CHILDREN_JSON)] + b"}"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, CategoryRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.FIELDS)
+
+    def __repr__(self) -> str:
+        return f"CategoryRecord({', '.join(f'{field}={getattr(self, field)!r}' for field in self.FIELDS)})"
+
+
 class Similarity(BaseModel):
     category_name_1: str
     category_name_2: str
+
+
+class DeleteMode(str, Enum):
+    # Children of the deleted category are moved up to its parent
+    REPARENT = "reparent"
+    # The whole subtree is deleted
+    CASCADE = "cascade"
+
+
+class ProfilerMode(str, Enum):
+    OFF = "off"
+    # Stacks of the threads serving a profiled request are sampled, written as folded stacks
+    SAMPLING = "sampling"
+    # Every call of a profiled request is traced, written as pstats
+    CPROFILE = "cprofile"
+
+
+class ProfilerSettings(BaseModel):
+    """Settings that PUT /profiler may change - where profiles are written is only set by CATEGORY_TREE_PROFILE_DIR"""
+    model_config = ConfigDict(extra="forbid")
+
+    mode: Optional[ProfilerMode] = None
+    sample_rate: Optional[float] = Field(None, ge=0, le=1)
+    threshold_ms: Optional[float] = Field(None, ge=0)
+    interval_ms: Optional[float] = Field(None, gt=0)
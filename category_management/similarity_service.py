@@ -1,40 +1,135 @@
+import time
 from fastapi import HTTPException
-from schemas import Similarity
+from typing import Iterator, List, Optional, Tuple
+from schemas import CategoryRecord, Similarity
+from journaled import Journaled
 from models import db
+from metrics import metrics
+from versions import SIMILAR
 
 
-class SimilarityService:
+class SimilarityService(Journaled):
 
-    def __init__(self, in_memory_db):
-        self.in_memory_db = in_memory_db
-        self.categories = in_memory_db.categories
-        self.category_tree = in_memory_db.category_tree
-        self.similarities = in_memory_db.similarities
+    def __init__(self, repository):
+        # A repository.Repository - the in-memory database or the SQLite one
+        self.repository = repository
+        self.write_lock = repository.write_lock
+        self.versions = repository.versions
 
     def create_similarity(self, similarity: Similarity):
         category_name_1, category_name_2 = similarity.category_name_1, similarity.category_name_2
-        if category_name_1 not in self.categories or category_name_2 not in self.categories:
-            raise HTTPException(status_code=404, detail="One or both categories not found")
+        with self.write_lock:
+            if not self.repository.has_category(category_name_1) or not self.repository.has_category(category_name_2):
+                raise HTTPException(status_code=404, detail="One or both categories not found")
 
-        self.similarities.add((category_name_1, category_name_2))
-        self.similarities.add((category_name_2, category_name_1))
+            self.repository.add_similarities([(category_name_1, category_name_2)])
+            self.log("create_similarity", category_name_1, category_name_2)
+            self.versions.bump(SIMILAR, (category_name_1, category_name_2))
+
+        self.sync()
         return {"ok": True}
 
+    '''
+    All or nothing - the whole batch is validated first and nothing is created if any similarity fails
+    '''
+    def create_similarities(self, similarities: List[Similarity]):
+        with self.write_lock:
+            # A batch names far fewer categories than it has pairs, so every name is looked up once
+            names = {name for similarity in similarities
+                     for name in (similarity.category_name_1, similarity.category_name_2)}
+            existing = {name for name in names if self.repository.has_category(name)}
+            errors = [{"index": index, "detail": "One or both categories not found"}
+                      for index, similarity in enumerate(similarities)
+                      if similarity.category_name_1 not in existing or similarity.category_name_2 not in existing]
+            if errors:
+                raise HTTPException(status_code=422, detail=errors)
+
+            pairs = [(similarity.category_name_1, similarity.category_name_2) for similarity in similarities]
+            self.repository.add_similarities(pairs)
+            self.log("create_similarities", pairs)
+            self.versions.bump(SIMILAR, names)
+
+        self.sync()
+        return {"ok": True, "created": len(similarities)}
+
     '''
     By design if we try to delete non existing similarity - we don't throw exception but rather ignore
     '''
     def delete_similarity(self, similarity: Similarity):
         category_name_1, category_name_2 = similarity.category_name_1, similarity.category_name_2
-        self.similarities.discard((category_name_1, category_name_2))
-        self.similarities.discard((category_name_2, category_name_1))
+        with self.write_lock:
+            self.repository.discard_similarity((category_name_1, category_name_2))
+            self.log("delete_similarity", category_name_1, category_name_2)
+            self.versions.bump(SIMILAR, (category_name_1, category_name_2))
+
+        self.sync()
         return {"ok": True}
 
+    '''
+    ETag of the similar categories of name, taken before they are read
+    '''
+    def similarities_etag(self, name: str) -> str:
+        return self.versions.etag(SIMILAR, name)
+
     def get_similarities(self, name: str):
-        if name not in self.categories:
+        if not self.repository.has_category(name):
+            raise HTTPException(status_code=404, detail="Category not found")
+
+        metrics.similarity_lookups.inc("similar")
+        return self.repository.get_similar(name)
+
+    '''
+    Categories at most hops similarities away from name, as (category, hops) nearest first. One BFS that stops
+    once limit categories are found. It looks up the similar categories of each category it reaches, as they
+    are then, so it never waits for a snapshot of the whole graph. It runs lazily, so a streamed response sends
+    each category as soon as it is reached.
+    '''
+    def get_similarity_neighborhood(self, name: str, hops: int,
+                                    limit: Optional[int] = None) -> Iterator[Tuple[CategoryRecord, int]]:
+        if not self.repository.has_category(name):
             raise HTTPException(status_code=404, detail="Category not found")
 
-        similar_categories = {cid2 for cid1, cid2 in self.similarities if cid1 == name}
-        return [self.categories[cid] for cid in similar_categories]
+        metrics.similarity_lookups.inc("neighborhood")
+        return self._neighborhood(name, hops, limit)
+
+    '''
+    A category without similarities forms a rabbit island of its own
+    '''
+    def get_rabbit_island(self, name: str):
+        if not self.repository.has_category(name):
+            raise HTTPException(status_code=404, detail="Category not found")
+
+        metrics.similarity_lookups.inc("rabbit_island")
+        return self.repository.get_rabbit_island(name)
+
+    def get_rabbit_islands(self):
+        metrics.similarity_lookups.inc("rabbit_islands")
+        return self.repository.get_rabbit_islands()
+
+    def _neighborhood(self, name: str, hops: int, limit: Optional[int]) -> Iterator[Tuple[CategoryRecord, int]]:
+        started = time.perf_counter()
+        seen, frontier, found, vertices, edges = {name}, [name], 0, 0, 0
+        try:
+            for level in range(1, hops + 1):
+                next_frontier = []
+                for vertex in frontier:
+                    similar = self.repository.get_similar(vertex)
+                    vertices += 1
+                    edges += len(similar)
+                    for category in similar:
+                        if category.name in seen:
+                            continue
+                        seen.add(category.name)
+                        next_frontier.append(category.name)
+                        yield category, level
+                        found += 1
+                        if found == limit:
+                            return
+                frontier = next_frontier
+                if not frontier:
+                    return
+        finally:
+            metrics.bfs("neighborhood", started, vertices, edges)
 
 
 similarity_service = SimilarityService(db)
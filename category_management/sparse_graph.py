@@ -0,0 +1,223 @@
+import time
+from collections.abc import Mapping
+from typing import List, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, shortest_path
+
+from metrics import metrics
+from models import SimilarityGraph
+
+
+class SparseGraph:
+    """
+    The similarity graph as a SciPy CSR matrix, for the "sparse" engine of RabbitHoleScript.
+
+    Only categories with similarities are vertices, numbered in the order of the adjacency list, and results use
+    the keys of that list - names, or ids of a SimilarityGraph - like the python engine does.
+    Searches run from many sources at once: the frontier holds one bit per source, packed into uint64 words per
+    vertex, and a BFS level is the boolean product of the frontier rows with the adjacency, done by one
+    bitwise OR reduction over the similarities of the frontier.
+    """
+
+    # Bytes the per-vertex bitsets of one batch of sources may take, which bounds how many sources run at once
+    BATCH_BYTES = 32 << 20
+
+    def __init__(self, adjacency_list: Mapping):
+        if isinstance(adjacency_list, SimilarityGraph):
+            offsets = np.asarray(adjacency_list.offsets, dtype=np.int64)
+            all_degrees = np.diff(offsets)
+            present = np.flatnonzero(all_degrees)
+            position = np.full(len(all_degrees), -1, dtype=np.int64)
+            position[present] = np.arange(len(present))
+            self.keys = present.tolist()
+            self.degrees = all_degrees[present]
+            indices = position[np.asarray(adjacency_list.targets)[:offsets[-1]]]
+        else:
+            self.keys = list(adjacency_list)
+            index = {key: position for position, key in enumerate(self.keys)}
+            self.degrees = np.fromiter((len(adjacency_list[key]) for key in self.keys), np.int64, len(self.keys))
+            indices = np.fromiter((index[neighbor] for key in self.keys for neighbor in adjacency_list[key]),
+                                  np.int64, int(self.degrees.sum()))
+
+        self.vertex_count = len(self.keys)
+        self.indices = indices.astype(np.int32)
+        self.indptr = np.concatenate(([0], np.cumsum(self.degrees))).astype(np.int32)
+        self.matrix = csr_matrix((np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr),
+                                 shape=(self.vertex_count, self.vertex_count))
+
+        # Islands are numbered by their lowest vertex, so they come in the order the python engine finds them
+        self.component_count, component = connected_components(self.matrix, directed=False)
+        firsts = np.full(self.component_count, self.vertex_count, dtype=np.int64)
+        np.minimum.at(firsts, component, np.arange(self.vertex_count))
+        rank = np.empty(self.component_count, dtype=np.int64)
+        rank[np.argsort(firsts)] = np.arange(self.component_count)
+        self.component = rank[component]
+        self.firsts = np.sort(firsts)
+
+    def islands(self) -> List[list]:
+        if not self.vertex_count:
+            return []
+        order = np.argsort(self.component, kind="stable")
+        bounds = np.cumsum(np.bincount(self.component, minlength=self.component_count))[:-1]
+        return [[self.keys[vertex] for vertex in members] for members in np.split(order, bounds)]
+
+    def distances(self, sources: np.ndarray) -> np.ndarray:
+        """Hops from every vertex to the nearest of sources, -1 for vertices no source reaches"""
+        started = time.perf_counter()
+        # One BFS in C from an extra vertex that is similar to every source, and to nothing back
+        sources = np.asarray(sources, dtype=np.int32)
+        indices = np.concatenate((self.indices, sources))
+        indptr = np.append(self.indptr, len(indices))
+        matrix = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                            shape=(self.vertex_count + 1, self.vertex_count + 1))
+        hops = shortest_path(matrix, unweighted=True, indices=self.vertex_count)[:-1]
+
+        reached = np.isfinite(hops)
+        distances = np.where(reached, hops - 1, -1).astype(np.int32)
+        metrics.bfs("sparse", started, int(reached.sum()), int(self.degrees[reached].sum()))
+        return distances
+
+    def eccentricities(self, sources: np.ndarray = None) -> np.ndarray:
+        """Eccentricity of each of the distinct sources within its island, of every vertex by default"""
+        sources = np.arange(self.vertex_count) if sources is None else np.asarray(sources, dtype=np.int64)
+        eccentricities = np.zeros(len(sources), dtype=np.int32)
+        words = max(1, self.BATCH_BYTES // (8 * max(self.vertex_count, len(self.indices), 1)))
+        for begin in range(0, len(sources), 64 * words):
+            batch = sources[begin:begin + 64 * words]
+            eccentricities[begin:begin + len(batch)] = self._batch_eccentricities(batch)
+        return eccentricities
+
+    def diameter(self) -> int:
+        lengths, _, _ = self._diameters()
+        return int(lengths.max()) if len(lengths) else 0
+
+    def longest_path(self) -> Tuple[int, list]:
+        lengths, candidates, eccentricities = self._diameters()
+        if not len(lengths):
+            return 0, []
+        length = lengths.max()
+        start = candidates[np.argmax(eccentricities == length)]
+        distances, predecessors = shortest_path(self.matrix, unweighted=True, indices=[start],
+                                                return_predecessors=True)
+        return int(length), self._path(predecessors[0], np.argmax(distances[0] == length))
+
+    '''
+    Every longest rabbit hole as an ordered path - one per pair of end categories
+    '''
+    def longest_paths(self) -> List[list]:
+        lengths, candidates, eccentricities = self._diameters()
+        if not len(lengths):
+            return []
+        length = lengths.max()
+        starts = candidates[eccentricities == length]
+
+        longest_paths = {}
+        # shortest_path returns a row of distances and one of predecessors per start
+        batch = max(1, self.BATCH_BYTES // (12 * self.vertex_count))
+        for begin in range(0, len(starts), batch):
+            distances, predecessors = shortest_path(self.matrix, unweighted=True, indices=starts[begin:begin + batch],
+                                                    return_predecessors=True)
+            for start, row, start_predecessors in zip(starts[begin:begin + batch], distances, predecessors):
+                for end in np.flatnonzero(row == length):
+                    pair = frozenset((self.keys[start], self.keys[end]))
+                    if pair not in longest_paths:
+                        longest_paths[pair] = self._path(start_predecessors, end)
+
+        return list(longest_paths.values())
+
+    '''
+    Longest rabbit hole of every island, with the vertices that may end one and their eccentricities.
+
+    Two sweeps from every island at once give a lower bound and a central root. As ecc(v) <= d(root, v) + ecc(root),
+    only the vertices at least lower - ecc(root) away from the root can end a longest hole, and only those get
+    the bulk eccentricity search.
+    '''
+    def _diameters(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if not self.vertex_count:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+
+        sweep_starts, _ = self._farthest(self.distances(self.firsts))
+        start_distances = self.distances(sweep_starts)
+        sweep_ends, lower = self._farthest(start_distances)
+        end_distances = self.distances(sweep_ends)
+
+        half = lower // 2
+        middle = np.flatnonzero((start_distances == half[self.component]) &
+                                (end_distances == (lower - half)[self.component]))
+        roots = np.full(self.component_count, self.vertex_count, dtype=np.int64)
+        np.minimum.at(roots, self.component[middle], middle)
+        root_distances = self.distances(roots)
+        _, radius = self._farthest(root_distances)
+
+        candidates = np.flatnonzero(root_distances >= (lower - radius)[self.component])
+        eccentricities = self.eccentricities(candidates)
+        lengths = np.zeros(self.component_count, dtype=np.int32)
+        np.maximum.at(lengths, self.component[candidates], eccentricities)
+        return lengths, candidates, eccentricities
+
+    def _farthest(self, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The farthest vertex of every island and its distance, given the distances from one source per island"""
+        order = np.lexsort((distances, self.component))
+        ends = np.cumsum(np.bincount(self.component, minlength=self.component_count)) - 1
+        farthest = order[ends]
+        return farthest, distances[farthest]
+
+    def _batch_eccentricities(self, sources: np.ndarray) -> np.ndarray:
+        started = time.perf_counter()
+        # Too few sources to fill a word - one BFS in C per source beats a NumPy step per level on long holes
+        if len(sources) < 64:
+            hops = shortest_path(self.matrix, unweighted=True, indices=sources)
+            reached = np.isfinite(hops)
+            metrics.bfs("sparse", started, int(reached.sum()), int((reached * self.degrees).sum()))
+            return np.where(reached, hops, -1).max(axis=1).astype(np.int32)
+
+        columns = np.arange(len(sources))
+        bits = np.zeros((len(sources), (len(sources) + 63) // 64), dtype=np.uint64)
+        bits[columns, columns >> 6] = np.left_shift(np.uint64(1), (columns & 63).astype(np.uint64))
+        seen = np.zeros((self.vertex_count, bits.shape[1]), dtype=np.uint64)
+        seen[sources] = bits
+
+        eccentricities = np.zeros(len(sources), dtype=np.int32)
+        frontier, level, vertices, edges = sources, 0, 0, 0
+        while frontier.size:
+            level += 1
+            positions, owners = self._similarities(frontier)
+            vertices, edges = vertices + len(frontier), edges + len(positions)
+            reached, reached_bits = self._combine(self.indices[positions], bits[owners])
+            reached_bits &= ~seen[reached]
+            new = reached_bits.any(axis=1)
+            frontier, bits = reached[new], reached_bits[new]
+            seen[frontier] |= bits
+
+            # Every source with a bit in the new frontier is at least this eccentric
+            found = np.bitwise_or.reduce(bits, axis=0).astype("<u8").view(np.uint8)
+            eccentricities[np.unpackbits(found, bitorder="little")[:len(sources)].astype(bool)] = level
+
+        metrics.bfs("sparse", started, vertices, edges)
+        return eccentricities
+
+    def _similarities(self, vertices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions in indices of the similarities of vertices, and the index in vertices each belongs to"""
+        counts = self.degrees[vertices]
+        ends = np.cumsum(counts)
+        positions = np.repeat(self.indptr[vertices] - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+        return positions, np.repeat(np.arange(len(vertices)), counts)
+
+    @staticmethod
+    def _combine(vertices: np.ndarray, bits: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The distinct vertices, each with the OR of the bit rows given for it"""
+        if not vertices.size:
+            return vertices, bits
+        order = np.argsort(vertices, kind="stable")
+        vertices = vertices[order]
+        starts = np.flatnonzero(np.concatenate(([True], vertices[1:] != vertices[:-1])))
+        return vertices[starts], np.bitwise_or.reduceat(bits[order], starts, axis=0)
+
+    def _path(self, predecessors: np.ndarray, end: int) -> list:
+        path = [int(end)]
+        while predecessors[path[-1]] >= 0:
+            path.append(int(predecessors[path[-1]]))
+        path.reverse()
+        return [self.keys[vertex] for vertex in path]
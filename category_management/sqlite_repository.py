@@ -0,0 +1,360 @@
+import sqlite3
+from array import array
+from collections.abc import Mapping
+from contextlib import contextmanager
+from queue import Queue
+from threading import Lock, RLock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from schemas import Category, CategoryRecord, DeleteMode
+from models import RabbitIslands, SimilarityGraph
+from metrics import metrics
+from versions import ResourceVersions
+from repository import Repository
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS categories (
+    name TEXT PRIMARY KEY,
+    description TEXT,
+    image TEXT,
+    parent_name TEXT,
+    -- Siblings are ordered by position, which only grows, so moved and new children go last
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS categories_parent_name ON categories (parent_name, position);
+
+-- Every similarity is stored once, with category_name_1 <= category_name_2
+CREATE TABLE IF NOT EXISTS similarities (
+    category_name_1 TEXT NOT NULL,
+    category_name_2 TEXT NOT NULL,
+    PRIMARY KEY (category_name_1, category_name_2)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS similarities_category_name_2 ON similarities (category_name_2, category_name_1);
+'''
+
+CATEGORY_COLUMNS = 'c.name, c.description, c.image, c.parent_name'
+
+SELECT_CATEGORY = f'SELECT {CATEGORY_COLUMNS} FROM categories c WHERE c.name = ?'
+HAS_CATEGORY = 'SELECT 1 FROM categories WHERE name = ?'
+SELECT_CHILDREN = f'SELECT {CATEGORY_COLUMNS} FROM categories c WHERE c.parent_name = ? ORDER BY c.position'
+SELECT_ROOTS = f'SELECT {CATEGORY_COLUMNS} FROM categories c WHERE c.parent_name IS NULL ORDER BY c.position'
+SELECT_MAX_POSITION = 'SELECT COALESCE(MAX(position), 0) FROM categories'
+
+# Preorder is the order of the root-to-category paths of zero padded sibling positions
+SELECT_SUBTREE = f'''
+WITH RECURSIVE subtree(name, depth, path) AS (
+    SELECT name, 0, printf('%020d', position) FROM categories WHERE name = ?1
+    UNION ALL
+    SELECT c.name, s.depth + 1, s.path || printf('%020d', c.position)
+    FROM categories c JOIN subtree s ON c.parent_name = s.name
+    WHERE ?2 IS NULL OR s.depth < ?2
+)
+SELECT {CATEGORY_COLUMNS}, s.depth FROM subtree s JOIN categories c ON c.name = s.name ORDER BY s.path
+'''
+SELECT_SUBTREE_NAMES = '''
+WITH RECURSIVE subtree(name) AS (
+    SELECT ?1
+    UNION ALL
+    SELECT c.name FROM categories c JOIN subtree s ON c.parent_name = s.name
+)
+SELECT name FROM subtree
+'''
+# The roots or the named category are depth 0 and only levels down to ?2 are expanded
+LEVELS = '''
+    UNION ALL
+    SELECT c.name, l.depth + 1, l.path || printf('%020d', c.position)
+    FROM categories c JOIN levels l ON c.parent_name = l.name
+    WHERE l.depth < ?2
+)
+SELECT {columns} FROM levels l JOIN categories c ON c.name = l.name WHERE l.depth = ?2 ORDER BY l.path
+'''.format(columns=CATEGORY_COLUMNS)
+SELECT_AT_DEPTH = '''
+WITH RECURSIVE levels(name, depth, path) AS (
+    SELECT name, 0, printf('%020d', position) FROM categories WHERE name = ?1
+''' + LEVELS
+SELECT_AT_ABSOLUTE_DEPTH = '''
+WITH RECURSIVE levels(name, depth, path) AS (
+    SELECT name, 0, printf('%020d', position) FROM categories WHERE parent_name IS NULL
+''' + LEVELS
+IS_IN_SUBTREE = '''
+WITH RECURSIVE ancestors(name) AS (
+    SELECT ?1
+    UNION
+    SELECT c.parent_name FROM categories c JOIN ancestors a ON c.name = a.name WHERE c.parent_name IS NOT NULL
+)
+SELECT EXISTS (SELECT 1 FROM ancestors WHERE name = ?2)
+'''
+
+UPSERT_CATEGORY = '''
+INSERT INTO categories (name, description, image, parent_name, position) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET description = excluded.description, image = excluded.image,
+    parent_name = excluded.parent_name, position = excluded.position
+'''
+# ?2 and ?4 tell whether description and image are updated, so one prepared statement serves every update
+UPDATE_CATEGORY = '''
+UPDATE categories SET description = CASE WHEN ?2 THEN ?3 ELSE description END,
+    image = CASE WHEN ?4 THEN ?5 ELSE image END
+WHERE name = ?1
+'''
+SET_PARENT = 'UPDATE categories SET parent_name = ?, position = ? WHERE name = ?'
+SELECT_PARENT_NAME = 'SELECT parent_name FROM categories WHERE name = ?'
+SELECT_CHILD_NAMES = 'SELECT name FROM categories WHERE parent_name = ? ORDER BY position'
+DELETE_CATEGORY = 'DELETE FROM categories WHERE name = ?'
+
+INSERT_SIMILARITY = 'INSERT OR IGNORE INTO similarities (category_name_1, category_name_2) VALUES (?, ?)'
+DELETE_SIMILARITY = 'DELETE FROM similarities WHERE category_name_1 = ? AND category_name_2 = ?'
+DELETE_SIMILARITIES_1 = 'DELETE FROM similarities WHERE category_name_1 = ?'
+DELETE_SIMILARITIES_2 = 'DELETE FROM similarities WHERE category_name_2 = ?'
+SELECT_SIMILARITIES = 'SELECT category_name_1, category_name_2 FROM similarities'
+SELECT_SIMILAR = f'''
+SELECT {CATEGORY_COLUMNS} FROM similarities s JOIN categories c ON c.name = s.category_name_2
+WHERE s.category_name_1 = ?1
+UNION
+SELECT {CATEGORY_COLUMNS} FROM similarities s JOIN categories c ON c.name = s.category_name_1
+WHERE s.category_name_2 = ?1
+'''
+SELECT_SIMILAR_NAMES = '''
+SELECT category_name_2 FROM similarities WHERE category_name_1 = ?1
+UNION
+SELECT category_name_1 FROM similarities WHERE category_name_2 = ?1
+'''
+SELECT_RABBIT_ISLAND = f'''
+WITH RECURSIVE island(name) AS (
+    SELECT ?1
+    UNION
+    SELECT s.category_name_2 FROM similarities s JOIN island i ON s.category_name_1 = i.name
+    UNION
+    SELECT s.category_name_1 FROM similarities s JOIN island i ON s.category_name_2 = i.name
+)
+SELECT {CATEGORY_COLUMNS} FROM island i JOIN categories c ON c.name = i.name
+'''
+
+
+class ConnectionPool:
+    """
+    Fixed size pool of SQLite connections shared between threads.
+
+    Every query is one of the constant statements above with parameters, and every connection keeps
+    a cache of its prepared statements, so a statement is compiled once per connection.
+    """
+
+    STATEMENT_CACHE_SIZE = 64
+
+    def __init__(self, path: str, size: int = 4):
+        self.connections: Queue = Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                         cached_statements=self.STATEMENT_CACHE_SIZE)
+            # WAL lets readers run while a write commits
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('PRAGMA busy_timeout = 5000')
+            self.connections.put(connection)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class SqliteRepository(Repository):
+    """
+    Repository on a SQLite database file, for catalogs that must outlive the process or outgrow memory.
+
+    Children are found through the index on parent_name and similar categories through the indexes
+    on both similarity columns. Subtrees, depths and ancestors are recursive CTEs, so a tree query is
+    one statement. The similarity graph for the rabbit hole analysis is built from the table and cached
+    against similarity_version, which this process bumps on every similarity write.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.pool = ConnectionPool(path, pool_size)
+        self.write_lock = RLock()
+        self.versions = ResourceVersions()
+        with self.pool.connection() as connection:
+            connection.executescript(SCHEMA)
+            self.position = connection.execute(SELECT_MAX_POSITION).fetchone()[0]
+        self.version = 0
+        self.cache_lock = Lock()
+        self._graph: Optional[SimilarityGraph] = None
+        # (version, islands, {name: index of its island}) of the latest island query
+        self._islands: Tuple[int, List[List[str]], Dict[str, int]] = (-1, [], {})
+
+    def get_category(self, name: str) -> Optional[CategoryRecord]:
+        row = self._fetch_one(SELECT_CATEGORY, (name,))
+        return None if row is None else self.category(row)
+
+    def has_category(self, name: str) -> bool:
+        return self._fetch_one(HAS_CATEGORY, (name,)) is not None
+
+    def get_children(self, parent_name: Optional[str]) -> List[CategoryRecord]:
+        if parent_name is None:
+            return self._fetch_categories(SELECT_ROOTS, ())
+        return self._fetch_categories(SELECT_CHILDREN, (parent_name,))
+
+    def get_categories_at_depth(self, depth: int, parent_name: Optional[str]) -> List[CategoryRecord]:
+        statement = SELECT_AT_ABSOLUTE_DEPTH if parent_name is None else SELECT_AT_DEPTH
+        return self._fetch_categories(statement, (parent_name, depth))
+
+    def get_subtree(self, name: str, max_depth: Optional[int]) -> Iterator[Tuple[CategoryRecord, int]]:
+        rows = self._fetch_all(SELECT_SUBTREE, (name, max_depth))
+        return ((self.category(row), row[-1]) for row in rows)
+
+    def is_in_subtree(self, name: Optional[str], root_name: str) -> bool:
+        return name is not None and bool(self._fetch_one(IS_IN_SUBTREE, (name, root_name))[0])
+
+    def add_categories(self, categories: List[Category]):
+        with self.pool.transaction() as connection:
+            connection.executemany(UPSERT_CATEGORY, [
+                (category.name, category.description, category.image, category.parent_name or None,
+                 self._next_position()) for category in categories])
+
+    def update_category(self, name: str, fields: dict):
+        with self.pool.transaction() as connection:
+            connection.execute(UPDATE_CATEGORY, (name, 'description' in fields, fields.get('description'),
+                                                 'image' in fields, fields.get('image')))
+
+    def set_parent(self, name: str, parent_name: Optional[str]):
+        with self.pool.transaction() as connection:
+            connection.execute(SET_PARENT, (parent_name, self._next_position(), name))
+
+    def delete_category(self, name: str, mode: DeleteMode) -> int:
+        with self.pool.transaction() as connection:
+            if mode == DeleteMode.CASCADE:
+                deleted_names = [(row[0],) for row in connection.execute(SELECT_SUBTREE_NAMES, (name,))]
+            else:
+                parent_name = connection.execute(SELECT_PARENT_NAME, (name,)).fetchone()[0]
+                children = [row[0] for row in connection.execute(SELECT_CHILD_NAMES, (name,))]
+                connection.executemany(SET_PARENT, [(parent_name, self._next_position(), child) for child in children])
+                deleted_names = [(name,)]
+
+            connection.executemany(DELETE_SIMILARITIES_1, deleted_names)
+            connection.executemany(DELETE_SIMILARITIES_2, deleted_names)
+            connection.executemany(DELETE_CATEGORY, deleted_names)
+        self.version += 1
+        return len(deleted_names)
+
+    def add_similarities(self, pairs: Iterable[Tuple[str, str]]):
+        with self.pool.transaction() as connection:
+            connection.executemany(INSERT_SIMILARITY, map(self.ordered, pairs))
+        self.version += 1
+
+    def discard_similarity(self, pair: Tuple[str, str]):
+        with self.pool.transaction() as connection:
+            connection.execute(DELETE_SIMILARITY, self.ordered(pair))
+        self.version += 1
+
+    def get_similar(self, name: str) -> List[CategoryRecord]:
+        return self._fetch_categories(SELECT_SIMILAR, (name,))
+
+    def similar_names(self, name: str) -> List[str]:
+        return [row[0] for row in self._fetch_all(SELECT_SIMILAR_NAMES, (name,))]
+
+    def get_rabbit_island(self, name: str) -> List[CategoryRecord]:
+        return self._fetch_categories(SELECT_RABBIT_ISLAND, (name,))
+
+    def get_rabbit_islands(self) -> List[List[str]]:
+        return [list(members) for members in self._fresh_islands()[1]]
+
+    def same_rabbit_island(self, name_1: str, name_2: str) -> bool:
+        if name_1 == name_2:
+            return True
+        island_of = self._fresh_islands()[2]
+        return name_1 in island_of and island_of[name_1] == island_of.get(name_2)
+
+    @property
+    def similarity_version(self) -> int:
+        return self.version
+
+    def similarity_graph(self) -> SimilarityGraph:
+        version = self.version
+        with self.cache_lock:
+            hit = self._graph is not None and self._graph.version == version
+            metrics.cache("similarity_graph", hit)
+            if not hit:
+                self._graph = self._build_graph(version)
+            return self._graph
+
+    def similarity_adjacency(self) -> Mapping:
+        graph = self.similarity_graph()
+        return {graph.names[vertex]: {graph.names[neighbor] for neighbor in graph[vertex]} for vertex in graph}
+
+    def close(self):
+        self.pool.close()
+
+    @staticmethod
+    def category(row: tuple) -> CategoryRecord:
+        return CategoryRecord(*row[:4])
+
+    @staticmethod
+    def ordered(pair: Tuple[str, str]) -> Tuple[str, str]:
+        return (pair[0], pair[1]) if pair[0] <= pair[1] else (pair[1], pair[0])
+
+    def _fresh_islands(self) -> Tuple[int, List[List[str]], Dict[str, int]]:
+        version = self.version
+        with self.cache_lock:
+            metrics.cache("rabbit_islands", self._islands[0] == version)
+            if self._islands[0] != version:
+                islands = RabbitIslands()
+                islands.rebuild(self._fetch_all(SELECT_SIMILARITIES, ()))
+                members = list(islands.members.values())
+                island_of = {name: index for index, island in enumerate(members) for name in island}
+                self._islands = version, members, island_of
+            return self._islands
+
+    def _build_graph(self, version: int) -> SimilarityGraph:
+        ids: Dict[str, int] = {}
+        names: List[str] = []
+        neighbors: List[List[int]] = []
+
+        def intern(name: str) -> int:
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+                neighbors.append([])
+            return ids[name]
+
+        for name_1, name_2 in self._fetch_all(SELECT_SIMILARITIES, ()):
+            vertex_1, vertex_2 = intern(name_1), intern(name_2)
+            neighbors[vertex_1].append(vertex_2)
+            if vertex_1 != vertex_2:
+                neighbors[vertex_2].append(vertex_1)
+
+        offsets, targets = array('i', [0]), array('i')
+        for vertex_neighbors in neighbors:
+            targets.extend(sorted(vertex_neighbors))
+            offsets.append(len(targets))
+        return SimilarityGraph(names, ids, offsets, targets, version)
+
+    def _next_position(self) -> int:
+        self.position += 1
+        return self.position
+
+    def _fetch_one(self, statement: str, parameters: tuple) -> Optional[tuple]:
+        with self.pool.connection() as connection:
+            return connection.execute(statement, parameters).fetchone()
+
+    def _fetch_all(self, statement: str, parameters: tuple) -> List[tuple]:
+        with self.pool.connection() as connection:
+            return connection.execute(statement, parameters).fetchall()
+
+    def _fetch_categories(self, statement: str, parameters: tuple) -> List[CategoryRecord]:
+        return [self.category(row) for row in self._fetch_all(statement, parameters)]
@@ -0,0 +1,30 @@
+import sys
+
+sys.path.append('..')
+
+import pytest
+from fastapi.testclient import TestClient
+from category_management.category_service import CategoryService
+from category_management.similarity_service import SimilarityService
+from category_management.rabbit_hole_script import RabbitHoleScript
+from category_management.models import InMemoryDatabase
+
+
+@pytest.fixture
+def repository():
+    return InMemoryDatabase()
+
+
+@pytest.fixture
+def client(repository, monkeypatch):
+    """
+    A TestClient of the app with its routes on new services of the repository. The routes look the services up
+    as globals of main, which are restored after the test.
+    """
+    # The module the routes are defined in, as imported by the app itself
+    import main
+
+    monkeypatch.setattr(main, "category_service", CategoryService(repository))
+    monkeypatch.setattr(main, "similarity_service", SimilarityService(repository))
+    monkeypatch.setattr(main, "rabbit_hole_script", RabbitHoleScript(repository))
+    return TestClient(main.app)
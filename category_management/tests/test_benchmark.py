@@ -0,0 +1,43 @@
+import sys
+
+sys.path.append('..')
+
+import json
+from category_management.benchmark import Workload, compare, percentile, run
+
+
+def test_workload_is_reproducible():
+    workload = Workload(50, 200, seed=1)
+    assert len(set(workload.pair_codes)) == 200
+    assert workload.parents == Workload(50, 200, seed=1).parents
+    assert workload.pair_codes == Workload(50, 200, seed=1).pair_codes
+    assert workload.pair_codes != Workload(50, 200, seed=2).pair_codes
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.95) == 7
+
+
+def test_run_covers_every_mode(monkeypatch):
+    # The api mode points the routes at the benchmark's services, so they are put back after the test
+    import main
+    for name in ("category_service", "similarity_service", "rabbit_hole_script"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+
+    results = run([100], category_count=40, samples=3, heavy_samples=1, report=lambda line: None)
+    json.dumps(results)
+
+    scale = results["scales"][0]
+    assert scale["load"] == {**scale["load"], "categories": 40, "pairs": 100}
+    modes = {result["mode"] for result in scale["results"]}
+    assert modes == {"in-process", "api"}
+    for result in scale["results"]:
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+        assert result["throughput_per_s"] > 0
+
+    lines = []
+    compare(results, results, report=lines.append)
+    assert len(lines) == len(scale["results"]) and all("+0.0%" in line for line in lines)
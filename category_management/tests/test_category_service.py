@@ -5,13 +5,13 @@ sys.path.append('..')
 import pytest
 from fastapi import HTTPException
 from category_management.category_service import CategoryService
-from category_management.models import InMemoryDatabase
-from category_management.schemas import Category
+from category_management.schemas import Category, DeleteMode, Similarity
+from category_management.similarity_service import SimilarityService
 
 
 @pytest.fixture
-def db():
-    return InMemoryDatabase()
+def db(repository):
+    return repository
 
 
 @pytest.fixture
@@ -53,7 +53,7 @@ def test_move_middle_node_to_root(category_service):
     assert [cat.name for cat in category_service.get_categories(parent_name="child1_1")] == ["child1_1_1", "child1_1_2"]
 
     # Ensure total number of categories remains the same (although we already checked this indirectly above)
-    assert len(category_service.categories) == 10
+    assert len(category_service.repository.categories) == 10
 
 
 def test_create_and_move_leaf_to_middle_node(category_service):
@@ -73,13 +73,13 @@ def test_create_and_move_leaf_to_middle_node(category_service):
     for category in categories:
         category_service.create_category(category)
 
-    initial_count = len(category_service.categories)
+    initial_count = len(category_service.repository.categories)
     category_service.move_category(name="child1_1_2", new_parent_name="child2_1")
 
     moved_category = category_service.get_category(name="child1_1_2")
     assert moved_category.parent_name == "child2_1"
     assert "child1_1_2" in [cat.name for cat in category_service.get_categories(parent_name="child2_1")]
-    assert len(category_service.categories) == initial_count
+    assert len(category_service.repository.categories) == initial_count
 
 
 def test_create_category_root(category_service):
@@ -138,6 +138,46 @@ def test_delete_category(category_service):
     assert exc_info.value.status_code == 404
 
 
+def test_delete_category_reparents_children_and_drops_similarities(db, category_service):
+    similarity_service = SimilarityService(db)
+    category_service.create_categories([
+        Category(name="root"),
+        Category(name="child", parent_name="root"),
+        Category(name="grandchild1", parent_name="child"),
+        Category(name="grandchild2", parent_name="child"),
+    ])
+    similarity_service.create_similarity(Similarity(category_name_1="child", category_name_2="root"))
+    similarity_service.create_similarity(Similarity(category_name_1="child", category_name_2="grandchild1"))
+
+    result = category_service.delete_category("child")
+
+    assert result["deleted_categories"] == 1
+    assert [cat.name for cat in category_service.get_categories("root")] == ["grandchild1", "grandchild2"]
+    assert category_service.get_category("grandchild1").parent_name == "root"
+    assert len(db.similarities) == 0
+    assert similarity_service.get_rabbit_islands() == []
+
+
+def test_delete_category_cascade_removes_subtree_and_similarities(db, category_service):
+    similarity_service = SimilarityService(db)
+    category_service.create_categories([
+        Category(name="root"),
+        Category(name="child", parent_name="root"),
+        Category(name="grandchild", parent_name="child"),
+        Category(name="great_grandchild", parent_name="grandchild"),
+        Category(name="other", parent_name="root"),
+    ])
+    similarity_service.create_similarity(Similarity(category_name_1="great_grandchild", category_name_2="other"))
+    similarity_service.create_similarity(Similarity(category_name_1="root", category_name_2="other"))
+
+    result = category_service.delete_category("child", DeleteMode.CASCADE)
+
+    assert result["deleted_categories"] == 3
+    assert sorted(category_service.repository.categories) == ["other", "root"]
+    assert [cat.name for cat, _ in category_service.get_subtree("root")] == ["root", "other"]
+    assert [cat.name for cat in similarity_service.get_similarities("other")] == ["root"]
+
+
 def test_delete_nonexistent_category(category_service):
     with pytest.raises(HTTPException) as exc_info:
         category_service.delete_category("nonexistent")
@@ -204,3 +244,146 @@ def test_get_categories_without_parent(category_service):
     result = category_service.get_categories()
     assert len(result) == 1
     assert result[0].name == "root"
+
+
+def test_create_categories_batch_with_parent_in_same_batch(category_service):
+    result = category_service.create_categories([
+        Category(name="root"),
+        Category(name="child", parent_name="root"),
+        Category(name="grandchild", parent_name="child"),
+    ])
+
+    assert result == {"created": 3}
+    assert [cat.name for cat in category_service.get_categories("child")] == ["grandchild"]
+
+
+def test_create_categories_batch_is_all_or_nothing(category_service):
+    category_service.create_category(Category(name="root"))
+
+    with pytest.raises(HTTPException) as exc_info:
+        category_service.create_categories([
+            Category(name="child", parent_name="root"),
+            Category(name="root"),
+            Category(name="orphan", parent_name="nonexistent"),
+            Category(name="child"),
+        ])
+
+    assert exc_info.value.status_code == 422
+    assert exc_info.value.detail == [
+        {"index": 1, "detail": "Category already exists"},
+        {"index": 2, "detail": "Parent category not found"},
+        {"index": 3, "detail": "Category already exists"},
+    ]
+    assert list(category_service.repository.categories) == ["root"]
+    assert category_service.get_categories("root") == []
+
+
+def test_get_subtree_with_max_depth(category_service):
+    categories = [
+        Category(name="root"),
+        Category(name="child1", parent_name="root"),
+        Category(name="child2", parent_name="root"),
+        Category(name="child1_1", parent_name="child1"),
+        Category(name="child1_1_1", parent_name="child1_1"),
+        Category(name="child2_1", parent_name="child2"),
+    ]
+    category_service.create_categories(categories)
+
+    assert [(cat.name, depth) for cat, depth in category_service.get_subtree("root")] == [
+        ("root", 0), ("child1", 1), ("child1_1", 2), ("child1_1_1", 3), ("child2", 1), ("child2_1", 2)]
+    assert [(cat.name, depth) for cat, depth in category_service.get_subtree("root", max_depth=1)] == [
+        ("root", 0), ("child1", 1), ("child2", 1)]
+
+    category_service.move_category("child2", "child1_1")
+    assert [(cat.name, depth) for cat, depth in category_service.get_subtree("child1", max_depth=2)] == [
+        ("child1", 0), ("child1_1", 1), ("child1_1_1", 2), ("child2", 2)]
+
+
+def test_get_categories_by_depth(category_service):
+    category_service.create_categories([
+        Category(name="root"),
+        Category(name="other_root"),
+        Category(name="child1", parent_name="root"),
+        Category(name="child2", parent_name="other_root"),
+        Category(name="child1_1", parent_name="child1"),
+    ])
+
+    assert [cat.name for cat in category_service.get_categories(depth=0)] == ["root", "other_root"]
+    assert [cat.name for cat in category_service.get_categories(depth=1)] == ["child1", "child2"]
+    assert [cat.name for cat in category_service.get_categories("root", depth=2)] == ["child1_1"]
+    assert category_service.get_categories("root", depth=5) == []
+
+
+def test_get_subtree_of_deep_tree_does_not_recurse(category_service):
+    category_service.create_categories(
+        [Category(name="category_0")] +
+        [Category(name=f"category_{i}", parent_name=f"category_{i - 1}") for i in range(1, 5000)])
+
+    subtree = list(category_service.get_subtree("category_0"))
+    assert len(subtree) == 5000
+    assert subtree[-1][0].name == "category_4999" and subtree[-1][1] == 4999
+
+
+def test_get_subtree_nonexistent_category(category_service):
+    with pytest.raises(HTTPException) as exc_info:
+        category_service.get_subtree("nonexistent")
+    assert exc_info.value.status_code == 404
+
+
+def test_move_category_into_own_subtree_is_rejected(category_service):
+    category_service.create_categories([
+        Category(name="root"),
+        Category(name="child", parent_name="root"),
+        Category(name="grandchild", parent_name="child"),
+    ])
+
+    for new_parent_name in ["grandchild", "child"]:
+        with pytest.raises(HTTPException) as exc_info:
+            category_service.move_category("child", new_parent_name)
+        assert exc_info.value.status_code == 400
+        assert exc_info.value.detail == "Category can not be moved into its own subtree"
+
+    assert [cat.name for cat in category_service.get_categories("root")] == ["child"]
+    assert [cat.name for cat, _ in category_service.get_subtree("root")] == ["root", "child", "grandchild"]
+
+
+def test_update_category_parent_moves_it_in_the_tree(category_service):
+    category_service.create_categories([
+        Category(name="root"),
+        Category(name="child1", parent_name="root"),
+        Category(name="child2", parent_name="root"),
+    ])
+
+    category_service.update_category("child2", Category(name="child2", parent_name="child1"))
+
+    assert [cat.name for cat in category_service.get_categories("root")] == ["child1"]
+    assert [cat.name for cat in category_service.get_categories("child1")] == ["child2"]
+
+
+def test_delete_many_root_categories(category_service):
+    names = [f"category_{i}" for i in range(2000)]
+    category_service.create_categories([Category(name=name) for name in names])
+
+    for name in names[::2]:
+        category_service.delete_category(name)
+
+    assert [cat.name for cat in category_service.get_categories()] == names[1::2]
+
+
+def test_batch_route_rejects_bodies_that_are_not_a_batch(category_service, client):
+    response = client.post("/categories/batch", content=b'{"name": "a"}\n{"name": 1}\n',
+                           headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 422 and [error["index"] for error in response.json()["detail"]] == [1]
+    for body in (b"{not json", b'{"name": "a"}'):
+        response = client.post("/categories/batch", content=body, headers={"content-type": "application/json"})
+        assert response.status_code == 422 and response.json()["detail"] == "Expected a JSON array"
+    assert client.post("/similarities/batch", content=b"[").status_code == 422
+
+    assert client.post("/categories/batch", json=[{"name": "a"}]).json() == {"created": 1}
+
+
+def test_empty_parent_name_creates_a_root(category_service, client):
+    for _ in range(2):
+        response = client.post("/categories/", json={"name": "a", "parent_name": ""})
+        assert response.status_code == 200 and response.json()["parent_name"] is None
+    assert [category.name for category in category_service.get_categories()] == ["a"]
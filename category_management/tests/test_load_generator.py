@@ -0,0 +1,65 @@
+import sys
+
+sys.path.append('..')
+
+import asyncio
+import json
+import httpx
+from category_management.benchmark import Workload
+from category_management.load_generator import LatencyHistogram, RequestMix, generate
+
+
+def test_histogram_percentiles_are_within_a_bucket():
+    histogram = LatencyHistogram()
+    for latency_ms in range(1, 1001):
+        histogram.record(latency_ms)
+
+    assert histogram.count == 1000 and histogram.max_ms == 1000
+    for fraction, exact in ((0.5, 500), (0.9, 900), (0.99, 990)):
+        assert exact <= histogram.percentile(fraction) <= exact * 1.05
+    assert histogram.percentile(1.0) == 1000
+
+    merged = LatencyHistogram()
+    merged.merge(histogram)
+    merged.merge(histogram)
+    assert merged.count == 2000 and merged.percentile(0.5) == histogram.percentile(0.5)
+
+
+def test_request_mix_is_seeded_and_deletes_only_created_pairs():
+    workload = Workload(40, 100, seed=1)
+    first, second = RequestMix(workload, 1.0, seed=1), RequestMix(workload, 1.0, seed=1)
+    requests = [first.next() for _ in range(50)]
+    assert requests == [second.next() for _ in range(50)]
+
+    assert all(request.operation != "DELETE /similarities/" for request in requests)
+    first.completed(requests[-1], 200)
+    deletes = [request for request in (first.next() for _ in range(200)) if request.method == "DELETE"]
+    assert len(deletes) == (requests[-1].method == "POST")
+
+
+def test_request_mix_does_not_create_live_pairs_again():
+    # A small catalog runs through its new pairs many times
+    mix = RequestMix(Workload(8, 10, seed=2), 1.0, seed=2)
+    for _ in range(2000):
+        request = mix.next()
+        if request.method != "GET":
+            mix.completed(request, 200)
+        pairs = [tuple(sorted(pair)) for pair in mix.created_pairs]
+        assert len(pairs) == len(set(pairs))
+
+
+def test_generates_closed_and_open_loop_load(repository, client):
+    transport = httpx.ASGITransport(app=client.app)
+
+    results = asyncio.run(generate("http://test", concurrency=4, rates=[None, 200], write_ratio=0.3, duration=0.3,
+                                   warmup=0.05, category_count=40, pair_count=100, catalog=True,
+                                   transport=transport, report=lambda line: None))
+    json.dumps(results)
+
+    closed_loop, open_loop = results["runs"]
+    assert open_loop["target_rate_per_s"] == 200
+    for run in results["runs"]:
+        assert run["count"] > 0 and run["error_rate"] == 0
+        assert run["p50_ms"] <= run["p90_ms"] <= run["p99_ms"] <= run["max_ms"]
+        assert sum(operation["count"] for operation in run["operations"]) == run["count"]
+    assert len(repository.categories) == 40
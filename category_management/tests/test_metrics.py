@@ -0,0 +1,74 @@
+import sys
+
+sys.path.append('..')
+
+from category_management.metrics import Counter, Histogram, Metrics
+# The registry the app and the services record into, which main imports as a top level module
+from category_management.main import metrics
+
+
+def test_renders_prometheus_text():
+    registry = Metrics()
+    registry.requests.inc("GET", "/categories/{name}", "200")
+    registry.requests.inc("GET", "/categories/{name}", "200")
+    registry.similarity_lookups.inc('say "hi"\n', amount=3)
+    registry.request_duration.observe(0.003, "GET", "/categories/{name}")
+    registry.request_duration.observe(20, "GET", "/categories/{name}")
+    lines = registry.render().splitlines()
+
+    assert "# TYPE category_tree_http_requests_total counter" in lines
+    assert 'category_tree_http_requests_total{method="GET",route="/categories/{name}",status="200"} 2' in lines
+    assert 'category_tree_similarity_lookups_total{lookup="say \\"hi\\"\\n"} 3' in lines
+    assert "# TYPE category_tree_http_request_duration_seconds histogram" in lines
+    labels = 'method="GET",route="/categories/{name}"'
+    assert f'category_tree_http_request_duration_seconds_bucket{{{labels},le="0.0025"}} 0' in lines
+    assert f'category_tree_http_request_duration_seconds_bucket{{{labels},le="0.005"}} 1' in lines
+    assert f'category_tree_http_request_duration_seconds_bucket{{{labels},le="10"}} 1' in lines
+    assert f'category_tree_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f'category_tree_http_request_duration_seconds_sum{{{labels}}} 20.003' in lines
+    assert f'category_tree_http_request_duration_seconds_count{{{labels}}} 2' in lines
+
+
+def test_counters_and_histograms_without_labels():
+    counter, histogram = Counter("jobs_total", "Jobs."), Histogram("job_seconds", "Jobs.", buckets=(1,))
+    counter.inc(amount=2.5)
+    histogram.observe(1)
+    assert counter.samples() == [("jobs_total", (), (), 2.5)]
+    assert histogram.samples()[:2] == [("job_seconds_bucket", ("le",), ("1",), 1),
+                                       ("job_seconds_bucket", ("le",), ("+Inf",), 1)]
+    assert histogram.count() == 1
+
+
+def test_metrics_endpoint_reports_requests_and_hot_paths(client):
+    for name in ("a", "b", "c"):
+        client.post("/categories/", json={"name": name})
+    client.post("/similarities/batch", json=[{"category_name_1": "a", "category_name_2": "b"},
+                                             {"category_name_1": "b", "category_name_2": "c"}])
+
+    requests = metrics.requests.value("GET", "/similarities/{name}", "200")
+    not_found = metrics.requests.value("GET", "/similarities/{name}", "404")
+    lookups = metrics.similarity_lookups.value("similar")
+    vertices = metrics.bfs_vertices.value("tree")
+    hits = metrics.cache_requests.value("rabbit_hole_analysis", "hit")
+
+    client.get("/similarities/a")
+    client.get("/similarities/b")
+    client.get("/similarities/missing")
+    assert client.get("/rabbit_hole_and_islands/").json()["longest_rabbit_hole"]["length"] == 2
+    client.get("/rabbit_hole_and_islands/")
+
+    assert metrics.requests.value("GET", "/similarities/{name}", "200") == requests + 2
+    assert metrics.requests.value("GET", "/similarities/{name}", "404") == not_found + 1
+    assert metrics.request_duration.count("GET", "/similarities/{name}") >= 3
+    assert metrics.similarity_lookups.value("similar") == lookups + 2
+    assert metrics.bfs_vertices.value("tree") >= vertices + 3
+    assert metrics.cache_requests.value("rabbit_hole_analysis", "hit") == hits + 1
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'category_tree_http_requests_total{method="GET",route="/similarities/{name}",status="404"}' in response.text
+    assert 'category_tree_bfs_edges_visited_total{traversal="tree"}' in response.text
+    assert 'category_tree_cache_requests_total{cache="rabbit_hole_analysis",result="miss"}' in response.text
+
+    client.get("/no/such/route")
+    assert metrics.requests.value("GET", "unmatched", "404") >= 1
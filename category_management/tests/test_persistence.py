@@ -0,0 +1,144 @@
+import sys
+
+sys.path.append('..')
+
+import os
+import pytest
+from category_management.category_service import CategoryService
+from category_management.similarity_service import SimilarityService
+from category_management.persistence import Persistence, WriteAheadLog
+from category_management.schemas import Category, DeleteMode, Similarity
+from category_management.models import InMemoryDatabase
+
+
+def open_database(directory):
+    db = InMemoryDatabase()
+    category_service, similarity_service = CategoryService(db), SimilarityService(db)
+    persistence = Persistence(db, category_service, similarity_service, str(directory))
+    persistence.open()
+    return db, category_service, similarity_service, persistence
+
+
+def state(db):
+    categories = {name: category.json for name, category in db.categories.items()}
+    tree = {parent: list(children) for parent, children in db.category_tree.items() if children}
+    return categories, tree, sorted(db.similarities)
+
+
+@pytest.fixture
+def populated(tmp_path):
+    db, category_service, similarity_service, persistence = open_database(tmp_path)
+    category_service.create_categories([
+        Category(name="root", description="Root"),
+        Category(name="child1", parent_name="root", image="child1.png"),
+        Category(name="child2", parent_name="root"),
+        Category(name="child1_1", parent_name="child1"),
+        Category(name="other"),
+    ])
+    category_service.update_category("child2", Category(name="child2", description="Second", parent_name="child1"))
+    category_service.move_category("child1_1", "other")
+    similarity_service.create_similarity(Similarity(category_name_1="root", category_name_2="other"))
+    similarity_service.create_similarities([Similarity(category_name_1="child1", category_name_2="child2"),
+                                            Similarity(category_name_1="child2", category_name_2="child1_1")])
+    similarity_service.delete_similarity(Similarity(category_name_1="root", category_name_2="other"))
+    category_service.delete_category("child1", DeleteMode.REPARENT)
+    return db, persistence
+
+
+def test_replays_the_write_ahead_log(tmp_path, populated):
+    db, persistence = populated
+    persistence.close()
+
+    reopened_db, _, _, reopened = open_database(tmp_path)
+    assert state(reopened_db) == state(db)
+    assert reopened_db.categories["child2"].parent_name == "root"
+    reopened.close()
+
+
+def test_loads_a_compacted_snapshot(tmp_path, populated):
+    db, persistence = populated
+    persistence.compact()
+    assert os.path.getsize(tmp_path / Persistence.WAL_FILE) == 0
+
+    # Writes after the snapshot are replayed from the log on top of it
+    persistence.category_service.create_category(Category(name="späť", parent_name="root"))
+    persistence.similarity_service.create_similarity(Similarity(category_name_1="späť", category_name_2="other"))
+    persistence.close()
+
+    reopened_db, _, _, reopened = open_database(tmp_path)
+    assert state(reopened_db) == state(db)
+    assert reopened_db.similarities.neighbors("other") == {"späť"}
+    reopened.close()
+
+
+def test_skips_a_torn_last_record(tmp_path, populated):
+    db, persistence = populated
+    expected = state(db)
+    persistence.close()
+
+    with open(tmp_path / Persistence.WAL_FILE, 'ab') as wal:
+        wal.write(b'[99,"create_category",{"name":"tor')
+
+    reopened_db, _, _, reopened = open_database(tmp_path)
+    assert state(reopened_db) == expected
+    reopened.close()
+
+
+def test_group_commit(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "wal.log"))
+    for index in range(100):
+        wal.append("create_category", {"name": f"category{index}"})
+    wal.sync()
+    assert wal.durable_sequence == 100
+    wal.close()
+
+    records = list(WriteAheadLog.read(str(tmp_path / "wal.log")))
+    assert [record[0] for record in records] == list(range(1, 101))
+
+
+def test_compacts_in_the_background(tmp_path):
+    db = InMemoryDatabase()
+    category_service = CategoryService(db)
+    persistence = Persistence(db, category_service, SimilarityService(db), str(tmp_path),
+                              compact_size=1, compaction_interval=0.01)
+    persistence.open()
+    category_service.create_category(Category(name="root"))
+
+    persistence.stopped.wait(0.5)
+    assert os.path.exists(tmp_path / Persistence.SNAPSHOT_FILE)
+    assert persistence.wal.size == 0
+    persistence.close()
+
+
+def test_similarities_are_read_from_the_mapped_snapshot(tmp_path, populated):
+    db, persistence = populated
+    persistence.compact()
+    persistence.close()
+
+    reopened_db, _, similarity_service, reopened = open_database(tmp_path)
+    targets = reopened_db.similarities.layers.targets
+    assert isinstance(targets, memoryview) and targets.readonly
+    assert [category.name for category in similarity_service.get_similarities("child2")] == ["child1_1"]
+
+    # Writes go to the overlay on top of the mapping, and a new snapshot can replace the mapped file
+    similarity_service.create_similarity(Similarity(category_name_1="root", category_name_2="child2"))
+    reopened.compact()
+    reopened_db.similarities.compact()
+    assert reopened_db.similarities.neighbors("child2") == {"child1_1", "root"}
+    assert reopened_db.similarities.snapshot().offsets is not targets
+    reopened.close()
+
+
+def test_only_one_process_opens_the_data_directory(tmp_path, populated):
+    db, persistence = populated
+    size = os.path.getsize(persistence.wal_path)
+    with pytest.raises(RuntimeError):
+        open_database(tmp_path)
+    assert os.path.getsize(persistence.wal_path) == size
+
+    # The lock is free again once the owner closes
+    persistence.close()
+    reopened_db, category_service, _, reopened = open_database(tmp_path)
+    assert state(reopened_db) == state(db)
+    category_service.create_category(Category(name="new"))
+    reopened.close()
@@ -0,0 +1,91 @@
+import sys
+
+sys.path.append('..')
+
+import pstats
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from category_management.profiling import Profiler
+from category_management.schemas import ProfilerMode
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+    return seconds
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = Profiler(str(tmp_path), threshold_ms=0, interval_ms=1)
+    yield profiler
+    profiler.configure(mode=ProfilerMode.OFF)
+
+
+def test_sampling_writes_folded_stacks_of_slow_requests(tmp_path, profiler):
+    profiler.configure(mode=ProfilerMode.SAMPLING, threshold_ms=30)
+    endpoint = profiler.wrap("/busy/{name}", busy_wait)
+
+    assert endpoint(0.001) == 0.001
+    assert endpoint(0.1) == 0.1
+    profiles = list(tmp_path.iterdir())
+    assert len(profiles) == 1 and profiles[0].name.endswith(".folded") and "busy_name" in profiles[0].name
+
+    lines = profiles[0].read_text().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("busy_wait (test_profiling.py" in line.split(";")[-1] for line in lines)
+
+
+def test_cprofile_follows_work_handed_to_other_threads(tmp_path, profiler):
+    profiler.configure(mode=ProfilerMode.CPROFILE)
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def endpoint():
+        return executor.submit(profiler.follow(busy_wait), 0.01).result()
+
+    assert profiler.wrap("/handed/over", endpoint)() == 0.01
+    executor.shutdown()
+    profiles = list(tmp_path.iterdir())
+    assert len(profiles) == 1 and profiles[0].suffix == ".prof"
+    assert {function for _, _, function in pstats.Stats(str(profiles[0])).stats} >= {"endpoint", "busy_wait"}
+
+
+def test_only_a_sampled_fraction_is_profiled(tmp_path, profiler):
+    profiler.configure(mode=ProfilerMode.CPROFILE, sample_rate=0)
+    profiler.wrap("/busy", busy_wait)(0.001)
+    assert profiler.written == 0
+
+    profiler.configure(mode=ProfilerMode.OFF, sample_rate=1)
+    profiler.wrap("/busy", busy_wait)(0.001)
+    assert not list(tmp_path.iterdir())
+
+
+def test_switched_at_runtime_through_the_api(tmp_path, client):
+    # The profiler the routes are wrapped with, which main imports as a top level module
+    from category_management.main import profiler
+
+    client.post("/categories/", json={"name": "a"})
+    settings = client.get("/profiler").json()
+    assert settings["mode"] == "off"
+
+    # Clients can not pick where the server writes files
+    assert client.put("/profiler", json={"directory": str(tmp_path)}).status_code == 422
+    assert client.get("/profiler").json() == settings
+
+    try:
+        profiler.configure(directory=str(tmp_path))
+        response = client.put("/profiler", json={"mode": "cprofile", "threshold_ms": 0})
+        assert response.json() == {**settings, "mode": "cprofile", "threshold_ms": 0, "directory": str(tmp_path)}
+        assert client.put("/profiler", json={"sample_rate": 2}).status_code == 422
+
+        client.get("/similarities/a")
+        client.get("/rabbit_hole_and_islands/")
+        similarities, rabbit_holes = sorted(tmp_path.iterdir(), key=lambda profile: profile.name.split("-")[1])
+        assert "similarities_name" in similarities.name and "rabbit_hole_and_islands" in rabbit_holes.name
+        # The analysis runs on the script's own worker thread, which the profile follows
+        assert "analyse_rabbit_holes" in {function for _, _, function in pstats.Stats(str(rabbit_holes)).stats}
+    finally:
+        profiler.configure(mode=ProfilerMode.OFF, threshold_ms=settings["threshold_ms"],
+                           directory=settings["directory"])
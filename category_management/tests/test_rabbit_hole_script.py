@@ -3,17 +3,21 @@ import sys
 sys.path.append('..')
 
 import pytest
-from category_management.rabbit_hole_script import RabbitHoleScript
+from fastapi import HTTPException
+from category_management.benchmark import Workload
+from category_management.rabbit_hole_script import IslandBitsets, RabbitHoleScript, metrics
+from category_management.landmarks import LandmarkIndex
 from category_management.category_service import CategoryService
 from category_management.similarity_service import SimilarityService
 from category_management.schemas import Category, Similarity
-from category_management.models import InMemoryDatabase
+import random
+import threading
 import time
 
 
 @pytest.fixture
-def db():
-    return InMemoryDatabase()
+def db(repository):
+    return repository
 
 
 @pytest.fixture
@@ -44,6 +48,17 @@ def test_create_adjacency_list_optimized(category_service, similarity_service, r
     assert adjacency_list == expected_adjacency_list
 
 
+def test_adjacency_list_is_not_changed_by_later_writes(category_service, similarity_service, rabbit_hole_script):
+    init_simple_example(category_service, similarity_service)
+    adjacency_list = rabbit_hole_script.create_adjacency_list_optimized()
+
+    similarity_service.delete_similarity(Similarity(category_name_1="B", category_name_2="C"))
+    similarity_service.create_similarity(Similarity(category_name_1="C", category_name_2="D"))
+    assert dict(adjacency_list) == {"A": {"B", "D"}, "B": {"A", "C", "D"}, "C": {"B"}, "D": {"A", "B"}}
+    assert len(rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list)[0]) == 3
+    assert rabbit_hole_script.create_adjacency_list_optimized()["C"] == {"D"}
+
+
 def test_bfs(category_service, similarity_service, rabbit_hole_script):
     init_simple_example(category_service, similarity_service)
 
@@ -59,6 +74,25 @@ def test_bfs(category_service, similarity_service, rabbit_hole_script):
     assert path == expected_paths
 
 
+def test_bfs_rebuilds_one_path_per_deepest_vertex(rabbit_hole_script):
+    adjacency_list = {
+        "A": {"B", "C"},
+        "B": {"A", "D"},
+        "C": {"A", "D"},
+        "D": {"B", "C", "E", "F"},
+        "E": {"D"},
+        "F": {"D"},
+    }
+
+    length, paths = rabbit_hole_script.bfs_deepest_paths("A", adjacency_list)
+
+    assert length == 3
+    assert sorted(path[-1] for path in paths) == ["E", "F"]
+    for path in paths:
+        assert path[0] == "A" and path[2] == "D"
+        assert all(b in adjacency_list[a] for a, b in zip(path, path[1:]))
+
+
 def test_find_longest_rabbit_hole_optimized(category_service, similarity_service, rabbit_hole_script):
     init_simple_example(category_service, similarity_service)
 
@@ -114,6 +148,101 @@ def test_find_longest_rabbit_hole_with_large_data(category_service, similarity_s
         f"Expected exactly 1 longest path, but got {len(longest_paths)} paths"
 
 
+def test_longest_rabbit_hole_keeps_path_order(category_service, similarity_service, rabbit_hole_script):
+    _, _, expected_longest_path = generate_long_path_example(category_service, similarity_service)
+
+    adjacency_list = rabbit_hole_script.create_adjacency_list_optimized()
+    length, path = rabbit_hole_script.find_longest_rabbit_hole(adjacency_list)
+
+    assert length == 9999
+    assert path in (expected_longest_path, expected_longest_path[::-1])
+
+    longest_paths = rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list)
+    assert len(longest_paths) == 1
+    assert longest_paths[0] in (expected_longest_path, expected_longest_path[::-1])
+
+
+def test_find_longest_rabbit_hole_is_exact_across_islands(category_service, similarity_service,
+                                                          rabbit_hole_script):
+    # A star and a five-cycle with a chord - both islands have longest rabbit holes of length 2
+    for name in ["hub", "leaf1", "leaf2", "leaf3", "P1", "P2", "P3", "P4", "P5"]:
+        category_service.create_category(Category(name=name))
+    for leaf in ["leaf1", "leaf2", "leaf3"]:
+        similarity_service.create_similarity(Similarity(category_name_1="hub", category_name_2=leaf))
+    for i in range(1, 5):
+        similarity_service.create_similarity(Similarity(category_name_1=f"P{i}", category_name_2=f"P{i + 1}"))
+    similarity_service.create_similarity(Similarity(category_name_1="P5", category_name_2="P1"))
+    similarity_service.create_similarity(Similarity(category_name_1="P3", category_name_2="P4"))
+
+    adjacency_list = rabbit_hole_script.create_adjacency_list_optimized()
+    length, path = rabbit_hole_script.find_longest_rabbit_hole(adjacency_list)
+
+    assert length == 2
+    assert path[0] in adjacency_list and all(b in adjacency_list[a] for a, b in zip(path, path[1:]))
+    assert {frozenset((path[0], path[-1])) for path in
+            rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list)} == {
+        frozenset(("leaf1", "leaf2")), frozenset(("leaf1", "leaf3")), frozenset(("leaf2", "leaf3")),
+        frozenset(("P1", "P3")), frozenset(("P1", "P4")), frozenset(("P2", "P4")), frozenset(("P2", "P5")),
+        frozenset(("P3", "P5")),
+    }
+
+
+def test_longest_rabbit_hole_at_benchmark_scale_expands_few_categories(db, rabbit_hole_script):
+    workload = Workload(2000, 20000, seed=42)
+    for similarity in workload.similarities(0, 20000):
+        db.similarities.add((similarity.category_name_1, similarity.category_name_2))
+    graph = db.similarity_graph()
+
+    # One search per category would expand millions of categories on this small-world graph
+    expanded = metrics.bfs_vertices.value("bitset")
+    length, path = rabbit_hole_script.find_longest_rabbit_hole(graph)
+    assert metrics.bfs_vertices.value("bitset") - expanded < 25 * 2000
+    assert length == 4 and len(path) == 5 and all(b in graph[a] for a, b in zip(path, path[1:]))
+    distances, _ = rabbit_hole_script.bfs_tree(path[0], graph)
+    assert distances[path[-1]] == length
+
+
+def test_analysis_runs_while_similarities_are_written(db, category_service, similarity_service, rabbit_hole_script):
+    names = [f"Category_{i}" for i in range(200)]
+    category_service.create_categories([Category(name=name) for name in names])
+    errors = []
+    writes_done = threading.Event()
+
+    def write():
+        try:
+            for _ in range(5000):
+                similarity = Similarity(category_name_1=random.choice(names), category_name_2=random.choice(names))
+                if random.random() < 0.7:
+                    similarity_service.create_similarity(similarity)
+                else:
+                    similarity_service.delete_similarity(similarity)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            writes_done.set()
+
+    def read():
+        try:
+            while not writes_done.is_set():
+                graph = db.similarities.snapshot()
+                length, path = rabbit_hole_script.find_longest_rabbit_hole(graph)
+                assert len(path) == (length + 1 if len(graph) else 0)
+                similarity_service.get_similarities(random.choice(names))
+                similarity_service.get_rabbit_islands()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    graph = db.similarities.snapshot()
+    assert sorted((graph.names[a], graph.names[b]) for a in graph for b in graph[a]) == sorted(db.similarities)
+
+
 def init_simple_example(category_service, similarity_service):
     categories = [
         Category(name="root"),
@@ -153,3 +282,244 @@ def generate_long_path_example(category_service, similarity_service):
     expected_longest_path = [f"Category_{i}" for i in range(1, 10001)]
 
     return categories, similarities, expected_longest_path
+
+
+def test_rabbit_hole_and_islands_is_cached_until_similarities_change(category_service, similarity_service,
+                                                                     rabbit_hole_script):
+    init_simple_example(category_service, similarity_service)
+
+    result = rabbit_hole_script.find_longest_rabbit_hole_and_islands()
+    assert result["longest_rabbit_hole"]["length"] == 2
+    assert [sorted(island) for island in result["rabbit_islands"]] == [["A", "B", "C", "D"]]
+    assert rabbit_hole_script.find_longest_rabbit_hole_and_islands() is result
+
+    category_service.create_category(Category(name="E"))
+    assert rabbit_hole_script.find_longest_rabbit_hole_and_islands() is result
+
+    # While the analysis after a write runs, polls get the last completed result
+    running = threading.Event()
+    analyse_rabbit_holes = rabbit_hole_script.analyse_rabbit_holes
+    rabbit_hole_script.analyse_rabbit_holes = lambda version: running.wait() and analyse_rabbit_holes(version)
+    similarity_service.create_similarity(Similarity(category_name_1="C", category_name_2="E"))
+    assert rabbit_hole_script.find_longest_rabbit_hole_and_islands() is result
+    assert rabbit_hole_script.find_longest_rabbit_hole_and_islands() is result
+
+    running.set()
+    rabbit_hole_script.analysis[1].result()
+    updated_result = rabbit_hole_script.find_longest_rabbit_hole_and_islands()
+    assert updated_result["version"] > result["version"]
+    assert updated_result["longest_rabbit_hole"]["length"] == 3
+
+
+def test_failed_rabbit_hole_analysis_is_retried(category_service, similarity_service, rabbit_hole_script):
+    init_simple_example(category_service, similarity_service)
+    rabbit_hole_script.engine = "gpu"
+    with pytest.raises(ValueError):
+        rabbit_hole_script.find_longest_rabbit_hole_and_islands()
+
+    rabbit_hole_script.engine = "python"
+    assert rabbit_hole_script.find_longest_rabbit_hole_and_islands()["longest_rabbit_hole"]["length"] == 2
+
+
+def test_use_engine_rejects_engines_that_can_not_run(rabbit_hole_script, monkeypatch):
+    with pytest.raises(ValueError):
+        rabbit_hole_script.use_engine("gpu")
+    # Without numpy and scipy the sparse engine fails when it is picked, not on the first analysis
+    monkeypatch.setitem(sys.modules, "sparse_graph", None)
+    with pytest.raises(ImportError):
+        rabbit_hole_script.use_engine("sparse")
+    assert rabbit_hole_script.engine == "python"
+
+    rabbit_hole_script.use_engine("parallel")
+    assert rabbit_hole_script.engine == "parallel"
+
+
+def test_parallel_engine_merges_islands_like_the_python_engine(db, similarity_service):
+    random.seed(5)
+    # Many islands of different sizes, several of them holding longest rabbit holes
+    for island in range(30):
+        size = random.randint(2, 60)
+        names = [f"I{island}_{index}" for index in range(size)]
+        db.add_categories([Category(name=name) for name in names])
+        similarity_service.create_similarities(
+            [Similarity(category_name_1=names[index], category_name_2=names[random.randrange(index)])
+             for index in range(1, size)])
+
+    rabbit_hole_script = RabbitHoleScript(db, engine="parallel", workers=2)
+    try:
+        graph = db.similarity_graph()
+        assert rabbit_hole_script.find_longest_rabbit_hole(graph) == \
+            rabbit_hole_script.find_longest_rabbit_hole(graph, "python")
+        assert rabbit_hole_script.find_longest_rabbit_hole_optimized(graph) == \
+            rabbit_hole_script.find_longest_rabbit_hole_optimized(graph, "python")
+
+        adjacency_list = rabbit_hole_script.create_adjacency_list_optimized()
+        assert {frozenset((path[0], path[-1])) for path in
+                rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list)} == \
+            {frozenset((path[0], path[-1])) for path in
+             rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list, "python")}
+        assert rabbit_hole_script.find_longest_rabbit_hole_optimized({}) == []
+        assert rabbit_hole_script.find_longest_rabbit_hole_and_islands()["longest_rabbit_hole"]["length"] == \
+            rabbit_hole_script.find_longest_rabbit_hole(graph, "python")[0]
+    finally:
+        rabbit_hole_script.process_executor.shutdown()
+
+
+def test_bidirectional_bfs_finds_shortest_rabbit_holes(rabbit_hole_script):
+    random.seed(9)
+    for _ in range(50):
+        adjacency_list = {vertex: set() for vertex in range(40)}
+        for _ in range(45):
+            vertex_1, vertex_2 = random.randrange(40), random.randrange(40)
+            adjacency_list[vertex_1].add(vertex_2)
+            adjacency_list[vertex_2].add(vertex_1)
+
+        for source in range(0, 40, 7):
+            distances, _ = rabbit_hole_script.bfs_tree(source, adjacency_list)
+            for target in range(40):
+                path = rabbit_hole_script.bidirectional_bfs(source, target, adjacency_list)
+                if target not in distances:
+                    assert path is None
+                    continue
+                assert len(path) - 1 == distances[target] and path[0] == source and path[-1] == target
+                assert all(b in adjacency_list[a] for a, b in zip(path, path[1:]))
+
+
+def test_find_rabbit_hole_follows_similarity_writes(category_service, similarity_service, rabbit_hole_script,
+                                                    monkeypatch):
+    init_simple_example(category_service, similarity_service)
+    category_service.create_category(Category(name="E"))
+    # Queries read the similar names of the repository and never wait for a graph snapshot
+    monkeypatch.setattr(rabbit_hole_script.repository, "similarity_graph", None)
+
+    assert rabbit_hole_script.find_rabbit_hole("C", "A") == {"length": 2, "categories": ["C", "B", "A"]}
+    assert rabbit_hole_script.find_rabbit_hole("A", "C") == {"length": 2, "categories": ["A", "B", "C"]}
+    assert rabbit_hole_script.find_rabbit_hole("E", "E") == {"length": 0, "categories": ["E"]}
+
+    with pytest.raises(HTTPException) as e:
+        rabbit_hole_script.find_rabbit_hole("A", "E")
+    assert e.value.status_code == 404 and "islands" in e.value.detail
+    with pytest.raises(HTTPException):
+        rabbit_hole_script.find_rabbit_hole("A", "missing")
+
+    similarity_service.create_similarity(Similarity(category_name_1="E", category_name_2="C"))
+    assert rabbit_hole_script.find_rabbit_hole("A", "E")["categories"] == ["A", "B", "C", "E"]
+    similarity_service.create_similarity(Similarity(category_name_1="E", category_name_2="A"))
+    assert rabbit_hole_script.find_rabbit_hole("C", "A")["length"] == 2
+    assert rabbit_hole_script.find_rabbit_hole("A", "E")["categories"] == ["A", "E"]
+    similarity_service.delete_similarity(Similarity(category_name_1="E", category_name_2="A"))
+    similarity_service.delete_similarity(Similarity(category_name_1="E", category_name_2="C"))
+    with pytest.raises(HTTPException):
+        rabbit_hole_script.find_rabbit_hole("A", "E")
+
+
+def test_rabbit_hole_route(category_service, similarity_service, client):
+    init_simple_example(category_service, similarity_service)
+    response = client.get("/rabbit_holes/A/C")
+    assert response.status_code == 200 and response.json() == {"length": 2, "categories": ["A", "B", "C"]}
+    assert client.get("/rabbit_holes/A/missing").status_code == 404
+
+    response = client.post("/rabbit_holes/distances?exact=true",
+                           json=[{"category_name_1": "C", "category_name_2": "D"}])
+    assert response.status_code == 200 and response.json()[0]["distance"] == 2
+
+
+def test_landmark_bounds_and_exact_distances_match_bfs(rabbit_hole_script):
+    random.seed(13)
+    for landmark_count in (1, 3, 8):
+        adjacency_list = {}
+        for _ in range(70):
+            vertex_1, vertex_2 = random.randrange(60), random.randrange(60)
+            adjacency_list.setdefault(vertex_1, set()).add(vertex_2)
+            adjacency_list.setdefault(vertex_2, set()).add(vertex_1)
+        # Islands of one pair never get a landmark
+        for vertex_1, vertex_2 in ((100, 101), (102, 103)):
+            adjacency_list[vertex_1], adjacency_list[vertex_2] = {vertex_2}, {vertex_1}
+        graph = rabbit_hole_script.csr_graph(adjacency_list)
+        index = LandmarkIndex(graph, landmark_count)
+        assert 0 < len(index.landmarks) <= landmark_count
+
+        for source in graph:
+            distances, _ = rabbit_hole_script.bfs_tree(source, graph)
+            for target in graph:
+                bounds = index.bounds(source, target)
+                if target not in distances:
+                    assert bounds is None and index.distance(source, target) is None
+                    continue
+                lower, upper = bounds
+                assert lower <= distances[target] and (upper is None or distances[target] <= upper)
+                assert index.distance(source, target) == distances[target]
+
+
+def test_rabbit_hole_distances_follow_similarity_writes(category_service, similarity_service, rabbit_hole_script):
+    generate_long_path_example(category_service, similarity_service)
+    category_service.create_category(Category(name="alone"))
+    pairs = [("Category_1", "Category_10000"), ("Category_20", "Category_30"), ("Category_5", "alone"),
+             ("alone", "alone")]
+
+    distances = rabbit_hole_script.rabbit_hole_distances(pairs, exact=True)
+    assert [distance["distance"] for distance in distances] == [9999, 10, None, 0]
+    # A landmark at an end of the path makes the lower bounds exact
+    assert all(distance["lower"] == distance["distance"] for distance in distances)
+    assert distances[1]["upper"] >= 10 and distances[2]["upper"] is None
+    assert rabbit_hole_script.landmark_index() is rabbit_hole_script.landmarks
+
+    assert not any(distance["approximate"] for distance in distances)
+
+    # While the index is rebuilt after a write, bounds come from the previous one and exact distances from a search
+    building = threading.Event()
+    keep_landmarks = rabbit_hole_script.keep_landmarks
+    rabbit_hole_script.keep_landmarks = lambda version: building.wait() and keep_landmarks(version)
+    similarity_service.create_similarity(Similarity(category_name_1="Category_1", category_name_2="Category_10000"))
+    distances = rabbit_hole_script.rabbit_hole_distances(pairs, exact=True)
+    assert [distance["distance"] for distance in distances] == [1, 10, None, 0]
+    assert distances[0]["approximate"] and distances[0]["lower"] == 9999
+
+    building.set()
+    rabbit_hole_script.landmarks_build[1].result()
+    distances = rabbit_hole_script.rabbit_hole_distances(pairs[:1])
+    assert distances[0]["lower"] <= 1 <= distances[0]["upper"] and "distance" not in distances[0]
+    assert not distances[0]["approximate"]
+
+    with pytest.raises(HTTPException) as e:
+        rabbit_hole_script.rabbit_hole_distances([("Category_1", "missing")])
+    assert e.value.status_code == 422 and e.value.detail[0]["index"] == 0
+
+
+def test_rabbit_hole_distances_of_categories_whose_similarities_were_deleted(category_service, similarity_service,
+                                                                             rabbit_hole_script):
+    init_simple_example(category_service, similarity_service)
+    category_service.create_category(Category(name="E"))
+    category_service.create_category(Category(name="F"))
+    similarity_service.create_similarity(Similarity(category_name_1="E", category_name_2="F"))
+    similarity_service.delete_similarity(Similarity(category_name_1="E", category_name_2="F"))
+
+    distances = rabbit_hole_script.rabbit_hole_distances([("E", "F"), ("E", "A"), ("E", "E")], exact=True)
+    assert [(distance["lower"], distance["upper"], distance["distance"]) for distance in distances] == [
+        (None, None, None), (None, None, None), (0, 0, 0)]
+
+
+def test_rabbit_hole_skips_categories_whose_similarities_were_deleted(category_service, similarity_service,
+                                                                      rabbit_hole_script):
+    init_simple_example(category_service, similarity_service)
+    category_service.create_category(Category(name="E"))
+    category_service.create_category(Category(name="F"))
+    similarity_service.create_similarity(Similarity(category_name_1="E", category_name_2="F"))
+    rabbit_hole_script.repository.similarities.compact()
+    similarity_service.delete_similarity(Similarity(category_name_1="E", category_name_2="F"))
+
+    # E and F keep their interned ids with no similar ids left
+    similarity_service.create_similarity(Similarity(category_name_1="C", category_name_2="D"))
+    assert rabbit_hole_script.shortest_rabbit_hole("E", "F") is None
+    # A-B-C and A-D-C are both shortest
+    assert rabbit_hole_script.shortest_rabbit_hole("A", "C") in (["A", "B", "C"], ["A", "D", "C"])
+
+
+def test_islands_that_are_not_connected_do_not_hang_the_search(rabbit_hole_script):
+    # Adjacency read while similarities change can be one-directional, or split an island in two
+    one_directional = {"A": {"B"}, "B": set(), "C": {"A"}}
+    assert IslandBitsets(list(one_directional), one_directional).levels(0) == [0b1, 0b10]
+
+    split = {"A": {"B"}, "B": {"A", "C"}, "C": {"B"}, "D": {"E"}, "E": {"D"}}
+    assert rabbit_hole_script.island_longest_paths(list(split), split) == (2, [["A", "B", "C"]])
+    rabbit_hole_script.island_longest_paths(list(one_directional), one_directional)
@@ -0,0 +1,48 @@
+import sys
+
+sys.path.append('..')
+
+import json
+from category_management.schemas import Category, CategoryRecord
+
+
+def test_record_json_matches_the_category_model():
+    category = Category(name="späť \"quoted\"", description="Ünïcode ✓", parent_name="root")
+    record = CategoryRecord.from_category(category)
+
+    assert record.json == category.model_dump_json().encode()
+    assert record.fields_json == category.model_dump_json(exclude={"children"}).encode()
+    assert record.json is record.json
+
+
+def test_replace_returns_a_new_record():
+    record = CategoryRecord("root", "Original")
+    record.json
+    updated = record.replace(description="Updated", children=[])
+
+    assert record.description == "Original" and json.loads(record.json)["description"] == "Original"
+    assert updated == CategoryRecord("root", "Updated") and json.loads(updated.json)["description"] == "Updated"
+
+
+def test_routes_send_the_category_model_json(client):
+    root = {"name": "root", "description": "Root", "image": None, "parent_name": None, "children": []}
+    child = {**root, "name": "child", "description": "Child", "parent_name": "root"}
+
+    assert client.post("/categories/", json=root).json() == root
+    assert client.post("/categories/", json=child).json() == child
+    client.post("/similarities/", json={"category_name_1": "root", "category_name_2": "child"})
+
+    response = client.get("/categories/root")
+    assert response.headers["content-type"] == "application/json" and response.json() == root
+    assert client.get("/categories/").json() == [root]
+    assert client.get("/categories/", params={"parent_name": "root"}).json() == [child]
+    assert client.get("/categories/", params={"depth": 5}).json() == []
+    assert client.get("/similarities/root").json() == [child]
+    assert sorted(client.get("/rabbit_islands/root").json(), key=lambda category: category["name"]) == [child, root]
+    assert client.get("/categories/missing").status_code == 404
+
+    updated = client.put("/categories/child", json={"name": "child", "description": "Updated"}).json()
+    assert updated == {**child, "description": "Updated"}
+    assert client.patch("/categories/child/move").json() == {**updated, "parent_name": None}
+    assert [json.loads(line) for line in client.get("/categories/root/subtree").text.splitlines()] == [
+        {"depth": 0, "category": {key: value for key, value in root.items() if key != "children"}}]
@@ -2,6 +2,7 @@ import sys
 
 sys.path.append('..')
 
+import json
 import pytest
 from fastapi import HTTPException
 from category_management.similarity_service import SimilarityService
@@ -137,7 +138,7 @@ def test_create_multiple_similarities(similarity_service, populate_categories):
     ]
 
     for similarity_pair in expected_similarities:
-        assert similarity_pair in similarity_service.similarities
+        assert similarity_pair in similarity_service.repository.similarities
 
 
 def test_get_similarities_large_dataset_add_inverted_similarity_succeeds(similarity_service, populate_categories,
@@ -185,3 +186,124 @@ def test_get_similarities_large_dataset_category_not_found(similarity_service, p
         similarity_service.get_similarities("non_existing_category")
     assert exc_info.value.status_code == 404
     assert exc_info.value.detail == "Category not found"
+
+
+def test_similarity_index_is_bidirectional_and_drops_empty_entries(similarity_service, populate_categories):
+    similarity_service.create_similarity(Similarity(category_name_1="child1", category_name_2="child2"))
+
+    assert ("child1", "child2") in similarity_service.repository.similarities
+    assert ("child2", "child1") in similarity_service.repository.similarities
+    assert [category.name for category in similarity_service.get_similarities("child2")] == ["child1"]
+
+    similarity_service.delete_similarity(Similarity(category_name_1="child2", category_name_2="child1"))
+
+    assert len(similarity_service.repository.similarities) == 0
+    assert similarity_service.repository.similarities.adjacency == {}
+
+
+def test_rabbit_islands_follow_created_and_deleted_similarities(similarity_service, populate_categories):
+    for category_name_1, category_name_2 in [("child1", "child2"), ("child2", "child1_1"), ("category3", "category4")]:
+        similarity_service.create_similarity(
+            Similarity(category_name_1=category_name_1, category_name_2=category_name_2))
+
+    assert sorted(category.name for category in similarity_service.get_rabbit_island("child1_1")) == \
+           ["child1", "child1_1", "child2"]
+    assert sorted(sorted(island) for island in similarity_service.get_rabbit_islands()) == \
+           [["category3", "category4"], ["child1", "child1_1", "child2"]]
+
+    similarity_service.delete_similarity(Similarity(category_name_1="child2", category_name_2="child1_1"))
+
+    assert sorted(sorted(island) for island in similarity_service.get_rabbit_islands()) == \
+           [["category3", "category4"], ["child1", "child2"]]
+    assert [category.name for category in similarity_service.get_rabbit_island("child1_1")] == ["child1_1"]
+
+
+def test_get_rabbit_island_category_not_found(similarity_service, populate_categories):
+    with pytest.raises(HTTPException) as exc_info:
+        similarity_service.get_rabbit_island("non_existing_category")
+    assert exc_info.value.status_code == 404
+    assert exc_info.value.detail == "Category not found"
+
+
+def test_similarity_index_compacts_overlay_into_csr_arrays(similarity_service, populate_categories, monkeypatch):
+    monkeypatch.setattr(similarity_service.repository.similarities, "COMPACTION_MIN_OVERLAY", 4)
+    names = ["category3", "category4", "category5", "category6", "category7"]
+    for name_1, name_2 in zip(names, names[1:]):
+        similarity_service.create_similarity(Similarity(category_name_1=name_1, category_name_2=name_2))
+
+    snapshot = similarity_service.repository.similarities.snapshot()
+    similarity_service.delete_similarity(Similarity(category_name_1="category4", category_name_2="category5"))
+    similarity_service.create_similarity(Similarity(category_name_1="category3", category_name_2="category7"))
+
+    assert similarity_service.repository.similarities.overlay_size <= 4
+    assert sorted(category.name for category in similarity_service.get_similarities("category3")) == \
+           ["category4", "category7"]
+    assert ("category4", "category5") not in similarity_service.repository.similarities
+
+    # Snapshots keep the graph they were taken from
+    vertex = snapshot.vertex("category4")
+    assert sorted(snapshot.names[neighbor] for neighbor in snapshot[vertex]) == ["category3", "category5"]
+    assert similarity_service.repository.similarities.snapshot() is not snapshot
+
+
+def test_create_similarities_batch_is_all_or_nothing(similarity_service, populate_categories):
+    with pytest.raises(HTTPException) as exc_info:
+        similarity_service.create_similarities([
+            Similarity(category_name_1="child1", category_name_2="child2"),
+            Similarity(category_name_1="child1", category_name_2="non_existing_category"),
+        ])
+    assert exc_info.value.status_code == 422
+    assert exc_info.value.detail == [{"index": 1, "detail": "One or both categories not found"}]
+    assert len(similarity_service.repository.similarities) == 0
+
+    result = similarity_service.create_similarities([
+        Similarity(category_name_1="child1", category_name_2="child2"),
+        Similarity(category_name_1="child2", category_name_2="child1_1"),
+    ])
+    assert result == {"ok": True, "created": 2}
+    assert sorted(category.name for category in similarity_service.get_similarities("child2")) == \
+           ["child1", "child1_1"]
+
+
+def test_similarity_neighborhood_gives_hop_distances(similarity_service, populate_categories, populate_similarities):
+    neighborhood = similarity_service.get_similarity_neighborhood("category3", 3)
+    assert {category.name: hops for category, hops in neighborhood} == {
+        "category4": 1, "category20": 1, "category5": 2, "category19": 2, "category6": 3, "category18": 3}
+
+    # The limit stops the search, and the nearest categories come first
+    neighborhood = list(similarity_service.get_similarity_neighborhood("category3", 9, limit=3))
+    assert [hops for _, hops in neighborhood] == [1, 1, 2]
+    assert list(similarity_service.get_similarity_neighborhood("root", 2)) == []
+    with pytest.raises(HTTPException) as exc:
+        similarity_service.get_similarity_neighborhood("missing", 2)
+    assert exc.value.status_code == 404
+
+
+def test_similarity_neighborhood_reads_writes_without_a_graph_snapshot(similarity_service, populate_categories,
+                                                                       populate_similarities, monkeypatch):
+    similarities = similarity_service.repository.similarities
+    monkeypatch.setattr(similarities, "snapshot", None)
+    similarity_service.create_similarity(Similarity(category_name_1="category3", category_name_2="child1"))
+
+    neighborhood = similarity_service.get_similarity_neighborhood("child2", 2)
+    assert {category.name: hops for category, hops in neighborhood} == {"child1": 1, "category3": 2}
+    assert similarities.overlay_size > 0
+
+def test_similarity_neighborhood_route_sends_json_or_ndjson(client):
+    for name in ("A", "B", "C", "D"):
+        client.post("/categories/", json={"name": name})
+    for pair in (("A", "B"), ("B", "C"), ("C", "D")):
+        client.post("/similarities/", json={"category_name_1": pair[0], "category_name_2": pair[1]})
+
+    assert [category["name"] for category in client.get("/similarities/A").json()] == ["B"]
+    neighborhood = client.get("/similarities/A", params={"hops": 2}).json()
+    assert [(item["hops"], item["category"]["name"]) for item in neighborhood] == [(1, "B"), (2, "C")]
+    assert [item["category"]["name"] for item in client.get("/similarities/A", params={"hops": 3, "limit": 2}).json()
+            ] == ["B", "C"]
+
+    response = client.get("/similarities/D", params={"hops": 3, "stream": True})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [(item["hops"], item["category"]["name"]) for item in map(json.loads, response.text.splitlines())] == [
+        (1, "C"), (2, "B"), (3, "A")]
+    assert client.get("/similarities/A", params={"hops": 0}).status_code == 422
+    assert client.get("/similarities/missing", params={"hops": 2}).status_code == 404
@@ -0,0 +1,92 @@
+import sys
+
+sys.path.append('..')
+
+import random
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from category_management.rabbit_hole_script import RabbitHoleScript
+from category_management.models import InMemoryDatabase
+from category_management.sparse_graph import SparseGraph
+
+
+@pytest.fixture
+def db():
+    return InMemoryDatabase()
+
+
+@pytest.fixture
+def rabbit_hole_script(db):
+    return RabbitHoleScript(db)
+
+
+def random_adjacency_list(rng, vertex_count, pair_count):
+    adjacency_list = {}
+    for _ in range(pair_count):
+        name_1, name_2 = f"C{rng.randrange(vertex_count)}", f"C{rng.randrange(vertex_count)}"
+        adjacency_list.setdefault(name_1, set()).add(name_2)
+        adjacency_list.setdefault(name_2, set()).add(name_1)
+    return adjacency_list
+
+
+def ends(paths):
+    return {frozenset((path[0], path[-1])) for path in paths}
+
+
+@pytest.mark.parametrize("vertex_count, pair_count", [(12, 10), (40, 45), (200, 220), (300, 900)])
+def test_sparse_engine_agrees_with_python_engine(rabbit_hole_script, vertex_count, pair_count):
+    rng = random.Random(vertex_count)
+    for _ in range(10):
+        adjacency_list = random_adjacency_list(rng, vertex_count, pair_count)
+
+        python_paths = rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list, "python")
+        sparse_paths = rabbit_hole_script.find_longest_rabbit_hole_optimized(adjacency_list, "sparse")
+        assert ends(sparse_paths) == ends(python_paths)
+        for path in sparse_paths:
+            assert len(path) == len(python_paths[0])
+            assert all(b in adjacency_list[a] for a, b in zip(path, path[1:]))
+
+        length, path = rabbit_hole_script.find_longest_rabbit_hole(adjacency_list, "sparse")
+        assert length == rabbit_hole_script.find_longest_rabbit_hole(adjacency_list, "python")[0] == len(path) - 1
+
+        python_islands = rabbit_hole_script.find_rabbit_islands_optimized(adjacency_list, "python")
+        sparse_islands = rabbit_hole_script.find_rabbit_islands_optimized(adjacency_list, "sparse")
+        assert [sorted(island) for island in sparse_islands] == [sorted(island) for island in python_islands]
+
+
+def test_bulk_eccentricities_match_one_bfs_per_category(rabbit_hole_script):
+    # 150 categories fill more than one word of sources
+    adjacency_list = random_adjacency_list(random.Random(7), 150, 200)
+    graph = SparseGraph(adjacency_list)
+
+    expected = [max(rabbit_hole_script.bfs_tree(name, adjacency_list)[0].values()) for name in graph.keys]
+    assert graph.eccentricities().tolist() == expected
+    assert graph.diameter() == max(expected)
+
+
+def test_sparse_engine_runs_on_the_similarity_graph(db, rabbit_hole_script):
+    for index in range(1000):
+        db.similarities.add((f"P{index}", f"P{index + 1}"))
+    db.similarities.add(("X", "Y"))
+    graph = db.similarity_graph()
+
+    length, path = rabbit_hole_script.find_longest_rabbit_hole(graph, "sparse")
+    assert length == 1000
+    assert [graph.names[vertex] for vertex in path] in ([f"P{i}" for i in range(1001)],
+                                                        [f"P{i}" for i in range(1000, -1, -1)])
+    assert sorted(len(island) for island in rabbit_hole_script.find_rabbit_islands_optimized(graph, "sparse")) == [
+        2, 1001]
+
+
+def test_engine_is_picked_per_script_or_per_call(db):
+    rabbit_hole_script = RabbitHoleScript(db, engine="sparse")
+    adjacency_list = {"A": {"B"}, "B": {"A", "C"}, "C": {"B"}}
+
+    assert rabbit_hole_script.find_longest_rabbit_hole(adjacency_list) == (2, ["A", "B", "C"])
+    assert rabbit_hole_script.find_rabbit_islands_optimized(adjacency_list, "python") == [["A", "B", "C"]]
+    assert rabbit_hole_script.find_longest_rabbit_hole_optimized({}) == []
+    with pytest.raises(ValueError):
+        rabbit_hole_script.find_rabbit_islands_optimized(adjacency_list, "gpu")
@@ -0,0 +1,158 @@
+import sys
+
+sys.path.append('..')
+
+import random
+import pytest
+from fastapi import HTTPException
+from category_management.category_service import CategoryService
+from category_management.similarity_service import SimilarityService
+from category_management.rabbit_hole_script import RabbitHoleScript
+from category_management.sqlite_repository import SqliteRepository
+from category_management.schemas import Category, DeleteMode, Similarity
+from category_management.models import InMemoryDatabase
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = SqliteRepository(str(tmp_path / "categories.db"))
+    yield repository
+    repository.close()
+
+
+@pytest.fixture
+def category_service(repository):
+    return CategoryService(repository)
+
+
+@pytest.fixture
+def similarity_service(repository):
+    return SimilarityService(repository)
+
+
+@pytest.fixture
+def populated(category_service, similarity_service):
+    category_service.create_categories([
+        Category(name="root"),
+        Category(name="child1", parent_name="root"),
+        Category(name="child2", parent_name="root"),
+        Category(name="child1_1", parent_name="child1"),
+        Category(name="child1_2", parent_name="child1"),
+        Category(name="child2_1", parent_name="child2"),
+        Category(name="other"),
+    ])
+    similarity_service.create_similarities([
+        Similarity(category_name_1="child1", category_name_2="child2"),
+        Similarity(category_name_1="child2_1", category_name_2="child2"),
+        Similarity(category_name_1="other", category_name_2="child1_1"),
+    ])
+
+
+def names(categories):
+    return [category.name for category in categories]
+
+
+def test_tree_queries(category_service, populated):
+    assert names(category_service.get_categories()) == ["root", "other"]
+    assert names(category_service.get_categories(parent_name="child1")) == ["child1_1", "child1_2"]
+    assert names(category_service.get_categories(depth=2)) == ["child1_1", "child1_2", "child2_1"]
+    assert names(category_service.get_categories(parent_name="child2", depth=1)) == ["child2_1"]
+    assert [(category.name, depth) for category, depth in category_service.get_subtree("root", max_depth=1)] == \
+           [("root", 0), ("child1", 1), ("child2", 1)]
+    assert [depth for _, depth in category_service.get_subtree("root")] == [0, 1, 2, 2, 1, 2]
+
+
+def test_moves_and_updates(category_service, populated):
+    category_service.move_category("child1_1", "child2")
+    assert names(category_service.get_categories(parent_name="child2")) == ["child2_1", "child1_1"]
+
+    with pytest.raises(HTTPException) as e:
+        category_service.move_category("child2", "child1_1")
+    assert e.value.status_code == 400
+
+    category_service.update_category("child2", Category(name="child2", description="Second", parent_name=None))
+    assert category_service.get_category("child2").description == "Second"
+    assert names(category_service.get_categories()) == ["root", "other", "child2"]
+
+
+def test_delete_drops_similarities(category_service, similarity_service, populated):
+    assert category_service.delete_category("child2")["deleted_categories"] == 1
+    assert names(category_service.get_categories(parent_name="root")) == ["child1", "child2_1"]
+    assert similarity_service.get_similarities("child1") == []
+
+    assert category_service.delete_category("root", DeleteMode.CASCADE)["deleted_categories"] == 5
+    assert names(category_service.get_categories()) == ["other"]
+    assert similarity_service.get_similarities("other") == []
+
+
+def test_similarities_and_rabbit_holes(repository, similarity_service, populated):
+    assert names(similarity_service.get_similarities("child2")) == ["child1", "child2_1"]
+    assert sorted(repository.similar_names("child2")) == ["child1", "child2_1"]
+    assert sorted(names(similarity_service.get_rabbit_island("child1"))) == ["child1", "child2", "child2_1"]
+    assert sorted(map(sorted, similarity_service.get_rabbit_islands())) == \
+           [["child1", "child2", "child2_1"], ["child1_1", "other"]]
+
+    result = RabbitHoleScript(repository).find_longest_rabbit_hole_and_islands()
+    assert result["longest_rabbit_hole"]["length"] == 2
+    assert RabbitHoleScript(repository).find_rabbit_hole("child2_1", "child1") == {
+        "length": 2, "categories": ["child2_1", "child2", "child1"]}
+    assert repository.same_rabbit_island("child1", "child2_1") and not repository.same_rabbit_island("child1", "other")
+
+    similarity_service.delete_similarity(Similarity(category_name_1="child2", category_name_2="child1"))
+    assert names(similarity_service.get_similarities("child2")) == ["child2_1"]
+    assert RabbitHoleScript(repository).find_longest_rabbit_hole_and_islands()["longest_rabbit_hole"]["length"] == 1
+
+
+def test_survives_reopening(tmp_path, repository, category_service, populated):
+    repository.close()
+    reopened = SqliteRepository(str(tmp_path / "categories.db"))
+    category_service = CategoryService(reopened)
+
+    category_service.create_category(Category(name="child1_3", parent_name="child1"))
+    assert names(category_service.get_categories(parent_name="child1")) == ["child1_1", "child1_2", "child1_3"]
+    assert names(reopened.get_similar("other")) == ["child1_1"]
+    reopened.close()
+
+
+def test_matches_the_in_memory_repository(repository):
+    random.seed(7)
+    services = [(CategoryService(store), SimilarityService(store)) for store in (InMemoryDatabase(), repository)]
+
+    def apply(operation, *arguments):
+        results = []
+        for category_service, similarity_service in services:
+            try:
+                results.append(operation(category_service, similarity_service, *arguments))
+            except HTTPException as e:
+                results.append(e.status_code)
+        assert results[0] == results[1]
+
+    # Deleted names stay in created, so operations on missing categories are compared as well
+    created = []
+    for index in range(300):
+        name = f"c{index}"
+        action = random.random()
+        if action < 0.4 or not created:
+            parent_name = random.choice(created + [None])
+            apply(lambda c, s: c.create_category(Category(name=name, parent_name=parent_name)).name)
+            created.append(name)
+            continue
+
+        name_1, name_2 = random.choice(created), random.choice(created + [None])
+        if action < 0.55:
+            apply(lambda c, s: c.move_category(name_1, name_2).parent_name)
+        elif action < 0.8 and name_2:
+            apply(lambda c, s: s.create_similarity(Similarity(category_name_1=name_1, category_name_2=name_2)))
+        elif action < 0.9:
+            mode = random.choice(list(DeleteMode))
+            apply(lambda c, s: c.delete_category(name_1, mode)["deleted_categories"])
+        elif name_2:
+            apply(lambda c, s: s.delete_similarity(Similarity(category_name_1=name_1, category_name_2=name_2)))
+
+    for name in created:
+        apply(lambda c, s: [(category.name, depth) for category, depth in c.get_subtree(name)])
+        apply(lambda c, s: sorted(names(s.get_similarities(name))))
+        apply(lambda c, s: names(c.get_categories(depth=2, parent_name=name)))
+        apply(lambda c, s: RabbitHoleScript(s.repository).find_rabbit_hole(name, created[-1])["length"])
+    apply(lambda c, s: names(c.get_categories()))
+    apply(lambda c, s: sorted(map(sorted, s.get_rabbit_islands())))
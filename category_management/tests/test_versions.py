@@ -0,0 +1,106 @@
+import sys
+
+sys.path.append('..')
+
+import random
+import pytest
+from fastapi import HTTPException
+from category_management.category_service import CategoryService
+from category_management.similarity_service import SimilarityService
+from category_management.models import InMemoryDatabase
+from category_management.sqlite_repository import SqliteRepository
+from category_management.schemas import Category, DeleteMode, Similarity
+from category_management.versions import etag_matches
+
+
+def test_etag_matches_any_listed_tag():
+    assert etag_matches('"a-1"', '"a-1"')
+    assert etag_matches('"a-0", W/"a-1"', '"a-1"')
+    assert not etag_matches('"a-2"', '"a-1"')
+    assert not etag_matches(None, '"a-1"')
+
+
+def test_conditional_gets_answer_304_until_the_resource_changes(client):
+    client.post("/categories/", json={"name": "root"})
+    client.post("/categories/", json={"name": "child", "parent_name": "root"})
+    client.post("/categories/", json={"name": "other"})
+    client.post("/similarities/", json={"category_name_1": "root", "category_name_2": "other"})
+
+    urls = ["/categories/child", "/categories/?parent_name=root", "/categories/?depth=1", "/similarities/other"]
+    etags = {}
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200 and response.headers["cache-control"] == "no-cache"
+        etags[url] = response.headers["etag"]
+
+        not_modified = client.get(url, headers={"If-None-Match": etags[url]})
+        assert not_modified.status_code == 304 and not_modified.content == b""
+        assert not_modified.headers["etag"] == etags[url]
+
+    # Renaming the description of child changes every listing it is in, but not the similarities of other
+    client.put("/categories/child", json={"name": "child", "description": "Changed"})
+    for url in urls:
+        response = client.get(url, headers={"If-None-Match": etags[url]})
+        assert response.status_code == (304 if url == "/similarities/other" else 200)
+
+    # root is similar to other, so its change shows in the similarities of other
+    client.put("/categories/root", json={"name": "root", "description": "Changed"})
+    response = client.get("/similarities/other", headers={"If-None-Match": etags["/similarities/other"]})
+    assert response.status_code == 200 and response.json()[0]["description"] == "Changed"
+
+    assert client.get("/categories/missing").status_code == 404
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_unchanged_etags_always_mean_unchanged_bodies(tmp_path, store):
+    random.seed(11)
+    repository = InMemoryDatabase() if store == "memory" else SqliteRepository(str(tmp_path / "categories.db"))
+    category_service, similarity_service = CategoryService(repository), SimilarityService(repository)
+    names = [f"c{index}" for index in range(12)]
+
+    def served():
+        resources = {}
+        for name in names + [None]:
+            for depth in (None, 1):
+                try:
+                    resources["categories", name, depth] = (category_service.categories_etag(name, depth), [
+                        category.json for category in category_service.get_categories(name, depth)])
+                except HTTPException:
+                    pass
+            if name is None:
+                continue
+            try:
+                resources["category", name] = (category_service.category_etag(name),
+                                               category_service.get_category(name).json)
+                resources["similar", name] = (similarity_service.similarities_etag(name), sorted(
+                    category.json for category in similarity_service.get_similarities(name)))
+            except HTTPException:
+                pass
+        return resources
+
+    seen = {}
+    for _ in range(400):
+        name, other = random.choice(names), random.choice(names + [None])
+        action = random.random()
+        try:
+            if action < 0.3:
+                category_service.create_category(Category(name=name, parent_name=other))
+            elif action < 0.45:
+                category_service.move_category(name, other)
+            elif action < 0.55:
+                category_service.update_category(name, Category(name=name, description=str(random.random())))
+            elif action < 0.65:
+                category_service.delete_category(name, random.choice(list(DeleteMode)))
+            elif other and action < 0.9:
+                similarity_service.create_similarity(Similarity(category_name_1=name, category_name_2=other))
+            elif other:
+                similarity_service.delete_similarity(Similarity(category_name_1=name, category_name_2=other))
+        except HTTPException:
+            pass
+
+        for resource, (etag, body) in served().items():
+            seen.setdefault(etag, {}).setdefault(resource, body)
+            assert seen[etag][resource] == body, resource
+
+    if store == "sqlite":
+        repository.close()
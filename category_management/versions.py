@@ -0,0 +1,46 @@
+import uuid
+from itertools import count
+from typing import Dict, Iterable, Optional, Tuple
+
+# What a version is kept for: one category, the children of a parent (None for the roots),
+# the similar categories of a category, and the whole tree for depth queries
+CATEGORY = "category"
+CHILDREN = "children"
+SIMILAR = "similar"
+TREE = "tree"
+
+
+class ResourceVersions:
+    """
+    Versions of the categories and listings the API serves, for ETags and conditional GETs.
+
+    Every bump takes the next number of one sequence, so a version is never reused. Only changed resources have
+    an entry - an unchanged one is at version 0 - and deleting a category bumps and keeps its entries, so one
+    created again under the same name continues past them. Versions restart with the process, so ETags carry
+    a per-process epoch and one from before a restart never matches.
+
+    The services bump after the write and readers take the version before they read, so a response may pair
+    an old version with new data - the next poll gets a full response - but never a new version with old data.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.sequence = count(1)
+        self.versions: Dict[Tuple[str, Optional[str]], int] = {}
+
+    def bump(self, kind: str, names: Iterable[Optional[str]]):
+        for name in names:
+            self.versions[kind, name] = next(self.sequence)
+
+    def version(self, kind: str, name: Optional[str] = None) -> int:
+        return self.versions.get((kind, name), 0)
+
+    def etag(self, kind: str, name: Optional[str] = None) -> str:
+        return f'"{self.epoch}-{self.version(kind, name)}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header lists etag, compared weakly as RFC 9110 prescribes for GET"""
+    if not if_none_match:
+        return False
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))